@@ -1,4 +1,6 @@
 import asyncio
+import contextlib
+import functools
 import json
 import logging
 import os
@@ -8,7 +10,7 @@ import pathlib
 # sys.path.append(
 #     pathlib.Path(__file__).parent.parent.as_posix()
 # )
-from typing import AsyncGenerator, Generator
+from typing import AsyncContextManager, AsyncGenerator, Generator
 import uuid
 
 import requests
@@ -16,12 +18,27 @@ import tiktoken
 import aiohttp
 
 from library.utils import get_filtered_keys_from_object, CFG
+from library.convo_store import ConversationStore
+from library.answer_cache import AnswerCache, Lookup
+from library.singleflight import SingleFlight
+from AIGC.scheduler import Priority, RequestScheduler
+from AIGC.endpoints import Endpoint, EndpointPool, key_fingerprint
+from AIGC.transport import RETRY_STATUSES, Backoff, Deadline, Timeouts, first_within, iter_lines
 from library.schemas import BaseAnwser, BaseQuestion
 from database import BaseAnwserDatabase
 import exceptions
 
 log = logging.getLogger("app.chat")
 
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(engine: str) -> tiktoken.Encoding:
+    """
+    Get tiktoken encoding of engine, loaded once per engine
+    """
+    return tiktoken.encoding_for_model(engine)
+
+
 class Chatbot:
     """
     Official ChatGPT API
@@ -29,6 +46,9 @@ class Chatbot:
     """
     _instance = None
     _init_args = None
+    # never written to / read from CONF_FP: session, cache, inflight, scheduler, endpoints, timeouts and retry are runtime only,
+    # conversation is persisted per convo_id by ConversationStore
+    _transient_keys = {'session', 'conversation', 'cache', 'inflight', 'scheduler', 'endpoints', 'timeouts', 'retry'}
 
     def __new__(cls, *args, **kwargs):
         if not cls._instance:
@@ -39,8 +59,9 @@ class Chatbot:
     @classmethod
     def get_instance(cls, *args, **kwargs):
         if not cls._instance:
-            cls._init_args = (args, kwargs)
-            cls._instance = super().__new__(cls)
+            # e.g. in a uvicorn worker process, where app.main did not create the bot
+            kwargs.setdefault('api_key', '')
+            cls(*args, **kwargs)
         return cls._instance
 
     def __init__(
@@ -86,8 +107,22 @@ class Chatbot:
             #     "https": proxy,
             # }
         log.debug(f"Proxy: {self.proxy}")
-        self.conversation = {}
-        self.new_user()
+        # shared aiohttp session for all OpenAI requests, see open_session
+        self.session: aiohttp.ClientSession | None = None
+        self.conversation = ConversationStore.from_config()
+        # answers of history-free asks, None if ChatGPT.CACHE.ENABLE is false
+        self.cache = AnswerCache.from_config(embed= self.embed)
+        # asks in flight, None if ChatGPT.COALESCE is false
+        self.inflight = SingleFlight() if CFG.C['ChatGPT'].get('COALESCE', True) else None
+        # rpm / tpm budgets and priorities of async requests
+        self.scheduler = RequestScheduler.from_config()
+        # api keys / base urls requests are spread over, ChatGPT.ENDPOINTS or api_key with API_URL
+        self.endpoints = EndpointPool.from_config(api_key= self.api_key)
+        # connect / first byte / idle stream timeouts, default deadline of an ask, and retries
+        self.timeouts = Timeouts.from_config()
+        self.retry = Backoff.from_config()
+        if 'default' not in self.conversation:
+            self.new_user()
         if max_tokens > 4000:
             raise Exception("Max tokens cannot be greater than 4000")
 
@@ -95,6 +130,90 @@ class Chatbot:
             raise Exception("System prompt is too long")
         self.load(CFG.C['ChatGPT']['CONF_FP'], 'not', 'api_key', 'max_tokens')
 
+    async def open_session(self) -> aiohttp.ClientSession:
+        """
+        Get the pooled aiohttp session, create it if not opened yet.
+        Opened on server startup and closed on shutdown, other callers create it lazily
+        """
+        if self.session is not None and not self.session.closed:
+            return self.session
+        http_cfg: dict = CFG.C['ChatGPT'].get('HTTP') or {}
+        connector = aiohttp.TCPConnector(
+            limit= http_cfg.get('LIMIT', 100),
+            limit_per_host= http_cfg.get('LIMIT_PER_HOST', 20),
+            keepalive_timeout= http_cfg.get('KEEPALIVE_TIMEOUT', 30),
+            ttl_dns_cache= http_cfg.get('DNS_CACHE_TTL', 300),
+            ssl= False,
+        )
+        timeout = aiohttp.ClientTimeout(
+            total= http_cfg.get('TOTAL_TIMEOUT'),
+            connect= http_cfg.get('CONNECT_TIMEOUT', 10),
+            sock_read= http_cfg.get('READ_TIMEOUT', 60),
+        )
+        self.session = aiohttp.ClientSession(connector= connector, timeout= timeout)
+        log.debug(f"Opened aiohttp session, {http_cfg=}")
+        return self.session
+
+    async def close_session(self) -> None:
+        """
+        Close the pooled aiohttp session
+        """
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+            log.debug("Closed aiohttp session")
+        self.session = None
+
+    async def embed(self, text: str) -> list[float]:
+        """
+        Get the embedding of text, used by the semantic lookup of AnswerCache
+        """
+        ss = await self.open_session()
+        model = (CFG.C['ChatGPT'].get('CACHE') or {}).get('EMBEDDING_MODEL') or "text-embedding-ada-002"
+        endpoint = self.endpoints.choose()
+        async with ss.post(
+            endpoint.embeddings_url,
+            headers= endpoint.headers(),
+            json= {"model": model, "input": text},
+            ssl = False,
+            proxy = self.proxy,
+            timeout= self.timeouts.client_timeout(stream= False),
+        ) as response:
+            if response.status != 200:
+                raise Exception(f"Error: {response.status} {response.reason} {await response.text()}")
+            resp = await response.json()
+        return resp['data'][0]['embedding']
+
+    def _answer_scope(self, convo_id: str, payload: dict, api_key: str = '') -> str | None:
+        """
+        Scope of answers that can be shared with other asks, by the answer cache or by coalescing
+        asks in flight. None if the conversation uses history, or several replies are asked.
+        Asks with another api key or of another endpoint pool (base urls, models) never share answers
+        """
+        if self.conversation[convo_id]['use_history'] or payload['n'] != 1:
+            return None
+        params = {key: payload[key] for key in ("model", "temperature", "top_p", "presence_penalty", "frequency_penalty", "n")}
+        params.update(api_key= key_fingerprint(api_key), endpoints= self.endpoints.identity())
+        return AnswerCache.make_scope(payload['messages'][0]['content'], params)
+
+    async def _save_anwser(self, full_response: str, **kwargs) -> None:
+        """
+        Save the anwser of a web question to anwser_db
+        """
+        if not kwargs.get("question_dict"):
+            return
+        question_dict: BaseQuestion = kwargs.get("question_dict")
+        anwser_db: BaseAnwserDatabase = kwargs.get("anwser_db")
+        anwser_dict = BaseAnwser(
+            content= full_response,
+            user_id= question_dict.user_id,
+            question_id=question_dict.id,
+            approach = question_dict.approach,
+            usage= 0,
+            timestamp= int(time.time())
+        )
+        # log.debug(anwser_dict.json())
+        await anwser_db.create(anwser_dict.dict())
+
     def add_to_conversation(
         self,
         message: str,
@@ -107,7 +226,12 @@ class Chatbot:
         if not self.conversation[convo_id]['use_history']:
             self.reset(convo_id)
             # self.conversation[convo_id]['history'] = [dict(role= role, content= message)]
-        self.conversation[convo_id]['history'].append(dict(role= role, content= message))
+        self._ensure_token_cache(convo_id)
+        _message = dict(role= role, content= message)
+        _tokens = self._count_message_tokens(_message)
+        self.conversation[convo_id]['history'].append(_message)
+        self.conversation[convo_id]['tokens'].append(_tokens)
+        self.conversation[convo_id]['token_count'] += _tokens
 
     # async def store_in_db(self, session, approach)
 
@@ -122,36 +246,86 @@ class Chatbot:
             ):
                 # Don't remove the first message
                 self.conversation[convo_id]['history'].pop(1)
+                self.conversation[convo_id]['token_count'] -= self.conversation[convo_id]['tokens'].pop(1)
             else:
                 break
 
     # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
-    def get_token_count(self, convo_id: str = "default") -> int:
+    def _count_message_tokens(self, message: dict) -> int:
         """
-        Get token count
+        Count tokens of a single history message
         """
         if self.engine not in ["gpt-3.5-turbo", "gpt-3.5-turbo-0301"]:
-            raise NotImplementedError("Unsupported engine {self.engine}")
-
-        encoding = tiktoken.encoding_for_model(self.engine)
-
-        num_tokens = 0
-        for message in self.conversation[convo_id]['history']:
-            # every message follows <im_start>{role/name}\n{content}<im_end>\n
-            num_tokens += 4
-            for key, value in message.items():
-                num_tokens += len(encoding.encode(value))
-                if key == "name":  # if there's a name, the role is omitted
-                    num_tokens += -1  # role is always required and always 1 token
-        num_tokens += 2  # every reply is primed with <im_start>assistant
+            raise NotImplementedError(f"Unsupported engine {self.engine}")
+
+        encoding = get_encoding(self.engine)
+
+        # every message follows <im_start>{role/name}\n{content}<im_end>\n
+        num_tokens = 4
+        for key, value in message.items():
+            num_tokens += len(encoding.encode(value))
+            if key == "name":  # if there's a name, the role is omitted
+                num_tokens += -1  # role is always required and always 1 token
         return num_tokens
 
+    def _ensure_token_cache(self, convo_id: str = "default") -> None:
+        """
+        Rebuild cached token counts of a conversation if they are missing or stale,
+        e.g. conversations loaded from a conf file written by an older version
+        """
+        convo = self.conversation[convo_id]
+        if 'tokens' in convo and len(convo['tokens']) == len(convo['history']):
+            return
+        log.debug(f"Rebuilding token cache of {convo_id}")
+        convo['tokens'] = [self._count_message_tokens(message) for message in convo['history']]
+        convo['token_count'] = sum(convo['tokens'])
+
+    def get_token_count(self, convo_id: str = "default") -> int:
+        """
+        Get token count
+        """
+        self._ensure_token_cache(convo_id)
+        # every reply is primed with <im_start>assistant
+        return self.conversation[convo_id]['token_count'] + 2
+
     def get_max_tokens(self, convo_id: str) -> int:
         """
         Get max tokens
         """
         return self.max_tokens - self.get_token_count(convo_id)
 
+    def _ask_lock(self, convo_id: str) -> AsyncContextManager:
+        """
+        Lock of an async ask: asks with history run one at a time per conversation, history-free asks
+        run concurrently. On a shared store every ask holds the lease, the usage counters it updates
+        are written back from a fresh copy
+        """
+        if self.conversation.shared or (convo_id in self.conversation and self.conversation[convo_id]['use_history']):
+            return self.conversation.lock(convo_id)
+        return contextlib.nullcontext()
+
+    def _ask_messages(self, prompt: str, convo_id: str) -> tuple[list[dict], int]:
+        """
+        Messages of an async ask and their token count, from the cached counts.
+        With history the prompt is added to the conversation, under the lock of _ask_lock;
+        a history-free ask sends the system prompt and its own prompt, and leaves the conversation as it is
+
+        Returns:
+            tuple[list[dict], int]: a snapshot of the messages, the tokens of the prompt
+        """
+        if convo_id not in self.conversation:
+            self.new_user(convo_id=convo_id, system_prompt=self.system_prompt)
+        if self.conversation[convo_id]['use_history']:
+            self.add_to_conversation(prompt, "user", convo_id=convo_id)
+            self.__truncate_conversation(convo_id=convo_id)
+            return list(self.conversation[convo_id]['history']), self.get_token_count(convo_id)
+        self._ensure_token_cache(convo_id)
+        system_message = self.conversation[convo_id]['history'][0]
+        message = dict(role= "user", content= prompt)
+        # every reply is primed with <im_start>assistant
+        prompt_tokens = self.conversation[convo_id]['tokens'][0] + self._count_message_tokens(message) + 2
+        return [system_message, message], prompt_tokens
+
     def ask_stream(
         self,
         prompt: str,
@@ -160,8 +334,19 @@ class Chatbot:
         **kwargs,
     ) -> Generator:
         """
-        Ask a question
+        Ask a question, holds the conversation lease of a shared store until the answer is saved.
+        For callers without an event loop, async code uses async_ask_stream
         """
+        with self.conversation.sync_lock(convo_id):
+            yield from self._ask_stream(prompt, role, convo_id, **kwargs)
+
+    def _ask_stream(
+        self,
+        prompt: str,
+        role: str = "user",
+        convo_id: str = "default",
+        **kwargs,
+    ) -> Generator:
         # Make conversation if it doesn't exist
         if convo_id not in self.conversation:
             self.new_user(convo_id=convo_id, system_prompt=self.system_prompt)
@@ -188,49 +373,68 @@ class Chatbot:
                 "max_tokens": self.get_max_tokens(convo_id=convo_id),
             }
         log.debug(f"Request payload: {payload}")
-        request_dict = dict(
-            headers = {"Authorization": f"Bearer {kwargs.get('api_key', self.api_key)}"},
-            json= payload,
-            stream = _stream,
-            verify = False,
-        )
-        if self.proxy:
-            request_dict['proxies'] = {"http": self.proxy, "https": self.proxy,}
+        # embeddings are async only, so the sync path does exact matches
+        lookup: Lookup | None = None
+        if (scope := self._answer_scope(convo_id, payload, kwargs.get('api_key', ''))) is not None and self.cache is not None:
+            lookup = self.cache.lookup(prompt, scope)
+            if lookup.hit:
+                log.debug(f"Anwser cache {lookup.hit} hit")
+                yield from self.cache.chunks(lookup.answer) if _stream else [lookup.answer]
+                return
+        deadline: Deadline = kwargs.get('deadline') or Deadline(self.timeouts.deadline)
+        tried: set[str] = set()
         # Get response
-        try_index = 0
-        while try_index < 3:
+        for attempt in range(self.retry.max_attempts):
+            last = attempt == self.retry.max_attempts - 1
+            if not deadline.allows(0):
+                raise exceptions.DeadlineExceeded("Deadline exceeded")
+            endpoint = self.endpoints.choose(tried)
+            tried.add(endpoint.name)
+            request_dict = dict(
+                headers = endpoint.headers(kwargs.get('api_key', '')),
+                json= dict(payload, model= endpoint.model) if endpoint.model else payload,
+                stream = _stream,
+                verify = False,
+                # requests has no deadline of its own, the read timeout is cut to the time left
+                timeout = (self.timeouts.connect, deadline.timeout(self.timeouts.first_byte if _stream else self.timeouts.read)),
+            )
+            if self.proxy:
+                request_dict['proxies'] = {"http": self.proxy, "https": self.proxy,}
             try:
                 response = requests.post(
-                    os.environ.get("API_URL") or "https://api.openai.com/v1/chat/completions",
+                    endpoint.chat_url,
                     **request_dict
                 )
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                endpoint.failure()
+                delay = self.retry.delay(attempt)
+                if last or not deadline.allows(delay):
+                    if isinstance(e, requests.exceptions.ProxyError):
+                        log.info(f"Proxy: {self.proxy}")
+                        raise exceptions.ProxyError(e) from e
+                    if isinstance(e, requests.exceptions.Timeout):
+                        raise exceptions.UpstreamTimeout(f"{endpoint.name} timed out") from e
+                    raise exceptions.UpstreamError(f"{endpoint.name}: {e!r}") from e
+                log.warning(f"Request to {endpoint.name} failed: {e!r}, retry in {delay:.2f}s")
+                time.sleep(delay)
+                continue
+            if response.status_code not in RETRY_STATUSES or last:
                 break
-            except requests.exceptions.ProxyError as e:
-                # log.exception(e)
-                raise exceptions.ProxyError() from e
-                # log.info(f"request dict: {request_dict}")
-            except Exception as e:
-                log.exception(e)
-            finally:
-                try_index += 1
-                log.info(f"request dict: {request_dict}")
-                if try_index == 3:
-                    return f"Error"
+            if response.status_code in (409, 429):
+                delay = self.retry.delay(attempt, response.headers.get("Retry-After"))
+                endpoint.throttled(delay)
+            else:
+                delay = self.retry.delay(attempt)
+                endpoint.failure()
+            if not deadline.allows(delay):
+                break
+            log.warning(f"Got {response.status_code} {response.reason} from {endpoint.name}, retry in {delay:.2f}s")
+            response.close()
+            time.sleep(delay)
+
+        if response.status_code != 200:
+            raise self._status_error(response.status_code, response.reason, response.text, endpoint)
 
-        match response.status_code:
-            case 401:
-                raise Exception(f"Error: {response.status_code} {response.reason} {response.text}\n API_KEY: {kwargs.get('api_key', self.api_key)}")
-            case 409:
-                raise exceptions.ModelOverloaded(
-                    reason= response.json()['error']['message']
-                )
-            case 200:
-                pass
-            case _:
-               raise Exception(
-                f"Error: {response.status_code} {response.reason} {response.text}",
-            ) 
-            
         if _stream:
             log.debug("streaming output")
             response_role: str = ''
@@ -268,6 +472,8 @@ class Chatbot:
             full_response = choices['message']['content'].strip()
             self.calculate_token(convo_id=convo_id, usage= usage)
 
+        if lookup is not None:
+            self.cache.store(lookup, full_response)
         if self.conversation[convo_id]['use_history']:
             self.add_to_conversation(full_response, response_role, convo_id=convo_id)
         if not _stream:
@@ -281,18 +487,30 @@ class Chatbot:
         **kwargs,
     ) -> AsyncGenerator:
         """
-        Ask a question
+        Ask a question, asks with history of the same conversation run one at a time.
+        kwargs['deadline'] (Deadline) bounds the ask until its answer starts, ChatGPT.HTTP.DEADLINE by default.
+        A failed ask yields the error as the answer and leaves no prompt behind in the history
         """
+        kwargs.setdefault('deadline', Deadline(self.timeouts.deadline))
+        # read from sqlite off the event loop before the conversation is used
+        await self.conversation.aload(convo_id)
+        async with self._ask_lock(convo_id):
+            async for content in self._async_ask_stream(prompt, role, convo_id, **kwargs):
+                yield content
+
+    async def _async_ask_stream(
+        self,
+        prompt: str,
+        role: str = "user",
+        convo_id: str = "default",
+        **kwargs,
+    ) -> AsyncGenerator:
         _stream = kwargs.get('stream', True)
         _approach = kwargs.get("approach", "Unknown")
-        # Make conversation if it doesn't exist
-        if convo_id not in self.conversation:
-            self.new_user(convo_id=convo_id, system_prompt=self.system_prompt)
-        self.add_to_conversation(prompt, "user", convo_id=convo_id)
-        self.__truncate_conversation(convo_id=convo_id)
+        messages, prompt_tokens = self._ask_messages(prompt, convo_id)
         payload = {
                 "model": self.engine,
-                "messages": self.conversation[convo_id]['history'],
+                "messages": messages,
                 "stream": _stream,
                 # kwargs
                 "temperature": kwargs.get("temperature", self.temperature),
@@ -307,81 +525,226 @@ class Chatbot:
                 ),
                 "n": kwargs.get("n", self.reply_count),
                 "user": role,
-                "max_tokens": self.get_max_tokens(convo_id=convo_id),
+                "max_tokens": self.max_tokens - prompt_tokens,
             }
+        # counted against the tokens-per-minute budget of the scheduler
+        kwargs["tokens"] = self._estimate_tokens(prompt_tokens, payload)
         log.debug(f"Request payload: {payload}")
-        # Get response
-        try_index = 0
-        response_role: str = ''
+        lookup: Lookup | None = None
+        if (scope := self._answer_scope(convo_id, payload, kwargs.get('api_key', ''))) is not None and self.cache is not None:
+            lookup = await self.cache.alookup(prompt, scope)
+            if lookup.hit:
+                log.debug(f"Anwser cache {lookup.hit} hit")
+                async for content in self.cache.replay(lookup.answer):
+                    yield content
+                await self._save_anwser(lookup.answer, **kwargs)
+                return
+        if scope is not None and self.inflight is not None:
+            # identical asks in flight share one request, every subscriber gets the whole stream
+            key = AnswerCache.make_key(prompt, scope)
+            joined = self.inflight.in_flight(key)
+            source = self.inflight.stream(key, lambda: self._completion_stream(payload, lookup, **kwargs))
+            if joined:
+                # the request runs with the leader's deadline, a follower waits no longer than its own
+                source = first_within(source, kwargs.get('deadline') or Deadline(self.timeouts.deadline))
+        else:
+            source = self._completion_stream(payload, lookup, **kwargs)
         full_response: str = ""
-        response: aiohttp.ClientResponse
-        while try_index < 3:
+        try:
+            async for content in source:
+                full_response += content
+                yield content
+        except exceptions.UpstreamError as e:
+            log.warning(f"Ask failed: {e!r}")
+            self._rollback_prompt(convo_id, messages)
+            yield self._error_answer(e)
+            return
+        await self._save_anwser(full_response, **kwargs)
+
+        if self.conversation[convo_id]['use_history']:
+            self.add_to_conversation(full_response, "assistant", convo_id=convo_id)
+
+    async def _completion_stream(
+        self,
+        payload: dict,
+        lookup: Lookup | None = None,
+        **kwargs,
+    ) -> AsyncGenerator:
+        """
+        Stream the content of one chat completion, the full answer is cached under lookup.
+        _post waits for the first line, a stream lost after it is not retried, and each of the other lines
+        must arrive within HTTP.IDLE_TIMEOUT; the deadline no longer applies
+        """
+        full_response: str = ""
+        endpoint, response, first_line = await self._post(payload, **kwargs)
+        try:
+            await self._raise_for_status(response, endpoint)
+            try:
+                async for line in iter_lines(response.content, self.timeouts.idle, first_line):
+                    line = line.decode("utf-8").strip()[6:]
+                    if not line:
+                        continue
+                    if line == "[DONE]":
+                        break
+                    resp: dict = json.loads(line)
+                    choices = resp.get("choices") # type: ignore
+                    if not choices:
+                        continue
+                    delta = choices[0].get("delta")
+                    if not delta:
+                        continue
+                    if "content" in delta:
+                        content = delta["content"]
+                        full_response += content
+                        # log.debug(f"yield {content=}")
+                        yield content
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                endpoint.failure()
+                raise self._upstream_error(e, endpoint) from e
+        finally:
+            # give the connection back to the pool
+            response.release()
+        log.debug(f"Iter finished")
+
+        if lookup is not None:
+            self.cache.store(lookup, full_response)
+
+    async def _post(self, payload: dict, **kwargs) -> tuple[Endpoint, aiohttp.ClientResponse, bytes]:
+        """
+        Post a chat completion request once the scheduler lets it go, with the priority, deadline and token estimate in kwargs.
+        The deadline bounds queueing, retries and the wait for the answer to start: the headers, and the first line
+        of a stream within HTTP.FIRST_BYTE_TIMEOUT. Network errors, timeouts and RETRY_STATUSES share one budget of
+        RETRY.MAX_ATTEMPTS attempts: right away on another endpoint when one is available,
+        else after a jittered exponential backoff.
+        429 (rate limited) / 409 (model overloaded) hold the endpoint for Retry-After seconds and pause the
+        whole queue instead when no other endpoint is available. 401 moves to another endpoint if there is one.
+        A retry that would not fit in the deadline is not made, the last error is given instead
+
+        Returns:
+            tuple[Endpoint, aiohttp.ClientResponse, bytes]: a 200 response, or the last error response for _raise_for_status,
+                and the first line of a streamed 200 response
+        """
+        tried: set[str] = set()
+        deadline: Deadline = kwargs.get('deadline') or Deadline(self.timeouts.deadline)
+        stream = payload['stream']
+        for attempt in range(self.retry.max_attempts):
+            last = attempt == self.retry.max_attempts - 1
+            await deadline.run(self.scheduler.acquire(kwargs.get('tokens', 0), kwargs.get("priority", Priority.IMSG)))
+            endpoint = self.endpoints.choose(tried)
+            tried.add(endpoint.name)
+            started = time.monotonic()
+            first_line = b''
             try:
-                async with aiohttp.ClientSession() as ss:
-                    response = await ss.post(
-                        os.environ.get("API_URL") or "https://api.openai.com/v1/chat/completions",
-                        headers={"Authorization": f"Bearer {kwargs.get('api_key', self.api_key)}"},
-                        json= payload,
+                ss = await self.open_session()
+                first_byte = Deadline(self.timeouts.first_byte if stream else self.timeouts.read)
+                response = await deadline.run(
+                    ss.post(
+                        endpoint.chat_url,
+                        headers= endpoint.headers(kwargs.get('api_key', '')),
+                        json= dict(payload, model= endpoint.model) if endpoint.model else payload,
                         ssl = False,
                         proxy = self.proxy,
-                    )
-                    async for line in response.content:
-                        line = line.decode("utf-8").strip()[6:]
-                        if not line:
-                            continue
-                        if line == "[DONE]":
-                            break
-                        resp: dict = json.loads(line)
-                        choices = resp.get("choices") # type: ignore
-                        if not choices:
-                            continue
-                        delta = choices[0].get("delta")
-                        if not delta:
-                            continue
-                        if "role" in delta:
-                            response_role = delta["role"]
-                        if "content" in delta:
-                            content = delta["content"]
-                            full_response += content
-                            # log.debug(f"yield {content=}")
-                            yield content
-                    print(f"Iter finished")
-                break
-            except (aiohttp.ClientProxyConnectionError, aiohttp.ClientHttpProxyError) as e:
-                log.exception(e)
-                log.info(f"Proxy: {self.proxy}")
-            finally:
-                try_index += 1
-                if try_index == 3:
-                    yield f"Error: {e}"
-                    return 
-
-        match response.status:
-            case 401:
-                raise Exception(f"Error: {response.status} {response.reason} {await response.text()}\n API_KEY: {kwargs.get('api_key', self.api_key)}")
-            case 200:
-                pass
-            case _:
-               raise Exception(
-                f"Error: {response.status} {response.reason} {await response.text()}",
-            )
+                        timeout= self.timeouts.client_timeout(stream),
+                    ),
+                    first_byte.remaining(),
+                )
+                if stream and response.status == 200:
+                    # nothing is generated (or billed) before the first line, so a stream lost until then is retried
+                    try:
+                        first_line = await deadline.run(response.content.readline(), first_byte.remaining())
+                    except BaseException:
+                        response.release()
+                        raise
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                endpoint.failure()
+                delay = 0 if self.endpoints.has_other(tried) else self.retry.delay(attempt)
+                if last or not deadline.allows(delay):
+                    raise self._upstream_error(e, endpoint) from e
+                log.warning(f"Request to {endpoint.name} failed: {e!r}, retry in {delay:.2f}s")
+                await asyncio.sleep(delay)
+                continue
+            if response.status == 200:
+                endpoint.success(time.monotonic() - started, response.headers)
+                return endpoint, response, first_line
+            if response.status in (409, 429):
+                delay = self.retry.delay(attempt, response.headers.get("Retry-After"))
+                endpoint.throttled(delay)
+            else:
+                delay = self.retry.delay(attempt)
+                if response.status in (401, 408) or response.status >= 500:
+                    endpoint.failure()
+            other = self.endpoints.has_other(tried)
+            retryable = response.status in RETRY_STATUSES or (response.status == 401 and other)
+            if last or not retryable or not deadline.allows(0 if other else delay):
+                return endpoint, response, first_line
+            response.release()
+            if other:
+                log.warning(f"Got {response.status} {response.reason} from {endpoint.name}, try another endpoint")
+            elif response.status in (409, 429):
+                log.warning(f"Got {response.status} {response.reason} from {endpoint.name}, pause the queue for {delay:.2f}s")
+                self.scheduler.pause(delay)
+            else:
+                log.warning(f"Got {response.status} {response.reason} from {endpoint.name}, retry in {delay:.2f}s")
+                await asyncio.sleep(delay)
 
-        if kwargs.get("question_dict"):
-            question_dict: BaseQuestion = kwargs.get("question_dict")
-            anwser_db: BaseAnwserDatabase = kwargs.get("anwser_db")
-            anwser_dict = BaseAnwser(
-                content= full_response,
-                user_id= question_dict.user_id,
-                question_id=question_dict.id,
-                approach = question_dict.approach,
-                usage= 0,
-                timestamp= int(time.time())
-            )
-            # log.debug(anwser_dict.json())
-            await anwser_db.create(anwser_dict.dict())
-            
-        if self.conversation[convo_id]['use_history']:
-            self.add_to_conversation(full_response, response_role, convo_id=convo_id)
+    def _upstream_error(self, e: Exception, endpoint: Endpoint) -> exceptions.UpstreamError:
+        """
+        The error to give up with after a network error or timeout of the last attempt
+        """
+        if isinstance(e, exceptions.UpstreamError):
+            return e
+        if isinstance(e, (aiohttp.ClientProxyConnectionError, aiohttp.ClientHttpProxyError)):
+            log.info(f"Proxy: {self.proxy}")
+            return exceptions.ProxyError(e)
+        if isinstance(e, asyncio.TimeoutError):
+            return exceptions.UpstreamTimeout(f"{endpoint.name} timed out")
+        return exceptions.UpstreamError(f"{endpoint.name}: {e!r}")
+
+    async def _raise_for_status(self, response: aiohttp.ClientResponse, endpoint: Endpoint) -> None:
+        if response.status == 200:
+            return
+        try:
+            text = await asyncio.wait_for(response.text(), self.timeouts.idle)
+        except (aiohttp.ClientError, asyncio.TimeoutError, UnicodeDecodeError):
+            text = ''
+        raise self._status_error(response.status, response.reason, text, endpoint)
+
+    def _status_error(self, status: int, reason: str | None, text: str, endpoint: Endpoint) -> exceptions.UpstreamStatusError:
+        """
+        The error for a non-200 response, ModelOverloaded with the message of a 409
+        """
+        if status == 409:
+            try:
+                reason = json.loads(text)['error']['message']
+            except (ValueError, KeyError, TypeError):
+                reason = text
+            return exceptions.ModelOverloaded(reason= reason)
+        if status == 401:
+            return exceptions.UpstreamStatusError(status, f"{status} {reason} {text}\n Endpoint: {endpoint.name}")
+        return exceptions.UpstreamStatusError(status, f"{status} {reason} {text}")
+
+    def _rollback_prompt(self, convo_id: str, messages: list[dict]) -> None:
+        """
+        Remove the prompt of a failed ask from the history, asking again does not send it twice
+        """
+        history = self.conversation[convo_id]['history']
+        if self.conversation[convo_id]['use_history'] and len(history) > 1 and history[-1] is messages[-1]:
+            self.rollback(1, convo_id=convo_id)
+
+    @staticmethod
+    def _error_answer(e: exceptions.UpstreamError) -> str:
+        """
+        The answer of a failed ask: the reason of an overloaded model as is, "Error: ..." otherwise
+        """
+        if isinstance(e, exceptions.ModelOverloaded):
+            return str(e.reason)
+        return f"Error: {e}"
+
+    def _estimate_tokens(self, prompt_tokens: int, payload: dict) -> int:
+        """
+        Tokens a request counts against the tokens-per-minute limit, prompt_tokens being the cached count of its messages
+        """
+        return self.scheduler.estimate(prompt_tokens, payload["max_tokens"])
 
     def ask(
         self,
@@ -402,7 +765,8 @@ class Chatbot:
             **kwargs,
         )
         # print(dir(full_response))
-        return next(full_response)
+        # run ask_stream to the end, so the answer is committed and the lease released
+        return ''.join(full_response)
     
     async def aask(
         self,
@@ -413,16 +777,28 @@ class Chatbot:
         **kwargs,
     ) -> tuple[str, str]:
         """
-        Non-streaming ask
+        Non-streaming ask, asks with history of the same conversation run one at a time.
+        kwargs['deadline'] (Deadline) bounds the ask until its answer starts, ChatGPT.HTTP.DEADLINE by default.
+        A failed ask returns the error as the answer and leaves no prompt behind in the history
         """
-        # Make conversation if it doesn't exist
-        if convo_id not in self.conversation:
-            self.new_user(convo_id=convo_id, system_prompt=self.system_prompt)
-        self.add_to_conversation(prompt, "user", convo_id=convo_id)
-        self.__truncate_conversation(convo_id=convo_id)
+        kwargs.setdefault('deadline', Deadline(self.timeouts.deadline))
+        # read from sqlite off the event loop before the conversation is used
+        await self.conversation.aload(convo_id)
+        async with self._ask_lock(convo_id):
+            return await self._aask(prompt, role, convo_id, msg_id, **kwargs)
+
+    async def _aask(
+        self,
+        prompt: str,
+        role: str = "user",
+        convo_id: str = "default",
+        msg_id: str = '1',
+        **kwargs,
+    ) -> tuple[str, str]:
+        messages, prompt_tokens = self._ask_messages(prompt, convo_id)
         payload = {
                 "model": self.engine,
-                "messages": self.conversation[convo_id]['history'],
+                "messages": messages,
                 "stream": False,
                 # kwargs
                 "temperature": kwargs.get("temperature", self.temperature),
@@ -437,65 +813,87 @@ class Chatbot:
                 ),
                 "n": kwargs.get("n", self.reply_count),
                 "user": role,
-                "max_tokens": self.get_max_tokens(convo_id=convo_id),
+                "max_tokens": self.max_tokens - prompt_tokens,
             }
-        # Get response
-        try_index = 0
-        response: aiohttp.ClientResponse
-        while try_index < 3:
-            try:
-                async with aiohttp.ClientSession() as ss:
-                    log.debug(f"Request payload: {payload}")
-                    response = await ss.post(
-                        os.environ.get("API_URL") or "https://api.openai.com/v1/chat/completions",
-                        headers={"Authorization": f"Bearer {kwargs.get('api_key', self.api_key)}"},
-                        json= payload,
-                        ssl = False,
-                        proxy = self.proxy
-                    )
-                break
-            except requests.exceptions.ProxyError as e:
-                log.exception(e)
-                log.info(f"Proxy: {self.proxy}")
-            finally:
-                try_index += 1
-                if try_index == 3:
-                    return msg_id, f"Error: {e}"
-
-        match response.status:
-            case 401:
-                raise Exception(f"Error: {response.status} {response.reason} {await response.text()}\n API_KEY: {kwargs.get('api_key', self.api_key)}")
-            case 200:
-                pass
-            case _:
-               raise Exception(
-                f"Error: {response.status} {response.reason} {await response.text()}",
-            ) 
-            
+        # counted against the tokens-per-minute budget of the scheduler
+        kwargs["tokens"] = self._estimate_tokens(prompt_tokens, payload)
+        lookup: Lookup | None = None
+        if (scope := self._answer_scope(convo_id, payload, kwargs.get('api_key', ''))) is not None and self.cache is not None:
+            lookup = await self.cache.alookup(prompt, scope)
+            if lookup.hit:
+                log.debug(f"Anwser cache {lookup.hit} hit")
+                return msg_id, lookup.answer
+        if scope is not None and self.inflight is not None:
+            # identical asks in flight share one request
+            key = AnswerCache.make_key(prompt, scope)
+            joined = self.inflight.in_flight(key)
+            completion = self.inflight.call(key, lambda: self._completion(payload, convo_id, lookup, **kwargs))
+            if joined:
+                # the request runs with the leader's deadline, a follower waits no longer than its own
+                completion = (kwargs.get('deadline') or Deadline(self.timeouts.deadline)).run(completion)
+        else:
+            completion = self._completion(payload, convo_id, lookup, **kwargs)
+        try:
+            result = await completion
+        except exceptions.UpstreamError as e:
+            log.warning(f"Ask failed: {e!r}")
+            self._rollback_prompt(convo_id, messages)
+            return msg_id, self._error_answer(e)
+        if result is None:
+            self._rollback_prompt(convo_id, messages)
+            return msg_id, "Error"
+        response_role, full_response = result
 
-        # log.debug(f"{response.text=}")
-        # async for line, _ in response.content.iter_chunks():
-        resp = await response.json()
+        if self.conversation[convo_id]['use_history']:
+            self.add_to_conversation(full_response, response_role, convo_id=convo_id)
+        return msg_id, full_response
+
+    async def _completion(
+        self,
+        payload: dict,
+        convo_id: str,
+        lookup: Lookup | None = None,
+        **kwargs,
+    ) -> tuple[str, str] | None:
+        """
+        Get one chat completion, tokens are counted for convo_id and the answer is cached under lookup
+
+        Returns:
+            tuple[str, str] | None: (role, answer), None if the response has no choices
+        """
+        log.debug(f"Request payload: {payload}")
+        endpoint, response, _ = await self._post(payload, **kwargs)
+        async with response:
+            await self._raise_for_status(response, endpoint)
+            try:
+                # the answer was generated (and billed) once the headers arrived: the body is read
+                # within HTTP.READ_TIMEOUT whatever the deadline, and not asked again when it fails
+                resp = await asyncio.wait_for(response.json(), self.timeouts.read)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                endpoint.failure()
+                raise self._upstream_error(e, endpoint) from e
         # TODO save usage info
         usage: dict = resp['usage']
         choices: dict = resp['choices'][0] # type: ignore
         if not choices:
             log.error(f"Error in response: {resp}")
-            return msg_id, "Error"
+            return None
         response_role = choices['message']['role']
         full_response = choices['message']['content'].strip()
         self.calculate_token(convo_id=convo_id, usage= usage)
 
-        if self.conversation[convo_id]['use_history']:
-            self.add_to_conversation(full_response, response_role, convo_id=convo_id)
-        return msg_id, full_response
+        if lookup is not None:
+            self.cache.store(lookup, full_response)
+        return response_role, full_response
 
     def rollback(self, n: int = 1, convo_id: str = "default") -> None:
         """
         Rollback the conversation
         """
+        self._ensure_token_cache(convo_id)
         for _ in range(n):
             self.conversation[convo_id]['history'].pop()
+            self.conversation[convo_id]['token_count'] -= self.conversation[convo_id]['tokens'].pop()
 
     def reset(self, convo_id: str = "default", system_prompt: str = '') -> None:
         """
@@ -505,6 +903,10 @@ class Chatbot:
             self.conversation[convo_id]['history'] = [
                 {"role": "system", "content": system_prompt or self.system_prompt},
             ]
+            self.conversation[convo_id]['tokens'] = [
+                self._count_message_tokens(self.conversation[convo_id]['history'][0])
+            ]
+            self.conversation[convo_id]['token_count'] = self.conversation[convo_id]['tokens'][0]
         else:
             self.new_user(convo_id)
 
@@ -513,8 +915,13 @@ class Chatbot:
         Open new session for new user
         """
         log.debug(f"Creating new user {convo_id}, {system_prompt}")
+        system_message = {'role': 'system', 'content': system_prompt or self.system_prompt}
+        system_tokens = self._count_message_tokens(system_message)
         self.conversation[convo_id] = {
-            'history': [{'role': 'system', 'content': system_prompt or self.system_prompt}],
+            'history': [system_message],
+            # cached token count of each history message, plus the running total
+            'tokens': [system_tokens],
+            'token_count': system_tokens,
             'use_history': False,
             'token_tt': 0,
             'token_ask': 0,
@@ -542,7 +949,7 @@ class Chatbot:
         """
         all_obj = {
             key: self.__dict__[key]
-            for key in get_filtered_keys_from_object(self, *keys)
+            for key in get_filtered_keys_from_object(self, *keys) - self._transient_keys
         }
         # if 'session' in all_obj:
         #     all_obj['session'] = all_obj['session'].proxies
@@ -566,13 +973,17 @@ class Chatbot:
         with open(file, encoding="utf-8") as f:
             # load json, if session is in keys, load proxies
             loaded_config = json.load(f)
-            keys = get_filtered_keys_from_object(self, *_keys)
+            keys = get_filtered_keys_from_object(self, *_keys) - self._transient_keys
             log.debug(f"Filtered keys: {keys}")
 
             # if "session" in keys and loaded_config["session"]:
             #     self.session.proxies = loaded_config["session"]
             # keys = keys - {"session"}
             self.__dict__.update({key: loaded_config[key] for key in keys if key in loaded_config})
+            # conversations saved in CONF_FP by older versions are moved to the store once
+            for convo_id, convo in (loaded_config.get('conversation') or {}).items():
+                if convo_id == 'default' or convo_id not in self.conversation:
+                    self.conversation[convo_id] = convo
 
     def load_test(self, *keys) -> None:
         """
@@ -584,6 +995,7 @@ class Chatbot:
     def __del__(self) -> None:
         try:
             self.save(CFG.C['ChatGPT']['CONF_FP'])
+            self.conversation.close()
         except NameError:
             pass
 
@@ -0,0 +1,262 @@
+import hashlib
+import logging
+import os
+import random
+import re
+import time
+from typing import Iterable, Mapping
+
+log = logging.getLogger("app.chat.endpoints")
+
+DEFAULT_BASE_URL = "https://api.openai.com/v1"
+# e.g. "1s", "6m0s", "20ms"
+DURATION_RE = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+
+def key_fingerprint(api_key: str) -> str:
+    """
+    Identifies an api key without revealing it, e.g. in answer cache scopes
+    """
+    return hashlib.sha256(api_key.encode()).hexdigest()[:16] if api_key else ''
+
+
+def parse_duration(value: str | None) -> float | None:
+    """
+    Parse durations of the x-ratelimit-reset-* headers, None if there is no valid value
+    """
+    if not value:
+        return None
+    parts = DURATION_RE.findall(value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(number) * DURATION_UNITS[unit] for number, unit in parts)
+
+
+class CircuitBreaker:
+    """
+    closed: requests go through, opens after `failures` consecutive failures
+    open: requests are refused until `reset_timeout` seconds (or the given time) have passed
+    half open: one probe request goes through, its success closes the breaker and its failure opens it again
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failures: int = 5, reset_timeout: float = 30) -> None:
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self._state = self.CLOSED
+        # a probe that never reports back (cancelled request) does not block the endpoint forever
+        self._probe_until = 0.0
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() >= self.open_until:
+            self._state = self.HALF_OPEN
+        return self._state
+
+    def available(self) -> bool:
+        match self.state:
+            case self.CLOSED:
+                return True
+            case self.HALF_OPEN:
+                return time.monotonic() >= self._probe_until
+            case _:
+                return False
+
+    def attempt(self) -> None:
+        if self.state == self.HALF_OPEN:
+            self._probe_until = time.monotonic() + self.reset_timeout
+
+    def success(self) -> None:
+        self.consecutive_failures = 0
+        self._state = self.CLOSED
+
+    def failure(self) -> None:
+        self.consecutive_failures += 1
+        if self._state == self.HALF_OPEN or self.consecutive_failures >= self.failures:
+            self.open(self.reset_timeout)
+
+    def open(self, seconds: float) -> None:
+        self._state = self.OPEN
+        self.open_until = max(self.open_until, time.monotonic() + seconds)
+        self._probe_until = 0.0
+
+
+class Endpoint:
+    """
+    An OpenAI-compatible API base url with its api key, e.g. https://api.openai.com/v1 or a local server.
+    Tracks latency (time to response headers), error rate, rate-limit headroom from the
+    x-ratelimit-* headers and a circuit breaker
+    """
+
+    def __init__(
+        self,
+        base_url: str = DEFAULT_BASE_URL,
+        api_key: str = '',
+        name: str = '',
+        model: str = '',
+        breaker: CircuitBreaker | None = None,
+    ) -> None:
+        self.base_url = base_url.rstrip('/')
+        self.api_key = api_key
+        self.name = name or self.base_url
+        # model name used instead of Chatbot.engine, for local servers
+        self.model = model
+        self.breaker = breaker or CircuitBreaker()
+        self.latency = 1.0
+        self.error_rate = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.remaining_requests: int | None = None
+        self.limit_requests: int | None = None
+        self.remaining_tokens: int | None = None
+        self.limit_tokens: int | None = None
+
+    @property
+    def chat_url(self) -> str:
+        return f"{self.base_url}/chat/completions"
+
+    @property
+    def embeddings_url(self) -> str:
+        return f"{self.base_url}/embeddings"
+
+    def headers(self, api_key: str = '') -> dict:
+        api_key = api_key or self.api_key
+        return {"Authorization": f"Bearer {api_key}"} if api_key else {}
+
+    def score(self) -> float:
+        """
+        Lower is better: slow, failing or nearly rate limited endpoints score higher
+        """
+        headroom = 1.0
+        for remaining, limit in ((self.remaining_requests, self.limit_requests), (self.remaining_tokens, self.limit_tokens)):
+            if remaining is not None and limit:
+                headroom = min(headroom, max(remaining / limit, 0.01))
+        return self.latency * (1 + 4 * self.error_rate) / headroom
+
+    def success(self, latency: float, headers: Mapping[str, str] | None = None) -> None:
+        self.requests += 1
+        self.latency = 0.8 * self.latency + 0.2 * latency
+        self.error_rate *= 0.8
+        self.breaker.success()
+        if headers:
+            self.update_limits(headers)
+
+    def failure(self) -> None:
+        self.requests += 1
+        self.errors += 1
+        self.error_rate = 0.8 * self.error_rate + 0.2
+        self.breaker.failure()
+
+    def throttled(self, retry_after: float) -> None:
+        """
+        429 / 409: no requests to this endpoint for retry_after seconds
+        """
+        self.requests += 1
+        self.breaker.open(retry_after)
+
+    def update_limits(self, headers: Mapping[str, str]) -> None:
+        def to_int(key: str, default: int | None = None) -> int | None:
+            try:
+                return int(headers[key])
+            except (KeyError, ValueError):
+                return default
+        # servers without these headers (e.g. local ones) keep None
+        self.limit_requests = to_int('x-ratelimit-limit-requests', self.limit_requests)
+        self.limit_tokens = to_int('x-ratelimit-limit-tokens', self.limit_tokens)
+        self.remaining_requests = to_int('x-ratelimit-remaining-requests', self.remaining_requests)
+        self.remaining_tokens = to_int('x-ratelimit-remaining-tokens', self.remaining_tokens)
+        # budget used up, skip the endpoint until it is reset
+        for remaining, reset in (('x-ratelimit-remaining-requests', 'x-ratelimit-reset-requests'),
+                                 ('x-ratelimit-remaining-tokens', 'x-ratelimit-reset-tokens')):
+            if to_int(remaining) == 0 and (seconds := parse_duration(headers.get(reset))):
+                self.breaker.open(seconds)
+
+    def stats(self) -> dict:
+        return {
+            'state': self.breaker.state,
+            'requests': self.requests,
+            'errors': self.errors,
+            'error_rate': round(self.error_rate, 3),
+            'latency': round(self.latency, 3),
+            'remaining_requests': self.remaining_requests,
+            'remaining_tokens': self.remaining_tokens,
+        }
+
+
+class EndpointPool:
+    """
+    Spreads requests over several endpoints: picks the better scoring of two random available ones.
+    Endpoints already tried by a request are only used again when nothing else is available,
+    when every breaker is open the one that reopens first is probed
+    """
+
+    def __init__(self, endpoints: Iterable[Endpoint]) -> None:
+        self.endpoints = list(endpoints)
+        if not self.endpoints:
+            raise ValueError("No endpoints")
+
+    @classmethod
+    def from_config(cls, api_key: str = '') -> 'EndpointPool':
+        """
+        ChatGPT.ENDPOINTS, or api_key with the API_URL env var when there is none
+        """
+        from library.utils import CFG
+        chat_cfg: dict = CFG.C['ChatGPT']
+        breaker_cfg: dict = chat_cfg.get('BREAKER') or {}
+
+        def breaker() -> CircuitBreaker:
+            return CircuitBreaker(
+                failures= breaker_cfg.get('FAILURES', 5),
+                reset_timeout= breaker_cfg.get('RESET_TIMEOUT', 30),
+            )
+
+        endpoints = [
+            Endpoint(
+                base_url= ep_cfg.get('URL') or DEFAULT_BASE_URL,
+                api_key= ep_cfg.get('API_KEY') or '',
+                name= ep_cfg.get('NAME') or f"endpoint{i}",
+                model= ep_cfg.get('MODEL') or '',
+                breaker= breaker(),
+            )
+            for i, ep_cfg in enumerate(chat_cfg.get('ENDPOINTS') or [])
+        ]
+        if not endpoints:
+            # API_URL used to be the full chat completions url
+            base_url = (os.environ.get("API_URL") or DEFAULT_BASE_URL).removesuffix('/chat/completions')
+            endpoints = [Endpoint(base_url, api_key, name= 'default', breaker= breaker())]
+        return cls(endpoints)
+
+    def choose(self, exclude: set[str] | None = None) -> Endpoint:
+        exclude = exclude or set()
+        available = [ep for ep in self.endpoints if ep.breaker.available()]
+        candidates = [ep for ep in available if ep.name not in exclude] or available
+        if not candidates:
+            endpoint = min(self.endpoints, key=lambda ep: ep.breaker.open_until)
+            log.warning(f"All endpoints are open, probing {endpoint.name}")
+        else:
+            endpoint = min(random.sample(candidates, min(2, len(candidates))), key=Endpoint.score)
+        endpoint.breaker.attempt()
+        return endpoint
+
+    def identity(self) -> list[str]:
+        """
+        Base urls, models and api key fingerprints of the endpoints, answers of other pools are not shared
+        """
+        return sorted(f"{ep.base_url} {ep.model} {key_fingerprint(ep.api_key)}" for ep in self.endpoints)
+
+    def has_other(self, exclude: set[str]) -> bool:
+        """
+        Whether an available endpoint not in exclude is left
+        """
+        return any(ep.breaker.available() and ep.name not in exclude for ep in self.endpoints)
+
+    def stats(self) -> dict:
+        return {ep.name: ep.stats() for ep in self.endpoints}
@@ -0,0 +1,134 @@
+import asyncio
+import collections
+import enum
+import heapq
+import itertools
+import logging
+import time
+
+from library.ratelimit import RateLimiter
+
+log = logging.getLogger("app.chat.scheduler")
+
+
+class Priority(enum.IntEnum):
+    """
+    Lower value goes first
+    """
+    WEB = 0
+    WECOM = 1
+    IMSG = 2
+
+
+class RequestScheduler:
+    """
+    Keeps OpenAI requests of this process within the requests-per-minute and tokens-per-minute budgets.
+    Requests over budget wait in a priority queue: a request goes only when it fits both budgets
+    and no request of higher priority (or earlier of the same priority) is waiting.
+    After a 429 / 409 response that no other endpoint can take, the whole queue pauses for Retry-After seconds.
+    rpm / tpm of 0 disables that budget
+    """
+
+    def __init__(
+        self,
+        rpm: int = 3500,
+        tpm: int = 90000,
+        completion_tokens: int = 500,
+    ) -> None:
+        self.requests = RateLimiter(rpm) if rpm else None
+        self.tokens = RateLimiter(tpm) if tpm else None
+        # tokens expected in a reply, see estimate
+        self.completion_tokens = completion_tokens
+        # (priority, seq, tokens, future)
+        self._queue: list[tuple[int, int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        self._timer: asyncio.TimerHandle | None = None
+        self.counter = collections.Counter()
+        self.waited = collections.Counter()
+        self.max_waited = collections.Counter()
+
+    @classmethod
+    def from_config(cls) -> 'RequestScheduler':
+        from library.utils import CFG
+        limit_cfg: dict = CFG.C['ChatGPT'].get('LIMIT') or {}
+        return cls(
+            rpm= limit_cfg.get('RPM', 3500),
+            tpm= limit_cfg.get('TPM', 90000),
+            completion_tokens= limit_cfg.get('COMPLETION_TOKENS', 500),
+        )
+
+    def estimate(self, prompt_tokens: int, max_tokens: int) -> int:
+        """
+        Tokens a request counts against the tokens-per-minute budget: the prompt plus the expected reply.
+        max_tokens is whatever is left of the context window, so it is only an upper bound of the reply
+        """
+        return prompt_tokens + min(max_tokens, self.completion_tokens)
+
+    async def acquire(self, tokens: int, priority: Priority = Priority.IMSG) -> float:
+        """
+        Wait for the turn of a request estimated at `tokens` tokens
+
+        Returns:
+            float: seconds waited
+        """
+        priority = Priority(priority)
+        started = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._seq), tokens, future))
+        self._dispatch()
+        # a cancelled waiter is dropped by _dispatch
+        await future
+        waited = time.monotonic() - started
+        self.counter[f"granted_{priority.name.lower()}"] += 1
+        self.waited[priority.name] += waited
+        self.max_waited[priority.name] = max(self.max_waited[priority.name], waited)
+        if waited > 1:
+            log.info(f"{priority.name} request waited {waited:.2f}s, {len(self._queue)} queued")
+        return waited
+
+    def _dispatch(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._queue:
+            _, _, tokens, future = self._queue[0]
+            if future.done():
+                heapq.heappop(self._queue)
+                continue
+            delay = max(self._paused_until - time.monotonic(), self._delay(tokens))
+            if delay > 0:
+                self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                return
+            heapq.heappop(self._queue)
+            if self.requests is not None:
+                self.requests.take(1)
+            if self.tokens is not None:
+                self.tokens.take(tokens)
+            future.set_result(None)
+
+    def _delay(self, tokens: int) -> float:
+        return max(
+            self.requests.delay(1) if self.requests is not None else 0,
+            self.tokens.delay(tokens) if self.tokens is not None else 0,
+        )
+
+    def pause(self, delay: float) -> None:
+        """
+        Hold the whole queue for delay seconds
+        """
+        self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        self.counter['throttled'] += 1
+        self._dispatch()
+
+    def stats(self) -> dict:
+        queued = collections.Counter(Priority(p).name for p, _, _, future in self._queue if not future.done())
+        stats: dict = {**self.counter}
+        for priority in Priority:
+            name = priority.name
+            granted = self.counter[f"granted_{name.lower()}"]
+            stats[f"queued_{name.lower()}"] = queued[name]
+            stats[f"wait_avg_{name.lower()}"] = round(self.waited[name] / granted, 3) if granted else 0.0
+            stats[f"wait_max_{name.lower()}"] = round(self.max_waited[name], 3)
+        stats['paused'] = round(max(self._paused_until - time.monotonic(), 0), 3)
+        return stats
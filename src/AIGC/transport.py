@@ -0,0 +1,183 @@
+import asyncio
+import dataclasses
+import inspect
+import random
+import time
+from typing import AsyncIterator, Awaitable, TypeVar
+
+import aiohttp
+
+import exceptions
+
+T = TypeVar('T')
+
+# worth retrying, on another endpoint when there is one
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+
+@dataclasses.dataclass
+class Timeouts:
+    """
+    Seconds, see ChatGPT.HTTP
+        - connect: to open the connection
+        - first_byte: until the response headers and the first line of a stream arrive
+        - idle: between two lines of a stream
+        - read: until a non-stream response is complete
+        - deadline: default budget of an ask until its answer starts: queueing, retries, connecting and the first byte.
+          An answer that started is timed by idle / read only
+    """
+    connect: float = 10
+    first_byte: float = 30
+    idle: float = 20
+    read: float = 60
+    deadline: float = 120
+
+    @classmethod
+    def from_config(cls) -> 'Timeouts':
+        from library.utils import CFG
+        http_cfg: dict = CFG.C['ChatGPT'].get('HTTP') or {}
+        return cls(
+            connect= http_cfg.get('CONNECT_TIMEOUT', 10),
+            first_byte= http_cfg.get('FIRST_BYTE_TIMEOUT', 30),
+            idle= http_cfg.get('IDLE_TIMEOUT', 20),
+            read= http_cfg.get('READ_TIMEOUT', 60),
+            deadline= http_cfg.get('DEADLINE', 120),
+        )
+
+    def client_timeout(self, stream: bool) -> aiohttp.ClientTimeout:
+        """
+        Per request timeout of aiohttp, stream reads are timed by iter_lines instead
+        """
+        return aiohttp.ClientTimeout(
+            sock_connect= self.connect,
+            sock_read= None if stream else self.read,
+        )
+
+
+class Backoff:
+    """
+    Exponential backoff with jitter: attempt n waits about base * 2 ** n seconds (at most cap),
+    or Retry-After when the server sent one
+    """
+
+    def __init__(self, max_attempts: int = 3, base: float = 0.5, cap: float = 8) -> None:
+        self.max_attempts = max(max_attempts, 1)
+        self.base = base
+        self.cap = cap
+
+    @classmethod
+    def from_config(cls) -> 'Backoff':
+        from library.utils import CFG
+        retry_cfg: dict = CFG.C['ChatGPT'].get('RETRY') or {}
+        return cls(
+            max_attempts= retry_cfg.get('MAX_ATTEMPTS', 3),
+            base= retry_cfg.get('BACKOFF', 0.5),
+            cap= retry_cfg.get('MAX_BACKOFF', 8),
+        )
+
+    def delay(self, attempt: int, retry_after: str | None = None) -> float:
+        try:
+            return max(float(retry_after), 0)
+        except (TypeError, ValueError):
+            return min(self.cap, self.base * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+
+class Deadline:
+    """
+    Point in time an ask must be answered by, passed down with kwargs['deadline'].
+    None seconds means no deadline
+    """
+
+    def __init__(self, seconds: float | None = None) -> None:
+        self.expires = time.monotonic() + seconds if seconds else None
+
+    @classmethod
+    def from_header(cls, value: str | None, default: float | None = None) -> 'Deadline':
+        """
+        From a timeout header of the incoming request (seconds), never longer than default
+        """
+        try:
+            seconds = float(value)
+        except (TypeError, ValueError):
+            return cls(default)
+        if seconds <= 0:
+            return cls(default)
+        return cls(min(seconds, default) if default else seconds)
+
+    def remaining(self) -> float | None:
+        if self.expires is None:
+            return None
+        return self.expires - time.monotonic()
+
+    @property
+    def expired(self) -> bool:
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    def timeout(self, timeout: float | None = None) -> float | None:
+        """
+        The shorter of timeout and the time left
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        return remaining if timeout is None else min(timeout, remaining)
+
+    async def run(self, aw: Awaitable[T], timeout: float | None = None) -> T:
+        """
+        Await aw for at most timeout seconds and the time left.
+        Raises DeadlineExceeded when the deadline passed, asyncio.TimeoutError when only timeout did
+        """
+        if self.expired:
+            if inspect.iscoroutine(aw):
+                aw.close()
+            raise exceptions.DeadlineExceeded("Deadline exceeded")
+        try:
+            return await asyncio.wait_for(aw, self.timeout(timeout))
+        except asyncio.TimeoutError:
+            if self.expired:
+                raise exceptions.DeadlineExceeded("Deadline exceeded") from None
+            raise
+
+    def allows(self, delay: float) -> bool:
+        """
+        Whether there is time left to wait delay seconds before a retry
+        """
+        remaining = self.remaining()
+        return remaining is None or delay < remaining
+
+
+async def first_within(chunks: AsyncIterator[T], deadline: Deadline) -> AsyncIterator[T]:
+    """
+    Chunks of a stream shared with other asks, the first one must arrive before this ask's deadline.
+    Later chunks are timed by whoever produces the stream
+    """
+    it = aiter(chunks)
+    try:
+        first = await deadline.run(anext(it))
+    except StopAsyncIteration:
+        return
+    yield first
+    async for chunk in it:
+        yield chunk
+
+
+async def iter_lines(
+    content: aiohttp.StreamReader,
+    idle: float | None = None,
+    first: bytes = b'',
+) -> AsyncIterator[bytes]:
+    """
+    Lines of a streamed response that already started, each must arrive within idle seconds of the previous one.
+    No deadline applies, a long answer is not cut off
+
+    Args:
+        first (bytes): the first line when it was read already, e.g. while waiting for the first byte
+    """
+    if first:
+        yield first
+    while True:
+        line = await asyncio.wait_for(content.readline(), idle)
+        if not line:
+            return
+        yield line
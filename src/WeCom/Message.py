@@ -1,9 +1,10 @@
 import json
 import logging
 from datetime import datetime as dt
-import os
 import pathlib
+import subprocess
 import sys
+from typing import AsyncIterator
 sys.path.append(
     pathlib.Path(__file__).parent.parent.as_posix()
 )
@@ -11,10 +12,15 @@ sys.path.append(
 import requests
 
 
+from library.transcode import Transcoder, reframe, tee_to_file
 from library.utils import CFG
+from WeCom.access_token import AccessTokenManager
+from WeCom.client import TOKEN_ERRCODES, WeComClient, text_msg_payload, split_text
 
 log = logging.getLogger('app.wcom.msg')
 
+TEMP_MEDIA_URL = 'https://qyapi.weixin.qq.com/cgi-bin/media/get?access_token=%s&media_id=%s'
+
 def send_text_to_app(content: str, recvd_cont_dict: dict):
     """send text to WeCom app
 
@@ -24,52 +30,25 @@ def send_text_to_app(content: str, recvd_cont_dict: dict):
     """
     token = get_access_token()
     url = CFG.C['WeCom']['URL']['SEND_MSG'] % token
-    body = {
-        'agent_id': ''
-    }
-    payload = json.dumps({
-        "touser": recvd_cont_dict['FromUserName'],
-        #    "toparty": config.toparty,
-        #    "totag": config.totag,
-        "msgtype": "text",
-        "agentid": recvd_cont_dict['AgentID'],
-        "text": {
-            "content": content
-        },
-        "safe": 0,
-        "enable_id_trans": 0,
-        "enable_duplicate_check": 0
-    })
-    res = requests.post(url, data=payload)
-    log.debug(f"Status: {res.status_code}")
+    for part in split_text(content):
+        payload = json.dumps(text_msg_payload(part, recvd_cont_dict))
+        res = requests.post(url, data=payload)
+        log.debug(f"Status: {res.status_code}")
+
+async def async_send_text_to_app(content: str, recvd_cont_dict: dict) -> bool:
+    """send text to WeCom app without blocking the event loop
+
+    Args:
+        content (str): text
+        recvd_cont_dict (dict): dict: {ToUserName, FromUserName, CreateTime, MsgType, Content, MsgId, AgentID}
+    """
+    return await WeComClient.get_instance().send_text(content, recvd_cont_dict)
 
 def get_access_token() -> str:
-    token_file = pathlib.Path(CFG.C['WeCom']['ACCESS_TOKEN_CACHE']).expanduser()
-    if token_file.exists():
-        with open(token_file, 'r') as f:
-            token_obj = json.load(f)
-        if token_valid(token_obj):
-            return token_obj['token']
-    url = CFG.C['WeCom']['URL']['ACCTK'] % (CFG.C['WeCom']['CorpID'], CFG.C['WeCom']['Secret'])
-    res = requests.get(url, verify=False)
-    log.debug(f"status: {res.status_code}")
-    access_token = res.json()['access_token']
-    store_token(access_token)
-    return access_token
-
-def store_token(token: str):
-    token_file = pathlib.Path(CFG.C['WeCom']['ACCESS_TOKEN_CACHE']).expanduser()
-    # 企业微信设置token 7200s 过期，但是也可能提前过期，所以认为缩短200s
-    token_obj = {'token': token, 'expiry': int(dt.timestamp(dt.now())) + 7000 }
-    with open(token_file, 'w') as f:
-        json.dump(token_obj, f)
-
-def token_valid(token_obj: dict) -> bool:
-    if int(token_obj['expiry']) < dt.timestamp(dt.now()):
-        log.warning(f"Token expired, will request new token")
-        return False
-    log.debug(f"Get valid cache token")
-    return True
+    """
+    同步获取 access_token, 协程中使用 AccessTokenManager.get_instance().get()
+    """
+    return AccessTokenManager.get_instance().get_sync()
 
 def get_mediar_cache_fp(fn: str = '', suffix: str = '.amr') -> pathlib.Path:
     cache_dir = pathlib.Path(CFG.C['WeCom']['MEDIA_CACHE_DIR']).expanduser()
@@ -81,14 +60,15 @@ def get_mediar_cache_fp(fn: str = '', suffix: str = '.amr') -> pathlib.Path:
     log.debug(f"Temp media file name: {fn}")
     return cache_dir/fn
 
-def download_temp_media(media_id: str, access_token: str = get_access_token(), fn: str = '') -> str:
+def download_temp_media(media_id: str, access_token: str = '', fn: str = '') -> str:
     """
     获取临时素材
     Method: GET
 
     fn: file name,来源于 voice msgid
     """
-    url = 'https://qyapi.weixin.qq.com/cgi-bin/media/get?access_token=%s&media_id=%s' % (access_token, media_id)
+    access_token = access_token or get_access_token()
+    url = TEMP_MEDIA_URL % (access_token, media_id)
     res = requests.get(url, verify=False)
     log.debug(f"{res.status_code=}, {res.headers=}")
     if res.status_code == 200:
@@ -98,12 +78,48 @@ def download_temp_media(media_id: str, access_token: str = get_access_token(), f
     log.error(f"{res.text=}")
     return ''
 
-def download_high_definition_voice_material(media_id: str, access_token: str = get_access_token(), fn: str = '') -> str:
+class MediaDownloadError(Exception):
+    pass
+
+async def stream_temp_media(media_id: str, chunk_size: int = 4096) -> AsyncIterator[bytes]:
+    """
+    获取临时素材, 边下载边返回数据块, 不写入文件
+    企业微信出错时返回 json 而不是素材内容
+    """
+    token_manager = AccessTokenManager.get_instance()
+    token = await token_manager.get()
+    ss = await WeComClient.get_instance().open_session()
+    async with ss.get(TEMP_MEDIA_URL % (token, media_id), ssl=False) as res:
+        log.debug(f"{res.status=}, {res.headers=}")
+        if res.status != 200 or res.content_type in ('application/json', 'text/plain'):
+            res_json: dict = await res.json(content_type=None)
+            if res_json.get('errcode') in TOKEN_ERRCODES:
+                token_manager.invalidate(token)
+            raise MediaDownloadError(f"Error while geting media with media_id {media_id}: {res_json}")
+        async for chunk in res.content.iter_chunked(chunk_size):
+            yield chunk
+
+def stream_voice_pcm(media_id: str, fn: str = '') -> AsyncIterator[bytes]:
+    """
+    下载 amr 语音并转换为 16k 16bit pcm, 按 160ms 分帧返回, 全程不落盘
+    WeCom.MEDIA_CACHE 为 true 时, 同时把 amr 和 pcm 保存到 MEDIA_CACHE_DIR 便于调试
+    """
+    cache = CFG.C['WeCom'].get('MEDIA_CACHE', False)
+    media = stream_temp_media(media_id)
+    if cache:
+        media = tee_to_file(media, get_mediar_cache_fp(fn= fn))
+    pcm = Transcoder.get_instance().stream_to_pcm(media, 'amr')
+    if cache:
+        pcm = tee_to_file(pcm, get_mediar_cache_fp(fn= fn, suffix='.pcm'))
+    return reframe(pcm)
+
+def download_high_definition_voice_material(media_id: str, access_token: str = '', fn: str = '') -> str:
     """
     WeCom 获取高清语音素材
     https://developer.work.weixin.qq.com/document/path/90255
     格式为speex, 16k ar
     """
+    access_token = access_token or get_access_token()
     url = 'https://qyapi.weixin.qq.com/cgi-bin/media/get/jssdk?access_token=%s&media_id=%s' % (access_token, media_id)
     res = requests.get(url, verify=False)
     log.debug(f"{res.status_code=}, {res.headers=}")
@@ -118,15 +134,20 @@ def amr2pcm(amr_fp: str, wav_fp: str, audio_rate: int = 16000) -> int:
     """
     amr格式语音数据转换为wav格式音频文件
     wav格式的音频文件编码格式为pcm
+    协程中使用 library.transcode.Transcoder, 不需要中间文件
     """
-    return os.system(f'ffmpeg -y -i {amr_fp} -acodec pcm_s16le -ar {audio_rate} {wav_fp}')
+    return subprocess.run(
+        ['ffmpeg', '-loglevel', 'error', '-y', '-i', amr_fp, '-acodec', 'pcm_s16le', '-ar', str(audio_rate), wav_fp]
+    ).returncode
 
 def spx2pcm(spx_fp: str, wav_fp: str, audio_rate: int = 16000) -> int:
     """
     spx(speex)格式语音数据转换为wav格式音频文件
     wav格式的音频文件编码格式为pcm
     """
-    return os.system(f"sox {spx_fp} -t raw -r 16000 -e signed-integer -b 16 -c 1 {wav_fp}")
+    return subprocess.run(
+        ['sox', spx_fp, '-t', 'raw', '-r', str(audio_rate), '-e', 'signed-integer', '-b', '16', '-c', '1', wav_fp]
+    ).returncode
 
 def voice2text():
     """
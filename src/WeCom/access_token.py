@@ -0,0 +1,134 @@
+import asyncio
+import json
+import logging
+import pathlib
+import threading
+import time
+
+import aiohttp
+import requests
+
+from library.utils import CFG
+
+log = logging.getLogger('app.wcom.token')
+
+# 企业微信设置token 7200s 过期，但是也可能提前过期，所以认为缩短200s
+EXPIRY_MARGIN = 200
+# 距离过期不足该时间时在后台提前刷新, 调用方继续使用当前 token
+REFRESH_AHEAD = 300
+# 获取 token 的请求超时, 卡住的 token 接口不会让所有发送方一直等待
+FETCH_TIMEOUT = 10
+
+
+class AccessTokenManager:
+    """
+    企业微信 access_token 缓存
+        - token 缓存在进程内存中, 过期前 REFRESH_AHEAD 秒在后台提前刷新
+        - 同一时刻只有一个刷新请求, 并发的调用方等待同一个结果
+        - ACCESS_TOKEN_CACHE 文件只用于进程启动时恢复 token
+    """
+    _instance = None
+
+    def __init__(self) -> None:
+        self.token: str = ''
+        self.expiry: float = 0
+        self._refresh_task: asyncio.Task | None = None
+        self._sync_lock = threading.Lock()
+        self._cache_fp = pathlib.Path(
+            CFG.C['WeCom'].get('ACCESS_TOKEN_CACHE') or '~/.AIGCSrv/wecom_token.json'
+        ).expanduser()
+        self._load_cache()
+
+    @classmethod
+    def get_instance(cls) -> 'AccessTokenManager':
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def valid(self, ahead: float = 0) -> bool:
+        return bool(self.token) and time.time() < self.expiry - ahead
+
+    async def get(self) -> str:
+        """
+        获取 access_token, 过期时等待刷新
+        """
+        if self.valid(REFRESH_AHEAD):
+            return self.token
+        if self.valid():
+            # 快过期了, 后台刷新, 先返回当前 token
+            self._start_refresh()
+            return self.token
+        return await self.refresh()
+
+    async def refresh(self) -> str:
+        """
+        刷新 access_token, 并发调用只会请求一次
+        """
+        return await asyncio.shield(self._start_refresh())
+
+    def invalidate(self, token: str) -> None:
+        """
+        企业微信返回 token 无效(40014, 42001)时调用, 下次 get 会重新获取
+        """
+        if token == self.token:
+            log.warning("Access token invalidated")
+            self.expiry = 0
+
+    def get_sync(self) -> str:
+        """
+        同步代码中获取 access_token, 与 get 共用进程内缓存
+        """
+        if self.valid():
+            return self.token
+        with self._sync_lock:
+            if not self.valid():
+                res = requests.get(self._url(), verify=False, timeout=FETCH_TIMEOUT)
+                log.debug(f"status: {res.status_code}")
+                self._set_token(res.json())
+                self._store_cache()
+        return self.token
+
+    def _start_refresh(self) -> asyncio.Task:
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._fetch())
+            self._refresh_task.add_done_callback(self._refresh_done)
+        return self._refresh_task
+
+    def _refresh_done(self, task: asyncio.Task) -> None:
+        # 后台刷新没有调用方等待, 在这里记录错误
+        if not task.cancelled() and task.exception():
+            log.error(f"Error while refreshing access token: {task.exception()}")
+
+    async def _fetch(self) -> str:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=FETCH_TIMEOUT)) as ss:
+            async with ss.get(self._url(), ssl=False) as res:
+                log.debug(f"status: {res.status}")
+                self._set_token(await res.json())
+        await asyncio.to_thread(self._store_cache)
+        return self.token
+
+    def _url(self) -> str:
+        return CFG.C['WeCom']['URL']['ACCTK'] % (CFG.C['WeCom']['CorpID'], CFG.C['WeCom']['Secret'])
+
+    def _set_token(self, res_json: dict) -> None:
+        if not res_json.get('access_token'):
+            raise Exception(f"Error while getting access token: {res_json}")
+        self.token = res_json['access_token']
+        self.expiry = time.time() + int(res_json.get('expires_in', 7200)) - EXPIRY_MARGIN
+        log.info("Access token refreshed")
+
+    def _load_cache(self) -> None:
+        if not self._cache_fp.exists():
+            return
+        try:
+            token_obj = json.loads(self._cache_fp.read_text())
+            self.token, self.expiry = token_obj['token'], float(token_obj['expiry'])
+        except (ValueError, KeyError) as e:
+            log.warning(f"Invalid access token cache {self._cache_fp}: {e}")
+            return
+        if self.valid():
+            log.debug(f"Get valid cache token")
+
+    def _store_cache(self) -> None:
+        self._cache_fp.parent.mkdir(parents=True, exist_ok=True)
+        self._cache_fp.write_text(json.dumps({'token': self.token, 'expiry': int(self.expiry)}))
@@ -0,0 +1,241 @@
+import asyncio
+import collections
+import logging
+import random
+from typing import AsyncIterator
+
+import aiohttp
+
+from library.utils import CFG
+from library.ratelimit import RateLimiter
+from WeCom.access_token import AccessTokenManager
+
+log = logging.getLogger('app.wcom.client')
+
+# access_token 无效、过期、缺失, 刷新 token 后重试
+TOKEN_ERRCODES = {40014, 42001, 41001}
+# 系统繁忙、调用频率超限, 退避后重试
+RETRY_ERRCODES = {-1, 45009, 45033}
+# 分段时优先在这些位置断开
+SPLIT_SEPS = ('\n\n', '\n', '。', '！', '？', '. ', '! ', '? ', '；', '; ', '，', ', ', ' ')
+# 流式回复时, 在段落或句子结束处发送已生成的部分
+SENTENCE_SEPS = ('\n', '。', '！', '？', '. ', '! ', '? ', '；', '; ')
+
+
+def text_msg_payload(content: str, recvd_cont_dict: dict) -> dict:
+    """
+    WeCom 应用文本消息 body
+    """
+    return {
+        "touser": recvd_cont_dict['FromUserName'],
+        #    "toparty": config.toparty,
+        #    "totag": config.totag,
+        "msgtype": "text",
+        "agentid": recvd_cont_dict['AgentID'],
+        "text": {
+            "content": content
+        },
+        "safe": 0,
+        "enable_id_trans": 0,
+        "enable_duplicate_check": 0
+    }
+
+
+def split_text(content: str, max_bytes: int = 2048) -> list[str]:
+    """将长文本按 utf-8 字节数分段, 尽量在段落、句子处断开
+    企业微信文本消息最长 2048 字节, 超过会被截断
+
+    Returns:
+        list[str]: 每段不超过 max_bytes 字节
+    """
+    parts = []
+    while len(content.encode()) > max_bytes:
+        # 不超过 max_bytes 的最长前缀, 不截断多字节字符
+        cut = len(content.encode()[:max_bytes].decode('utf-8', 'ignore'))
+        for sep in SPLIT_SEPS:
+            idx = content.rfind(sep, cut // 2, cut)
+            if idx != -1:
+                cut = idx + len(sep)
+                break
+        parts.append(content[:cut].rstrip())
+        content = content[cut:].lstrip('\n')
+    if content.strip():
+        parts.append(content)
+    return parts
+
+
+def chunk_end(text: str, min_chars: int) -> int:
+    """text 中可以发送的前缀长度, 0 表示继续等待
+
+    Args:
+        text (str): 尚未发送的文本
+        min_chars (int): 不足该长度时不发送, 避免消息过碎
+    """
+    if len(text) < min_chars:
+        return 0
+    idx = text.rfind('\n\n')
+    if idx > 0:
+        return idx + 2
+    return max((text.rfind(sep) + len(sep) for sep in SENTENCE_SEPS if text.rfind(sep) > 0), default=0)
+
+
+class WeComClient:
+    """
+    发送企业微信应用消息
+        - 共用一个 aiohttp session, 最多 CONCURRENCY 个请求同时发送
+        - 按应用和成员限流, 企业微信限制每应用对同一成员 30 次/分钟
+        - 网络错误、系统繁忙、token 失效时退避重试
+    """
+    _instance = None
+
+    def __init__(self) -> None:
+        send_cfg: dict = CFG.C['WeCom'].get('SEND') or {}
+        self.max_bytes: int = send_cfg.get('MAX_BYTES', 2048)
+        self.retries: int = send_cfg.get('RETRIES', 3)
+        self.backoff: float = send_cfg.get('BACKOFF', 1)
+        self.timeout: float = send_cfg.get('TIMEOUT', 10)
+        self.concurrency: int = send_cfg.get('CONCURRENCY', 10)
+        self.user_per_minute: int = send_cfg.get('USER_PER_MINUTE', 30)
+        self.stream_first_chars: int = send_cfg.get('STREAM_FIRST_CHARS', 20)
+        self.stream_chunk_chars: int = send_cfg.get('STREAM_CHUNK_CHARS', 300)
+        self._app_limiter = RateLimiter(send_cfg.get('APP_PER_MINUTE', 600))
+        # 按最近使用排序, 见 _user_limiter
+        self._user_limiters: collections.OrderedDict[str, RateLimiter] = collections.OrderedDict()
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self.session: aiohttp.ClientSession | None = None
+
+    @classmethod
+    def get_instance(cls) -> 'WeComClient':
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    async def open_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector= aiohttp.TCPConnector(limit= self.concurrency, ttl_dns_cache= 300),
+                timeout= aiohttp.ClientTimeout(total= self.timeout),
+            )
+        return self.session
+
+    async def close_session(self) -> None:
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    async def send_text(self, content: str, recvd_cont_dict: dict) -> bool:
+        """send text to WeCom app, 超长文本按顺序分段发送
+
+        Args:
+            content (str): text
+            recvd_cont_dict (dict): dict: {ToUserName, FromUserName, CreateTime, MsgType, Content, MsgId, AgentID}
+
+        Returns:
+            bool: 所有分段都发送成功
+        """
+        result = True
+        for part in split_text(content, self.max_bytes):
+            result &= await self.send(text_msg_payload(part, recvd_cont_dict))
+        return result
+
+    async def send_stream(self, stream: AsyncIterator[str], recvd_cont_dict: dict) -> str:
+        """边生成边发送, 第一句话生成后立即发送, 之后每积累 STREAM_CHUNK_CHARS 个字符
+        在段落或句子结束处发送一次
+
+        Args:
+            stream (AsyncIterator[str]): 例如 Chatbot.async_ask_stream
+            recvd_cont_dict (dict): dict: {ToUserName, FromUserName, CreateTime, MsgType, Content, MsgId, AgentID}
+
+        Returns:
+            str: 完整的回复
+        """
+        # 发送放在单独的 task 中, 不阻塞读取 stream
+        chunks: asyncio.Queue[str | None] = asyncio.Queue()
+
+        async def sender():
+            while (chunk := await chunks.get()) is not None:
+                await self.send_text(chunk, recvd_cont_dict)
+
+        sender_task = asyncio.create_task(sender())
+        full_response = ''
+        pending = ''
+        min_chars = self.stream_first_chars
+        try:
+            async for content in stream:
+                full_response += content
+                pending += content
+                cut = chunk_end(pending, min_chars)
+                if cut and pending[:cut].strip():
+                    chunks.put_nowait(pending[:cut].strip())
+                    pending = pending[cut:]
+                    min_chars = self.stream_chunk_chars
+            if pending.strip():
+                chunks.put_nowait(pending.strip())
+        finally:
+            chunks.put_nowait(None)
+            await sender_task
+        return full_response
+
+    def _user_limiter(self, touser: str) -> RateLimiter:
+        """
+        成员的限流器. 最久未使用的限流器恢复满额后丢弃, 与新建的没有区别,
+        所以只保留最近一分钟内发送过消息的成员
+        """
+        limiter = self._user_limiters.get(touser)
+        if limiter is None:
+            limiter = self._user_limiters[touser] = RateLimiter(self.user_per_minute)
+        self._user_limiters.move_to_end(touser)
+        while len(self._user_limiters) > 1:
+            oldest = next(iter(self._user_limiters.values()))
+            if oldest.delay(oldest.capacity) > 0:
+                break
+            self._user_limiters.popitem(last= False)
+        return limiter
+
+    async def send(self, payload: dict) -> bool:
+        """发送一条应用消息
+
+        Args:
+            payload (dict): 消息 body, 见 text_msg_payload
+
+        Returns:
+            bool: True 发送成功
+        """
+        touser = payload['touser']
+        await self._user_limiter(touser).acquire()
+        await self._app_limiter.acquire()
+        token_manager = AccessTokenManager.get_instance()
+        async with self._semaphore:
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    # 指数退避 + 抖动
+                    await asyncio.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+                try:
+                    token = await token_manager.get()
+                except Exception as e:
+                    # token 接口出错(网络、超时、返回错误)时同样退避重试
+                    log.warning(f"Get access token failed: {e!r}, {attempt=}")
+                    continue
+                try:
+                    ss = await self.open_session()
+                    async with ss.post(CFG.C['WeCom']['URL']['SEND_MSG'] % token, json= payload, ssl= False) as res:
+                        if res.status >= 500:
+                            log.warning(f"Send msg to {touser} failed, status: {res.status}, {attempt=}")
+                            continue
+                        res_json: dict = await res.json(content_type= None)
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                    # ValueError: 网关等返回的 body 不是 json
+                    log.warning(f"Send msg to {touser} failed: {e!r}, {attempt=}")
+                    continue
+                errcode = res_json.get('errcode')
+                if errcode == 0:
+                    log.debug(f"Sent msg to {touser}")
+                    return True
+                if errcode in TOKEN_ERRCODES:
+                    token_manager.invalidate(token)
+                elif errcode not in RETRY_ERRCODES:
+                    log.error(f"Send msg to {touser} failed: {res_json}")
+                    return False
+                log.warning(f"Send msg to {touser} failed: {res_json}, {attempt=}")
+        log.error(f"Send msg to {touser} failed after {self.retries} retries")
+        return False
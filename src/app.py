@@ -7,20 +7,28 @@ import time
 import logging
 import logging.config
 import sys
+from collections import deque
 # import pathlib
 # print(sys.path)
 
+import aiohttp
+
 from settings import conf
 from library.arguments import get_args
 from AIGC import get_chat_bot, Chatbot
-from iMessage.imsg import Imsg, Message, send_imsg
+from AIGC.scheduler import Priority
+from iMessage.imsg import ChatDBWatcher, Imsg, Message, send_imsg
+from iMessage.dispatcher import ImsgDispatcher
 from iMessage.utils import in_whitelist, build_anwser, run_command
 from server.server import run_server
 from library.utils import CFG
 from library.db import DB
-from library.baidu_api import wav_file_to_text
+from library.baidu_api import AsyncBaiDuASR, BaiDuASRError, wav_file_to_text, async_pcm_to_text
+from library.transcode import TranscodeError
 # from library.WeCom.WXBizMsgCrypt3 import WXBizMsgCrypt as WeComCrypt
-from WeCom.Message import send_text_to_app, download_temp_media, amr2pcm, download_high_definition_voice_material
+from WeCom.client import WeComClient
+from WeCom.Message import send_text_to_app, async_send_text_to_app, download_temp_media, amr2pcm, download_high_definition_voice_material
+from WeCom.Message import MediaDownloadError, stream_voice_pcm
 import exceptions
 from settings.log import get_log_config
 
@@ -31,8 +39,10 @@ cfg = CFG().C
 
 def sync_imsg(chat: Chatbot, args: argparse.Namespace):
     imsg = Imsg(CFG= CFG)
+    # --imsg_watch: 等待 chat.db 写入后按 rowid 增量读取, 否则每 3 秒轮询一次
+    watcher = ChatDBWatcher(imsg.db_fp) if args.imsg_watch else None
     while True:
-        msgs = imsg.get_latest_msgs()
+        msgs = imsg.get_new_msgs() if watcher else imsg.get_latest_msgs()
         for msg in msgs:
             msg_obj = Message(msg)
             # 过滤安全名单
@@ -56,7 +66,8 @@ def sync_imsg(chat: Chatbot, args: argparse.Namespace):
                     log.exception(e)
                 # log.debug(f"{content=}")
             elif msg_obj.msg[:3] == conf.CMD_FILTER:
-                anwser = run_command(msg_obj.msg[3:], chat, msg_obj)
+                with chat.conversation.sync_lock(msg_obj.sender_address):
+                    anwser = run_command(msg_obj.msg[3:], chat, msg_obj)
             else:
                 continue
             # content = f"{question}\n---------------------------------\nA: {anwser}"
@@ -69,14 +80,76 @@ def sync_imsg(chat: Chatbot, args: argparse.Namespace):
                 send_imsg(msg_obj.guid, str(e), sender_address = msg_obj.sender_address, group_name = msg_obj.group_name)
                 log.exception(e)
                 
-        time.sleep(3)
+        if watcher:
+            watcher.wait(timeout= conf.IMSG_WATCH_TIMEOUT)
+        else:
+            time.sleep(3)
+
+async def anwser_imsg(chat: Chatbot, args: argparse.Namespace, msg_obj: Message) -> str:
+    """
+    Answer one iMessage, returns the formated anwser, empty if nothing to send
+    """
+    if msg_obj.msg[:3] == conf.MSG_FILTER:
+        try:
+            _, anwser = await chat.aask(
+                prompt= msg_obj.msg[3:],
+                convo_id= imsg_convo_id(args, msg_obj),
+                priority= Priority.IMSG,
+            )
+        except Exception as e:
+            anwser = str(e)
+            log.exception(e)
+    else:
+        # 命令会修改发送者的会话(开关历史、重置), 与问答一样持有会话锁
+        async with chat.conversation.lock(msg_obj.sender_address):
+            anwser = run_command(msg_obj.msg[3:], chat, msg_obj)
+    if not anwser:
+        return ""
+    return build_anwser(msg_obj, anwser)
+
+
+def imsg_convo_id(args: argparse.Namespace, msg_obj: Message) -> str:
+    return msg_obj.sender_address if args.multi_people else "default"
+
+
+async def async_imsg(chat: Chatbot, args: argparse.Namespace):
+    """
+    Answer iMessages concurrently, at most args.concurrency at a time.
+    Msgs of the same conversation are answered and sent in the order they were received
+    """
+    imsg = Imsg(CFG= CFG)
+    watcher = ChatDBWatcher(imsg.db_fp) if args.imsg_watch else None
+    dispatcher = ImsgDispatcher(
+        answer= lambda msg_obj: anwser_imsg(chat, args, msg_obj),
+        concurrency= args.concurrency,
+        key= lambda msg_obj: imsg_convo_id(args, msg_obj),
+    )
+    try:
+        while True:
+            msgs = imsg.get_new_msgs() if watcher else imsg.get_latest_msgs()
+            for msg in msgs:
+                msg_obj = Message(msg)
+                # 过滤安全名单
+                if not in_whitelist(msg_obj, cfg):
+                    continue
+                # 过滤msg格式
+                if msg_obj.msg[:3] in (conf.MSG_FILTER, conf.CMD_FILTER):
+                    dispatcher.submit(msg_obj)
+            if watcher:
+                await asyncio.to_thread(watcher.wait, timeout= conf.IMSG_WATCH_TIMEOUT)
+            else:
+                await asyncio.sleep(3)
+    finally:
+        await dispatcher.close()
+        await chat.close_session()
+
 
 def anwser(chat: Chatbot, args: argparse.Namespace):
     # xml_parse = XMLParse()
     db = DB()
     while True:
-        time.sleep(3)
-        data = db.fetch()
+        time.sleep(db.poll_interval)
+        data = db.claim(limit= 10)
         if not data:
             continue
 
@@ -133,6 +206,115 @@ def anwser(chat: Chatbot, args: argparse.Namespace):
 
 
 
+async def aanwser_msg(chat: Chatbot, db: DB, recvd_cont_dict: dict, progressive: bool = False):
+    """
+    Answer one queued WeCom msg, blocking steps are run in threads.
+    If progressive, the answer is sent in parts while it is being generated
+    """
+    log.info(f"Dealing with msg: {recvd_cont_dict=}, Content: {recvd_cont_dict.get('Content', recvd_cont_dict.get('MediaId'))}")
+    if recvd_cont_dict['MsgType'] == 'text':
+        content = recvd_cont_dict['Content']
+    elif recvd_cont_dict['MsgType'] == 'voice':
+        media_id = recvd_cont_dict['MediaId']
+        try:
+            # 下载、转码、识别同时进行
+            content = await async_pcm_to_text(stream_voice_pcm(media_id, fn=recvd_cont_dict['MsgId']))
+        except (MediaDownloadError, TranscodeError, BaiDuASRError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log.error(f"Error while converting voice msg with media_id {media_id}: {e!r}")
+            await db.adelete({'msgid': recvd_cont_dict['MsgId']})
+            return
+        if not content:
+            log.debug(f"Empty content")
+            await db.adelete({'msgid': recvd_cont_dict['MsgId']})
+            return
+        await async_send_text_to_app(content= f"识别到您的问题：{content}", recvd_cont_dict= recvd_cont_dict)
+        log.debug(f"Content converted from voice data: {content}")
+    else:
+        log.error(f"Not supported MsgType {recvd_cont_dict['MsgType']}")
+        await db.adelete({'msgid': recvd_cont_dict['MsgId']})
+        return
+    user_name = recvd_cont_dict['FromUserName']
+    sent = False
+    try:
+        if progressive:
+            rply_cont = await WeComClient.get_instance().send_stream(
+                chat.async_ask_stream(content, convo_id=user_name, priority=Priority.WECOM), recvd_cont_dict
+            )
+            sent = True
+        else:
+            _, rply_cont = await chat.aask(content, convo_id=user_name, msg_id=recvd_cont_dict['MsgId'], priority=Priority.WECOM)
+    except Exception as e:
+        rply_cont = str(e)
+        log.exception(e)
+    log.info(f"Send to user {user_name}: {rply_cont}")
+    try:
+        if not sent:
+            await async_send_text_to_app(content= rply_cont, recvd_cont_dict= recvd_cont_dict)
+    finally:
+        # the answer is produced, a failed send does not ask OpenAI again after the lease times out
+        await db.adelete({'msgid': recvd_cont_dict['MsgId']})
+        log.info(f"Deleted msg {recvd_cont_dict['MsgId']}")
+
+
+async def aanwser(chat: Chatbot, args: argparse.Namespace):
+    """
+    Answer queued WeCom msgs concurrently, msgs of at most args.concurrency users at a time.
+    Each user has one worker answering its msgs in the order they were received, so a burst
+    from one user takes a single slot; msgs of users being answered stay in the queue
+    """
+    db = DB()
+    # users being answered -> their claimed msgs, a user is dropped when its worker finishes
+    user_msgs: dict[str, deque[dict]] = {}
+    claimed: set[str] = set()
+    tasks: set[asyncio.Task] = set()
+
+    async def deal(user_name: str):
+        msgs = user_msgs[user_name]
+        try:
+            while msgs:
+                recvd_cont_dict = msgs[0]
+                try:
+                    await aanwser_msg(chat, db, recvd_cont_dict, args.progressive)
+                except Exception as e:
+                    log.exception(e)
+                finally:
+                    msgs.popleft()
+                    claimed.discard(recvd_cont_dict['MsgId'])
+        finally:
+            del user_msgs[user_name]
+
+    try:
+        while True:
+            free = args.concurrency - len(user_msgs)
+            if free <= 0:
+                await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                continue
+            rows = await db.aclaim(limit= free, exclude_users= list(user_msgs))
+            for row_ in rows:
+                recvd_cont_dict = json.loads(row_[3])
+                # lease expired while still waiting or being answered
+                if recvd_cont_dict['MsgId'] in claimed:
+                    continue
+                claimed.add(recvd_cont_dict['MsgId'])
+                user_name = recvd_cont_dict['FromUserName']
+                if user_name in user_msgs:
+                    user_msgs[user_name].append(recvd_cont_dict)
+                    continue
+                user_msgs[user_name] = deque([recvd_cont_dict])
+                task = asyncio.create_task(deal(user_name))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if len(rows) < free:
+                # nothing left but msgs of users being answered, sleep until the server
+                # inserts a new msg or a worker finishes
+                waiter = asyncio.create_task(db.wait())
+                await asyncio.wait({waiter, *tasks}, return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+    finally:
+        await WeComClient.get_instance().close_session()
+        await AsyncBaiDuASR.get_instance().close_session()
+
+
 async def main():
     log.info(f"Running chatGPT Server, version: {conf.VERSION}")
     args = get_args(sys.argv[1:])
@@ -145,10 +327,16 @@ async def main():
     )
     # chat.load_test()
     if args.execute == 'imsg':
-        sync_imsg(chat= chat, args = args)
+        if args.concurrency > 0:
+            await async_imsg(chat= chat, args = args)
+        else:
+            sync_imsg(chat= chat, args = args)
     elif args.execute == 'srv_callback':
         log.info(f"Running as server callback")
-        anwser(chat, args)
+        if args.concurrency > 0:
+            await aanwser(chat, args)
+        else:
+            anwser(chat, args)
     elif args.execute == 'server':
         log.info(f"Running FastAPI server as WEB server")
         await run_server(port = args.port)
@@ -1,11 +1,37 @@
-
 from typing import Any
 
 
-class ProxyError(Exception):
+class UpstreamError(Exception):
+    """
+    OpenAI request failed after retries
+    """
+
+
+class UpstreamTimeout(UpstreamError):
     pass
 
 
-class ModelOverloaded(Exception):
+class DeadlineExceeded(UpstreamTimeout):
+    """
+    The deadline of the incoming request passed
+    """
+
+
+class ProxyError(UpstreamError):
+    pass
+
+
+class UpstreamStatusError(UpstreamError):
+    """
+    OpenAI answered with an error status, the message keeps the status and the response body
+    """
+
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+class ModelOverloaded(UpstreamStatusError):
     def __init__(self, reason: Any) -> None:
-        self.reason = reason
\ No newline at end of file
+        super().__init__(409, str(reason))
+        self.reason = reason
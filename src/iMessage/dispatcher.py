@@ -0,0 +1,96 @@
+# -*- coding: UTF-8 -*-
+import asyncio
+import collections
+import logging
+import typing
+
+from settings import conf
+from iMessage.imsg import Message, send_imsgs
+
+log = logging.getLogger('app.imsg.dispatcher')
+
+# [(msg, 回复内容)]
+Batch = typing.List[typing.Tuple[Message, str]]
+
+
+class ImsgDispatcher:
+    """
+    并发回答 iMessage
+        - key 相同的 msg 属于同一个会话, 按提交顺序逐条回答; 不同会话并发回答, 最多 concurrency 个
+        - 回复放入发送队列, 发送任务每次取出队列中已有的回复(最多 batch_size 条), 交给 sender 一次发送
+        - sender 是同步函数, 在线程中运行, 默认为 send_imsgs, 测试时可以替换
+    """
+
+    def __init__(
+            self,
+            answer: typing.Callable[[Message], typing.Awaitable[str]],
+            sender: typing.Callable[[Batch], None] = send_imsgs,
+            concurrency: int = 4,
+            key: typing.Callable[[Message], str] = lambda msg: msg.guid,
+            batch_size: int = conf.IMSG_SEND_BATCH,
+        ) -> None:
+        self.answer = answer
+        self.sender = sender
+        self.key = key
+        self.batch_size = batch_size
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._queues: typing.Dict[str, typing.Deque[Message]] = collections.defaultdict(collections.deque)
+        self._workers: typing.Dict[str, asyncio.Task] = {}
+        self._outbox: asyncio.Queue = asyncio.Queue()
+        self._sender_task: typing.Optional[asyncio.Task] = None
+
+    def submit(self, msg: Message) -> None:
+        """
+        提交一条待回答的 msg, 不等待回答
+        """
+        key = self.key(msg)
+        self._queues[key].append(msg)
+        if key not in self._workers:
+            self._workers[key] = asyncio.create_task(self._work(key))
+        if self._sender_task is None or self._sender_task.done():
+            self._sender_task = asyncio.create_task(self._send())
+
+    async def join(self) -> None:
+        """
+        等待已提交的 msg 全部回答并发送
+        """
+        while self._workers:
+            await asyncio.gather(*self._workers.values())
+        await self._outbox.join()
+
+    async def close(self) -> None:
+        await self.join()
+        if self._sender_task is not None:
+            self._sender_task.cancel()
+            await asyncio.gather(self._sender_task, return_exceptions=True)
+
+    async def _work(self, key: str) -> None:
+        queue = self._queues[key]
+        try:
+            while queue:
+                msg = queue.popleft()
+                async with self._semaphore:
+                    try:
+                        anwser = await self.answer(msg)
+                    except Exception as e:
+                        log.exception(e)
+                        anwser = str(e)
+                if anwser:
+                    self._outbox.put_nowait((msg, anwser))
+        finally:
+            # 队列为空和删除之间没有 await, 不会漏掉新提交的 msg
+            del self._workers[key]
+            del self._queues[key]
+
+    async def _send(self) -> None:
+        while True:
+            batch = [await self._outbox.get()]
+            while len(batch) < self.batch_size and not self._outbox.empty():
+                batch.append(self._outbox.get_nowait())
+            try:
+                await asyncio.to_thread(self.sender, batch)
+            except Exception as e:
+                log.exception(e)
+            finally:
+                for _ in batch:
+                    self._outbox.task_done()
@@ -1,6 +1,9 @@
 # -*- coding: UTF-8 -*-
+import os
+import select
 import sqlite3
 import pathlib
+import time
 import typing
 import logging
 # import sys
@@ -15,16 +18,19 @@ log = logging.getLogger('app.imsg')
 
 class Imsg:
     def __init__(self, **kwargs) -> None:
-        self.db = sqlite3.connect(pathlib.Path(conf.IMSG_DB_FP).expanduser().as_posix())
+        self.db_fp = pathlib.Path(kwargs.get('db_fp') or conf.IMSG_DB_FP).expanduser()
+        self.db = sqlite3.connect(self.db_fp.as_posix())
         self.cur = self.db.cursor()
         self.cur_time = 0
         self.set_cur_time()
+        self.rowid = 0
+        self.set_rowid()
 
     def get_latest_msgs(self) -> typing.List:
         """
         获取未读msgs
         """
-        self.cur.execute(conf.GET_LATEST_MSGS.format(date=self.cur_time))
+        self.cur.execute(conf.GET_LATEST_MSGS, (self.cur_time, ))
         # self.cur.execute(conf.GET_LATEST_MSGS.format(date='700560160686447872'))
         msgs = self.cur.fetchall()
         if len(msgs):
@@ -32,6 +38,29 @@ class Imsg:
             self.set_cur_time((msgs[-1][2], ))
         return msgs
 
+    def get_new_msgs(self) -> typing.List:
+        """
+        获取 rowid 大于上次读取位置的 msgs, 只扫描新增的行
+        """
+        self.cur.execute(conf.GET_MSGS_AFTER_ROWID, (self.rowid, ))
+        rows = self.cur.fetchall()
+        if not rows:
+            return []
+        self.rowid = rows[-1][-1]
+        msgs = [row[:-1] for row in rows]
+        log.debug(f"Fetched {len(msgs)} msgs, rowid -> {self.rowid}, {msgs=}")
+        return msgs
+
+    def set_rowid(self, rowid: typing.Optional[int] = None) -> None:
+        """
+        初始化读取位置, 默认从当前最新的 msg 之后开始
+        """
+        if rowid is None:
+            self.cur.execute(conf.GET_LATEST_ROWID)
+            rowid = self.cur.fetchone()[0]
+        self.rowid = rowid
+        log.info(f"set rowid to {self.rowid}")
+
     def set_cur_time(self, msg = []) -> None:
         """
         初始化cur_time
@@ -48,6 +77,107 @@ class Imsg:
             log.info(f"set cur_time to {self.cur_time}")
             
             
+class ChatDBWatcher:
+    """
+    等待 chat.db 或其 WAL 文件被写入
+    macOS 上使用 kqueue 文件事件, 其他平台每 interval 秒比较一次文件 stat
+    检测到写入后, 文件 settle 秒内没有新的写入才返回
+    """
+
+    def __init__(
+            self,
+            db_fp: typing.Union[str, pathlib.Path],
+            interval: float = conf.IMSG_WATCH_INTERVAL,
+            settle: float = conf.IMSG_WATCH_SETTLE,
+        ) -> None:
+        self.db_fp = pathlib.Path(db_fp).expanduser()
+        self.interval = interval
+        self.settle = settle
+        self.fps = [self.db_fp, self.db_fp.with_name(f"{self.db_fp.name}-wal")]
+        self._kq = select.kqueue() if hasattr(select, 'kqueue') else None
+        self._fds: typing.List[int] = []
+        self._wal_ino = None
+        self._stat = self._stat_signature()
+        if self._kq is not None:
+            self._watch()
+
+    def _stat_signature(self) -> typing.Tuple:
+        signature = []
+        for fp in self.fps:
+            try:
+                st = fp.stat()
+                signature.append((st.st_ino, st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                signature.append(None)
+        return tuple(signature)
+
+    def _watch(self) -> None:
+        """
+        注册 kqueue 事件, 目录事件用于发现 WAL 文件的创建和删除
+        """
+        self._unwatch()
+        self._wal_ino = self._stat[1] and self._stat[1][0]
+        events = []
+        for fp in (self.db_fp.parent, *self.fps):
+            try:
+                fd = os.open(fp, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            self._fds.append(fd)
+            events.append(select.kevent(
+                fd,
+                filter= select.KQ_FILTER_VNODE,
+                flags= select.KQ_EV_ADD | select.KQ_EV_CLEAR,
+                fflags= select.KQ_NOTE_WRITE | select.KQ_NOTE_EXTEND | select.KQ_NOTE_DELETE | select.KQ_NOTE_RENAME,
+            ))
+        self._kq.control(events, 0, 0)
+
+    def _unwatch(self) -> None:
+        for fd in self._fds:
+            os.close(fd)
+        self._fds = []
+
+    def wait(self, timeout: typing.Optional[float] = None) -> bool:
+        """等待文件变化
+
+        Args:
+            timeout (float, optional): 最长等待秒数, None 为一直等待
+
+        Returns:
+            bool: True 文件有变化, False 超时
+        """
+        if self._kq is not None:
+            events = self._kq.control(None, 8, timeout)
+            # 写入 WAL 的事务要稍后才对读取可见, 等写入停止后再返回
+            while events and (more := self._kq.control(None, 8, self.settle)):
+                events += more
+            self._stat = self._stat_signature()
+            if any(e.fflags & (select.KQ_NOTE_DELETE | select.KQ_NOTE_RENAME) for e in events) \
+                    or (self._stat[1] and self._stat[1][0]) != self._wal_ino:
+                # WAL 文件被创建、删除或替换, 重新注册
+                self._watch()
+            return bool(events)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            signature = self._stat_signature()
+            if signature != self._stat:
+                self._stat = signature
+                while True:
+                    time.sleep(self.settle)
+                    signature = self._stat_signature()
+                    if signature == self._stat:
+                        return True
+                    self._stat = signature
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(self.interval if deadline is None else min(self.interval, max(0, deadline - time.monotonic())))
+
+    def close(self) -> None:
+        self._unwatch()
+        if self._kq is not None:
+            self._kq.close()
+
+
 class Message:
     def __init__(self, msg: typing.Tuple):
         self.msg: typing.Text 
@@ -62,14 +192,22 @@ class Message:
         return f"{self.group_name}|{self.chat_id}|{self.sender_address}|{self.msg}"
 
 
+def escape_imsg(msg: typing.Text) -> typing.Text:
+    return msg.replace("\\", "\\\\").replace('"', '\\"')
+
+
 def send_imsg(guid: typing.Text, msg: typing.Text, **kwargs):
     if not msg:
         return
     log.debug(f"Send msg to {guid} {kwargs.get('group_name')} {kwargs.get('sender_address')}")
-    command = conf.SEND_IMSG.format(guid=guid, msg=msg.replace("\\", "\\\\").replace('"', '\\"'))
+    command = conf.SEND_IMSG.format(guid=guid, msg=escape_imsg(msg))
     log.debug(f"{command=}")
     r = applescript.run(command)
     log.debug(f"Send msg exit code - {r.code}")
+    if r.code == applescript.UNKNOWN:
+        # 可能已经发送, 不再重发或发送错误信息
+        log.error(f"Unknown whether msg to {guid} was sent: {r.err}")
+        return
     if r.out:
         log.debug(f"Out: {r.out}")
     if r.err:
@@ -79,6 +217,37 @@ def send_imsg(guid: typing.Text, msg: typing.Text, **kwargs):
     
 
 
+def send_imsgs(batch: typing.List[typing.Tuple[Message, typing.Text]]):
+    """
+    一次 osascript 按顺序发送多条回复
+    发送失败的回复逐条重发, 仍然失败则把错误信息发给对方
+    脚本超时等不知道是否已经发送的情况不重发, 避免对方收到重复的回复
+    """
+    batch = [(msg_obj, msg) for msg_obj, msg in batch if msg]
+    if len(batch) > 1:
+        command = conf.SEND_IMSG_BATCH.format(sends=''.join(
+            conf.SEND_IMSG_LINE.format(index=i, guid=msg_obj.guid, msg=escape_imsg(msg)) for i, (msg_obj, msg) in enumerate(batch)
+        ))
+        r = applescript.run(command)
+        log.debug(f"Send {len(batch)} msgs exit code - {r.code}")
+        if r.code == 0:
+            failed = {int(line.split(':')[0]) for line in r.out.splitlines() if line.split(':')[0].isdigit()}
+            if failed:
+                log.error(f"Error while sending msgs {sorted(failed)} in one script: {r.out}")
+            batch = [item for i, item in enumerate(batch) if i in failed]
+        elif r.code == applescript.UNKNOWN:
+            log.error(f"Unknown whether {len(batch)} msgs were sent, not resending: {r.err}")
+            batch = []
+        else:
+            log.error(f"Error while sending {len(batch)} msgs in one script, retry one by one: {r.code}: {r.err}")
+    for msg_obj, msg in batch:
+        try:
+            send_imsg(msg_obj.guid, msg, sender_address = msg_obj.sender_address, group_name = msg_obj.group_name)
+        except Exception as e:
+            log.exception(e)
+            send_imsg(msg_obj.guid, str(e), sender_address = msg_obj.sender_address, group_name = msg_obj.group_name)
+
+
 # imsg = Imsg()
 # t = imsg.set_cur_time()
 # print(t)
@@ -85,6 +85,7 @@ def get_sender_name(imsg_addr: Text) -> Text:
 
 def run_command(cmd: Text, chat: Chatbot, msg: Message) -> Text:
     """Run command if received 'C: *'
+    会修改 msg.sender_address 的会话, 调用方持有该会话的锁(conversation.lock/sync_lock)
 
     Args:
         cmd (Text): command
@@ -123,6 +124,20 @@ def run_command(cmd: Text, chat: Chatbot, msg: Message) -> Text:
             else:
                 result = f"您已使用token {chat.token_usage(msg.sender_address)}"
             return result
+        case ['cache']:
+            result = []
+            if chat.cache is not None:
+                result += ["回答缓存:", *(f"{k}: {v}" for k, v in chat.cache.stats().items())]
+            if chat.inflight is not None:
+                result += ["合并的请求:", *(f"{k}: {v}" for k, v in chat.inflight.stats().items())]
+            return '\n'.join(result) or "回答缓存未开启"
+        case ['queue']:
+            stats = '\n'.join(f"{k}: {v}" for k, v in chat.scheduler.stats().items())
+            endpoints = '\n'.join(
+                f"{name}: {ep['state']}, 延迟 {ep['latency']}s, 错误率 {ep['error_rate']}"
+                for name, ep in chat.endpoints.stats().items()
+            )
+            return f"以下是请求队列统计信息\n{stats}\n{endpoints}"
         case ['add_user', *users]:
             if not users:
                 return "请提供要添加的users"
@@ -0,0 +1,180 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   crypto.py
+@Desc    :   企业微信回调消息的签名校验与加解密, key/iv 只在创建时解码一次
+'''
+
+# here put the import lib
+import hashlib
+import hmac
+import os
+import struct
+import time
+from base64 import b64decode, b64encode
+from typing import Optional
+
+from Crypto.Cipher import AES
+
+# 加密后回复企业微信的消息模版
+AES_TEXT_RESPONSE_TEMPLATE = """<xml>
+<Encrypt><![CDATA[%(msg_encrypt)s]]></Encrypt>
+<MsgSignature><![CDATA[%(msg_signature)s]]></MsgSignature>
+<TimeStamp>%(timestamp)s</TimeStamp>
+<Nonce><![CDATA[%(nonce)s]]></Nonce>
+</xml>"""
+
+# 企业微信使用 32 字节对齐的 PKCS#7 补位
+BLOCK_SIZE = 32
+
+
+def format_b64text(b64text: str) -> str:
+    len_remain = 4 - (len(b64text) % 4)
+    if len_remain == 4:
+        return b64text
+    else:
+        return f"{b64text}{'='*len_remain}"
+
+
+class WeComCryptoError(Exception):
+    pass
+
+
+class WeComCrypto:
+    """
+    企业微信消息加解密
+    https://developer.work.weixin.qq.com/document/path/90968
+
+    AES-256-CBC 的 cipher 对象带有 CBC 状态, 不能跨消息复用,
+    所以这里缓存解码后的 key/iv, 每条消息只新建一次 cipher
+    """
+    _instance = None
+
+    def __init__(self, token: str, encoding_aes_key: str, receiveid: str = '') -> None:
+        self.token = token
+        self.key = b64decode(format_b64text(encoding_aes_key))
+        if len(self.key) != 32:
+            raise WeComCryptoError(f"Invalid EncodingAESKey, decoded length {len(self.key)} != 32")
+        self.iv = self.key[:16]
+        self.receiveid = receiveid
+
+    @classmethod
+    def get_instance(cls) -> 'WeComCrypto':
+        """
+        由配置文件创建, 全局共用一个实例
+        """
+        if cls._instance is None:
+            from library.utils import CFG
+            cls._instance = cls(
+                CFG.C['WeCom']['Token'],
+                CFG.C['WeCom']['EncodingAESKey'],
+                CFG.C['WeCom']['CorpID'] or '',
+            )
+        return cls._instance
+
+    def signature(self, timestamp: str, nonce: str, data: str) -> str:
+        """
+        sha1(sort(token, timestamp, nonce, data))
+        """
+        return hashlib.sha1(''.join(sorted((self.token, timestamp, nonce, data))).encode()).hexdigest()
+
+    def verify(self, signature: str, timestamp: str, nonce: str, data: str) -> bool:
+        """Check if msg is valid
+
+        Args:
+            signature (str): msg_signature
+
+        Returns:
+            bool: True valid, False invalid
+        """
+        return hmac.compare_digest(signature, self.signature(timestamp, nonce, data))
+
+    def decrypt(self, encrypted_text_b64: str) -> dict:
+        """msg decrypt
+
+        Args:
+            encrypted_text_b64 (str): msg encrypted w/ aes key and then b64encoded
+
+        Returns:
+            dict: {random, length, message, receiveid}, message 是 bytes
+        """
+        msg_bytes = AES.new(self.key, AES.MODE_CBC, self.iv).decrypt(b64decode(encrypted_text_b64))
+        # 去掉补位字符
+        pad = msg_bytes[-1]
+        if 1 <= pad <= BLOCK_SIZE:
+            msg_bytes = msg_bytes[:-pad]
+        msg_len = struct.unpack(">I", msg_bytes[16:20])[0]
+        return dict(
+            random = msg_bytes[:16].decode(),
+            length = msg_len,
+            message = msg_bytes[20: 20+msg_len],
+            receiveid = msg_bytes[20+msg_len:].decode(),
+        )
+
+    def encrypt(self, text: str, receiveid: str = '') -> str:
+        """msg encrypt
+
+        Args:
+            text (str): 明文
+            receiveid (str, optional): 默认为 CorpID
+
+        Returns:
+            str: b64encoded AES-256-CBC encrypted msg
+        """
+        text_bytes = text.encode()
+        msg_bytes = b''.join((
+            os.urandom(8).hex().encode(),
+            struct.pack(">I", len(text_bytes)),
+            text_bytes,
+            (receiveid or self.receiveid).encode(),
+        ))
+        pad = BLOCK_SIZE - len(msg_bytes) % BLOCK_SIZE
+        msg_bytes += bytes((pad, )) * pad
+        return b64encode(AES.new(self.key, AES.MODE_CBC, self.iv).encrypt(msg_bytes)).decode()
+
+    def encrypt_reply(self, reply_xml: str, nonce: str, timestamp: Optional[str] = None, receiveid: str = '') -> str:
+        """加密并签名被动回复的消息
+
+        Args:
+            reply_xml (str): 待回复的 xml 明文
+            nonce (str): 随机串, 可以使用回调 url 中的 nonce
+            timestamp (str, optional): 默认为当前时间
+
+        Returns:
+            str: 可以直接回复企业微信的 xml
+        """
+        timestamp = timestamp or str(int(time.time()))
+        encrypt = self.encrypt(reply_xml, receiveid)
+        return AES_TEXT_RESPONSE_TEMPLATE % dict(
+            msg_encrypt = encrypt,
+            msg_signature = self.signature(timestamp, nonce, encrypt),
+            timestamp = timestamp,
+            nonce = nonce,
+        )
+
+
+def main():
+    """
+    micro-benchmark, 单条消息的签名校验 + 解密, 以及加密回复的耗时
+    """
+    import timeit
+
+    crypto = WeComCrypto('token', b64encode(os.urandom(32)).decode().rstrip('='), 'corpid')
+    xml = "<xml><ToUserName><![CDATA[toUser]]></ToUserName><Content><![CDATA[%s]]></Content></xml>"
+    for size in (16, 1024, 16384):
+        encrypt = crypto.encrypt(xml % ('x' * size))
+        signature = crypto.signature('1409659813', 'nonce', encrypt)
+
+        def recv():
+            assert crypto.verify(signature, '1409659813', 'nonce', encrypt)
+            crypto.decrypt(encrypt)
+
+        def reply():
+            crypto.encrypt_reply(xml % ('x' * size), 'nonce', '1409659813')
+
+        for name, fn in (('verify+decrypt', recv), ('encrypt_reply', reply)):
+            number, total = timeit.Timer(fn).autorange()
+            print(f"{name:>15} {size:>6} bytes: {total / number * 1e6:8.2f} us/msg")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+import array
+import asyncio
+import collections
+import dataclasses
+import hashlib
+import json
+import logging
+import math
+import operator
+import re
+import time
+import unicodedata
+from typing import AsyncIterator, Awaitable, Callable
+
+log = logging.getLogger('app.answer_cache')
+
+# 问题末尾的标点和空白不影响回答
+TRAILING_RE = re.compile(r'[\s?？!！.。~～,，;；]+$')
+SPACE_RE = re.compile(r'\s+')
+# 每条缓存除问题和回答之外的大致内存开销
+ENTRY_OVERHEAD = 256
+
+Embed = Callable[[str], Awaitable[list[float]]]
+
+
+def normalize(prompt: str) -> str:
+    """
+    全角转半角、忽略大小写、合并空白、去掉末尾标点
+    """
+    prompt = unicodedata.normalize('NFKC', prompt).casefold()
+    prompt = SPACE_RE.sub(' ', prompt).strip()
+    return TRAILING_RE.sub('', prompt)
+
+
+def unit(vector: list[float]) -> array.array:
+    norm = math.sqrt(sum(map(operator.mul, vector, vector))) or 1.0
+    return array.array('f', [x / norm for x in vector])
+
+
+def nearest(vector: array.array, keys: list[str], matrix: array.array) -> tuple[str | None, float]:
+    """
+    matrix 中与 vector 余弦相似度最高的一行, 在线程池中执行
+    """
+    dim = len(vector)
+    best, best_score = None, -1.0
+    for row, key in enumerate(keys):
+        score = sum(map(operator.mul, vector, matrix[row * dim: (row + 1) * dim]))
+        if score > best_score:
+            best, best_score = key, score
+    return best, best_score
+
+
+class ScopeVectors:
+    """
+    一个 scope 中问题的单位向量, 按行连续保存在一个 array('f') 中, 每个数 4 字节;
+    删除时用最后一行填补, 行号不连续的空洞不会累积
+    """
+
+    def __init__(self, dim: int) -> None:
+        self.dim = dim
+        self.matrix = array.array('f')
+        self.keys: list[str] = []
+        # key -> 行号, 按写入顺序排列
+        self.rows: collections.OrderedDict[str, int] = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.rows
+
+    def add(self, key: str, vector: array.array) -> None:
+        self.rows[key] = len(self.keys)
+        self.keys.append(key)
+        self.matrix.extend(vector)
+
+    def remove(self, key: str) -> None:
+        row = self.rows.pop(key)
+        last = len(self.keys) - 1
+        if row != last:
+            moved = self.keys[last]
+            self.matrix[row * self.dim: (row + 1) * self.dim] = self.matrix[last * self.dim:]
+            self.keys[row] = moved
+            self.rows[moved] = row
+        self.keys.pop()
+        del self.matrix[last * self.dim:]
+
+    def oldest(self) -> str:
+        return next(iter(self.rows))
+
+    def snapshot(self) -> tuple[list[str], array.array]:
+        """
+        在其他线程中查找时使用的副本, 查找期间写入和淘汰不受影响
+        """
+        return list(self.keys), self.matrix[:]
+
+
+@dataclasses.dataclass
+class Entry:
+    scope: str
+    answer: str
+    expires: float
+    size: int
+
+
+@dataclasses.dataclass
+class Lookup:
+    """
+    一次查询的结果, 未命中时用于 store 写入回答, 避免重复计算 key 和 embedding
+    """
+    key: str
+    scope: str
+    size: int
+    answer: str | None = None
+    vector: array.array | None = None
+    # 'exact', 'semantic' 或 None
+    hit: str | None = None
+
+
+class AnswerCache:
+    """
+    不使用历史的单轮问答的回答缓存
+        - key 为规范化后的问题加 scope(system prompt、模型和采样参数), scope 不同的回答互不影响
+        - 超过 ttl 秒的回答失效; 总大小超过 max_bytes 时淘汰最久未命中的回答
+        - 设置 embed 时, 精确匹配未命中再按 embedding 余弦相似度查找同一 scope 中最相似的问题,
+          相似度不低于 similarity 视为命中. 向量按 scope 保存在连续的 array('f') 中, 在线程池中逐条计算相似度,
+          每个 scope 最多保存 max_vectors 个向量, 超出时淘汰最早写入的回答
+        - stats() 返回命中率等统计
+    """
+
+    def __init__(
+            self,
+            max_bytes: int = 64 * 1024 * 1024,
+            ttl: float = 86400,
+            embed: Embed | None = None,
+            similarity: float = 0.95,
+            replay_chunk: int = 16,
+            max_vectors: int = 2000,
+        ) -> None:
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.embed = embed
+        self.similarity = similarity
+        self.replay_chunk = replay_chunk
+        self.max_vectors = max_vectors
+        self.bytes = 0
+        self._entries: collections.OrderedDict[str, Entry] = collections.OrderedDict()
+        # 只在同一 scope 中查找相似问题
+        self._vectors: dict[str, ScopeVectors] = {}
+        self.counter = collections.Counter()
+
+    @classmethod
+    def from_config(cls, embed: Embed | None = None) -> 'AnswerCache | None':
+        """
+        ChatGPT.CACHE.ENABLE 为 false 时返回 None; SEMANTIC 为 false 时不使用 embed
+        """
+        from library.utils import CFG
+        cache_cfg: dict = CFG.C['ChatGPT'].get('CACHE') or {}
+        if not cache_cfg.get('ENABLE', True):
+            return None
+        return cls(
+            max_bytes= cache_cfg.get('MAX_BYTES', 64 * 1024 * 1024),
+            ttl= cache_cfg.get('TTL', 86400),
+            embed= embed if cache_cfg.get('SEMANTIC', False) else None,
+            similarity= cache_cfg.get('SIMILARITY', 0.95),
+            replay_chunk= cache_cfg.get('REPLAY_CHUNK', 16),
+            max_vectors= cache_cfg.get('MAX_VECTORS', 2000),
+        )
+
+    @staticmethod
+    def make_scope(system_prompt: str, params: dict) -> str:
+        data = json.dumps([system_prompt, params], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    @staticmethod
+    def make_key(prompt: str, scope: str) -> str:
+        return hashlib.sha256(f"{scope}\n{normalize(prompt)}".encode()).hexdigest()
+
+    def _probe(self, prompt: str, scope: str) -> Lookup:
+        lookup = Lookup(self.make_key(prompt, scope), scope, len(normalize(prompt).encode()))
+        if (entry := self._get(lookup.key)) is not None:
+            lookup.answer, lookup.hit = entry.answer, 'exact'
+        return lookup
+
+    def _get(self, key: str) -> Entry | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires < time.monotonic():
+            self._remove(key)
+            self.counter['expired'] += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def lookup(self, prompt: str, scope: str) -> Lookup:
+        """
+        只精确匹配, 用于同步的 Chatbot.ask
+        """
+        return self._count(self._probe(prompt, scope))
+
+    async def alookup(self, prompt: str, scope: str) -> Lookup:
+        lookup = self._probe(prompt, scope)
+        if lookup.hit or self.embed is None:
+            return self._count(lookup)
+        try:
+            lookup.vector = unit(await self.embed(prompt))
+        except Exception as e:
+            # embedding 出错时只使用精确匹配
+            log.warning(f"Embedding failed: {e!r}")
+            self.counter['embed_errors'] += 1
+            return self._count(lookup)
+        key, score = await self._nearest(lookup.vector, scope)
+        if key is not None and score >= self.similarity and (entry := self._get(key)) is not None:
+            log.debug(f"Semantic hit {score=:.4f}")
+            lookup.answer, lookup.hit = entry.answer, 'semantic'
+        return self._count(lookup)
+
+    async def _nearest(self, vector: array.array, scope: str) -> tuple[str | None, float]:
+        vectors = self._vectors.get(scope)
+        if vectors is None or vectors.dim != len(vector):
+            return None, -1.0
+        # 逐条计算相似度不阻塞 event loop
+        return await asyncio.get_running_loop().run_in_executor(None, nearest, vector, *vectors.snapshot())
+
+    def _count(self, lookup: Lookup) -> Lookup:
+        self.counter[f"{lookup.hit}_hits" if lookup.hit else 'misses'] += 1
+        return lookup
+
+    def store(self, lookup: Lookup, answer: str) -> None:
+        """
+        保存未命中的问题的回答
+        """
+        if lookup.hit or not answer:
+            return
+        size = lookup.size + len(answer.encode()) + ENTRY_OVERHEAD
+        vector = lookup.vector
+        if vector is not None and lookup.scope in self._vectors and self._vectors[lookup.scope].dim != len(vector):
+            # embedding 模型换了, 维度不同的向量不能比较
+            vector = None
+        if vector is not None:
+            size += vector.itemsize * len(vector)
+        if size > self.max_bytes:
+            return
+        self._remove(lookup.key)
+        self._entries[lookup.key] = Entry(lookup.scope, answer, time.monotonic() + self.ttl, size)
+        if vector is not None:
+            while (vectors := self._vectors.get(lookup.scope)) is not None and len(vectors) >= max(self.max_vectors, 1):
+                self._remove(vectors.oldest())
+                self.counter['evictions'] += 1
+            self._vectors.setdefault(lookup.scope, ScopeVectors(len(vector))).add(lookup.key, vector)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.counter['evictions'] += 1
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self.bytes -= entry.size
+        vectors = self._vectors.get(entry.scope)
+        if vectors is not None and key in vectors:
+            vectors.remove(key)
+            if not vectors:
+                del self._vectors[entry.scope]
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._vectors.clear()
+        self.bytes = 0
+
+    def chunks(self, answer: str) -> list[str]:
+        """
+        缓存的回答按 replay_chunk 个字符分段, 作为流式回复返回
+        """
+        size = max(self.replay_chunk, 1)
+        return [answer[i: i + size] for i in range(0, len(answer), size)]
+
+    async def replay(self, answer: str) -> AsyncIterator[str]:
+        for chunk in self.chunks(answer):
+            yield chunk
+
+    def stats(self) -> dict:
+        hits = self.counter['exact_hits'] + self.counter['semantic_hits']
+        total = hits + self.counter['misses']
+        return {
+            **self.counter,
+            'entries': len(self._entries),
+            'bytes': self.bytes,
+            'hit_rate': round(hits / total, 4) if total else 0.0,
+        }
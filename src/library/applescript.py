@@ -1,12 +1,58 @@
+import concurrent.futures
+import itertools
+import json
+import logging
+import os
+import queue
+import selectors
+import shutil
 import subprocess
+import threading
+import time
+import typing
 # import pathlib
 # import sys
 # sys.path.append(
 #     pathlib.Path(__file__).parent.parent.as_posix()
 # )
 
+log = logging.getLogger('app.applescript')
+
 TEMPFP = '/tmp/imsg.scpt'
 
+# 命令已经写入常驻进程, 但没有收到结果(超时或进程退出), 脚本可能已经执行, 调用方不能重试
+UNKNOWN = -2
+
+# 常驻的 JXA 进程, 每行读取一个 json 命令 {id, script}, 用 NSAppleScript 执行后输出一行 json 结果
+# 命令使用 ensure_ascii 编码, 按字节切分 stdin 不会截断多字节字符
+HELPER_JXA = """
+ObjC.import('Foundation');
+function run() {
+    const stdin = $.NSFileHandle.fileHandleWithStandardInput;
+    const stdout = $.NSFileHandle.fileHandleWithStandardOutput;
+    let buffer = '';
+    while (true) {
+        const data = stdin.availableData;
+        if (data.length == 0) break;
+        buffer += $.NSString.alloc.initWithDataEncoding(data, $.NSUTF8StringEncoding).js;
+        let idx;
+        while ((idx = buffer.indexOf('\\n')) >= 0) {
+            const cmd = JSON.parse(buffer.slice(0, idx));
+            buffer = buffer.slice(idx + 1);
+            const error = Ref();
+            const result = $.NSAppleScript.alloc.initWithSource(cmd.script).executeAndReturnError(error);
+            let res;
+            if (result.isNil()) {
+                res = {id: cmd.id, code: 1, out: '', err: ObjC.unwrap(error[0].objectForKey('NSAppleScriptErrorMessage')) || 'error'};
+            } else {
+                res = {id: cmd.id, code: 0, out: ObjC.unwrap(result.stringValue) || '', err: ''};
+            }
+            stdout.writeData($(JSON.stringify(res) + '\\n').dataUsingEncoding($.NSUTF8StringEncoding));
+        }
+    }
+}
+"""
+
 
 class Result:
     code = None
@@ -19,7 +65,172 @@ class Result:
         self.err = err.decode("utf-8").rstrip()
 
 
-def run(script: str):
+class Transport(typing.Protocol):
+    """
+    执行 AppleScript 的方式, AppleScriptWorker 在同一个线程中依次调用 run
+    """
+
+    def run(self, script: str) -> Result:
+        ...
+
+    def close(self) -> None:
+        ...
+
+
+class SpawnTransport:
+    """
+    每个脚本启动一个 osascript 进程
+    """
+
+    def run(self, script: str) -> Result:
+        return spawn_run(script)
+
+    def close(self) -> None:
+        pass
+
+
+class PersistentTransport:
+    """
+    常驻一个 osascript 进程, 通过 stdin/stdout 逐行收发 json 命令, 省去每条消息启动进程的耗时
+    进程退出或超时后, 下一个命令会重新启动进程
+    命令写入之后的失败返回 code 为 UNKNOWN 的结果, 脚本可能已经执行, 不会自动重试
+    """
+
+    def __init__(self, command: typing.Optional[typing.List[str]] = None, timeout: float = 30) -> None:
+        self.command = command or ["osascript", "-l", "JavaScript", "-e", HELPER_JXA]
+        self.timeout = timeout
+        self.proc: typing.Optional[subprocess.Popen] = None
+        self._ids = itertools.count(1)
+        # stdout 中已读取但还没有组成完整一行的数据
+        self._buf = bytearray()
+
+    def start(self) -> subprocess.Popen:
+        if self.proc is None or self.proc.poll() is not None:
+            log.info(f"Starting AppleScript helper process")
+            self._buf.clear()
+            self.proc = subprocess.Popen(
+                self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+            )
+        return self.proc
+
+    def run(self, script: str) -> Result:
+        cmd_id = next(self._ids)
+        for attempt in range(2):
+            proc = self.start()
+            try:
+                proc.stdin.write(json.dumps({'id': cmd_id, 'script': script}).encode() + b'\n')
+                proc.stdin.flush()
+            except (BrokenPipeError, OSError) as e:
+                # 进程已退出, 重启后重试一次; 命令没有写入, 不会重复执行
+                log.warning(f"AppleScript helper is gone: {e!r}, {attempt=}")
+                self.kill()
+                continue
+            line = self._readline(proc)
+            if not line:
+                self.kill()
+                return Result(UNKNOWN, b'', b'AppleScript helper exited or timed out')
+            res: dict = json.loads(line)
+            if res.get('id') != cmd_id:
+                self.kill()
+                return Result(UNKNOWN, b'', f"Unexpected response {res}".encode())
+            return Result(res['code'], res['out'].encode(), res['err'].encode())
+        return Result(-1, b'', b'Cannot start AppleScript helper')
+
+    def _readline(self, proc: subprocess.Popen) -> bytes:
+        """
+        读取一行结果, 超时或进程退出时返回 b''
+        直接 os.read 文件描述符, 不经过 proc.stdout 的缓冲区, select 才能反映是否还有未读数据;
+        timeout 是整行的时限, 进程只输出半行时也不会一直等待
+        """
+        fd = proc.stdout.fileno()
+        deadline = time.monotonic() + self.timeout
+        with selectors.DefaultSelector() as selector:
+            selector.register(fd, selectors.EVENT_READ)
+            while (idx := self._buf.find(b'\n')) < 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not selector.select(remaining):
+                    log.error(f"AppleScript helper timed out after {self.timeout}s")
+                    return b''
+                data = os.read(fd, 65536)
+                if not data:
+                    return b''
+                self._buf += data
+        line = bytes(self._buf[:idx + 1])
+        del self._buf[:idx + 1]
+        return line
+
+    def kill(self) -> None:
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        self.proc = None
+
+    def close(self) -> None:
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.stdin.close()
+            try:
+                self.proc.wait(timeout= 3)
+            except subprocess.TimeoutExpired:
+                self.kill()
+        self.proc = None
+
+
+class AppleScriptWorker:
+    """
+    在后台线程中按提交顺序执行 AppleScript, 每个命令的结果通过 Future 返回
+    transport 默认为常驻 osascript 进程, 测试时可以替换
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, transport: typing.Optional[Transport] = None) -> None:
+        self.transport = transport or PersistentTransport()
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target= self._work, name= 'applescript', daemon= True)
+        self._thread.start()
+
+    @classmethod
+    def get_instance(cls) -> 'AppleScriptWorker':
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls(PersistentTransport() if shutil.which('osascript') else SpawnTransport())
+            return cls._instance
+
+    def submit(self, script: str) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        self._queue.put((script, future))
+        return future
+
+    def run(self, script: str) -> Result:
+        return self.submit(script).result()
+
+    def _work(self) -> None:
+        while (item := self._queue.get()) is not None:
+            script, future = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(self.transport.run(script))
+            except Exception as e:
+                future.set_exception(e)
+        self.transport.close()
+
+    def close(self) -> None:
+        """
+        执行完已提交的命令后退出
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+
+def run(script: str) -> Result:
+    """
+    通过常驻的 AppleScriptWorker 执行
+    """
+    return AppleScriptWorker.get_instance().run(script)
+
+
+def spawn_run(script: str) -> Result:
     # if Path(script).expanduser().exists():
     #     f = script
     # else:
@@ -16,6 +16,9 @@ def get_args(args_: typing.List) -> argparse.Namespace:
     parser.add_argument("-p", "--port", type=int, default=0, help="Server port number")
     parser.add_argument("--use_history", action="store_true", required='--multi_people' in args_, help = "Single-turn or multi-turn chat")
     parser.add_argument("--multi_people", action="store_true", help="New conversation id for everyone people")
+    parser.add_argument("--imsg_watch", action="store_true", help="Read new iMessages as soon as chat.db changes instead of polling every 3s")
+    parser.add_argument("--progressive", action="store_true", help="Send WeCom answers part by part while they are generated")
+    parser.add_argument("--concurrency", type=int, default=4, help="Max WeCom msgs (srv_callback) or iMessages (imsg) answered concurrently, 0 to answer one by one")
     args = parser.parse_args(args_)
     log.debug(f"{args=}")
     return args
@@ -10,7 +10,7 @@
 
 # here put the import lib
 import logging
-import sys
+import math
 import time
 from typing import Text, Dict, List, Generator, ByteString, Union, BinaryIO
 import pathlib
@@ -32,7 +32,9 @@ class Audio:
             format: int = pyaudio.paInt16,
             channels: int = 1,
             rate: int = 16000,
-            chunk_size: int = 5120
+            chunk_size: int = 5120,
+            silence_threshold: int = 500,
+            silence_duration: float = 1.0,
         ):
         self.p = pyaudio.PyAudio()
         self.r_format = format
@@ -40,6 +42,25 @@ class Audio:
         self.r_rate = rate
         self.r_chunk = chunk_size
         # self.r_interval = 0.1
+        # 静音检测: 16bit 采样的 rms 低于 silence_threshold 视为静音
+        self.silence_threshold = silence_threshold
+        self.silence_duration = silence_duration
+
+    @property
+    def frame_width(self) -> int:
+        """
+        每个采样帧的字节数
+        """
+        return pyaudio.get_sample_size(self.r_format) * self.r_channel
+
+    def is_silent(self, data: memoryview) -> bool:
+        """
+        简单的能量检测, 只支持 paInt16
+        """
+        samples = data.cast('B').cast('h')
+        if not samples:
+            return True
+        return math.sqrt(sum(x * x for x in samples) / len(samples)) < self.silence_threshold
 
     def get_record_stream(self) -> pyaudio.PyAudio.Stream:
         stream = self.p.open(
@@ -51,41 +72,60 @@ class Audio:
         )
         return stream
 
-    def record_stream(self, duration: int) -> Generator:
+    def record_stream(self, duration: int, stop_on_silence: bool = False) -> Generator[memoryview, None, memoryview]:
         """
         录音并流式输出
+        录音写入按 duration 预分配的缓冲区, 输出的是缓冲区的 memoryview 切片, 不复制数据,
+        消费者可以直接发送或保存; 生成器结束时返回整段录音的 memoryview
+        stop_on_silence 为 True 时, 说话之后静音超过 silence_duration 秒即提前结束
         """
+        if duration <= 0:
+            return memoryview(b"")
+        frame_width = self.frame_width
+        buffer = memoryview(bytearray(int(duration * self.r_rate) * frame_width))
+        silence_limit = int(self.silence_duration * self.r_rate) * frame_width
+        spoke, silence = False, 0
+        pos = 0
         stream = self.get_record_stream()
-        if duration > 0:
-            logger.info(f"Recording for {duration} seconds")
-            for _ in range(int(self.r_rate * duration / self.r_chunk)):
-                sys.stdout.write(f"\rrecording {_}")
-                yield stream.read(self.r_chunk)
-            logger.debug(f"Record finished")
+        logger.info(f"Recording for {duration} seconds")
+        try:
+            while pos < len(buffer):
+                part = stream.read(min(self.r_chunk, (len(buffer) - pos) // frame_width))
+                end = pos + len(part)
+                buffer[pos: end] = part
+                chunk = buffer[pos: end]
+                pos = end
+                yield chunk
+                if stop_on_silence:
+                    if not self.is_silent(chunk):
+                        spoke, silence = True, 0
+                    elif spoke:
+                        silence += len(chunk)
+                        if silence >= silence_limit:
+                            logger.debug(f"Silence detected, stop recording")
+                            break
+        finally:
             stream.stop_stream()
             stream.close()
+        logger.debug(f"Record finished, {pos / frame_width / self.r_rate:.2f} seconds")
+        return buffer[:pos]
 
-    def record(self, duration: int = 10) -> ByteString:
+    def record(self, duration: int = 10, stop_on_silence: bool = False) -> memoryview:
         """
         录音
         """
-        data = b""
-        _gen = self.record_stream(duration)
+        _gen = self.record_stream(duration, stop_on_silence)
         try:
             while True:
-                part = next(_gen)
-                data += part
+                next(_gen)
         except StopIteration as e:
-            logger.exception(e)
-            pass
-
-        return data
+            return e.value
 
-    def record_to_wav(self, fp: Text, duration: int = 30) -> int:
+    def record_to_wav(self, fp: Text, duration: int = 30, stop_on_silence: bool = False) -> int:
         """
         录音并保存到文件，格式: wav
         """
-        data = self.record(duration)
+        data = self.record(duration, stop_on_silence)
         return self.save_wav(data, fp)
 
     def play_stream(self, file_object: Union[Text, BinaryIO, wave.Wave_read]) -> Generator:
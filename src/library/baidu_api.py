@@ -9,31 +9,38 @@
 '''
 
 # here put the import lib
+import asyncio
+import inspect
 import json
 import threading
 import logging
 import time
 import uuid
 import wave
-from typing import ByteString, Text, Generator
+from typing import Any, AsyncIterator, Awaitable, Callable, Generator, Optional, Text
 import sys
 import pathlib
 sys.path.append(pathlib.Path(__file__).parent.parent.as_posix())
 
+import aiohttp
 import websocket
 
+from library.transcode import reframe
 from settings.conf import APP_ID, APP_KEY, DEV_PID, HOST_MAC, URI
 
 
 logger = logging.getLogger()
 
-def send_start_params(ws):
+# 没有检测到有效语音
+NO_SPEECH_ERRNO = -3005
+# 每帧 160ms, 16k 16bit 单声道
+FRAME_BYTES = 5120
+
+def start_params() -> dict:
     """
     开始参数帧
-    :param websocket.WebSocket ws:
-    :return:
     """
-    req = {
+    return {
         "type": "START",
         "data": {
             "appid": APP_ID,  # 网页上的appid
@@ -44,15 +51,56 @@ def send_start_params(ws):
             "format": "pcm"  # 固定参数
         }
     }
-    body = json.dumps(req)
+
+
+def send_start_params(ws):
+    """
+    开始参数帧
+    :param websocket.WebSocket ws:
+    :return:
+    """
+    body = json.dumps(start_params())
     ws.send(body, websocket.ABNF.OPCODE_TEXT)
     logger.info("send START frame with params:" + body)
 
-def send_binary_stream(ws: websocket.WebSocket, _gen: Generator):
+class FramePacer:
+    """
+    按音频时长控制发送节奏, 发送时间按单调时钟上的固定时间表计算, send 本身的耗时不会累积成误差
+        - speed: 1 为实时, 大于 1 为快于实时, 0 为不限速
+        - 发送落后时间表超过 max_lag 秒时(网络或服务端背压), 从当前时间重新开始计时, 不会突发补发
+    """
+
+    def __init__(self, speed: float = 1.0, rate: int = 16000, max_lag: float = 0.5) -> None:
+        self.speed = speed
+        self.bytes_per_second = rate * 2
+        self.max_lag = max_lag
+        self.next_send: Optional[float] = None
+        self.waited = 0.0
+        self.lagged = 0
+
+    def delay(self, nbytes: int) -> float:
+        """发送 nbytes 字节的帧之前需要等待的秒数"""
+        if not self.speed:
+            return 0.0
+        now = time.monotonic()
+        if self.next_send is None:
+            self.next_send = now
+        elif now - self.next_send > self.max_lag:
+            self.lagged += 1
+            self.next_send = now
+        wait = max(0.0, self.next_send - now)
+        self.next_send += nbytes / self.bytes_per_second / self.speed
+        self.waited += wait
+        return wait
+
+
+def send_binary_stream(ws: websocket.WebSocket, _gen: Generator, speed: float = 1.0):
     """
-    接收数据流并发送
+    接收数据流并按实时节奏发送
     """
+    pacer = FramePacer(speed)
     for _binary in _gen:
+        time.sleep(pacer.delay(len(_binary)))
         ws.send(_binary, websocket.ABNF.OPCODE_BINARY)
 
 
@@ -120,6 +168,155 @@ class BaiDuVoiceAI:
 
 
 
+class BaiDuASRError(Exception):
+    pass
+
+
+class IdleTimer:
+    """
+    空闲超时: 每次 touch 重新计时, timeout 秒内没有 touch 视为超时
+    """
+
+    def __init__(self, timeout: float) -> None:
+        self.timeout = timeout
+        self.touch()
+
+    def touch(self) -> None:
+        self.last = time.monotonic()
+
+    def remaining(self) -> float:
+        return self.last + self.timeout - time.monotonic()
+
+    async def run(self, aw: Awaitable) -> Any:
+        """
+        等待 aw 完成, 空闲超时时取消并抛出 asyncio.TimeoutError
+        """
+        task = asyncio.ensure_future(aw)
+        try:
+            while (remaining := self.remaining()) > 0:
+                done, _ = await asyncio.wait({task}, timeout= remaining)
+                if done:
+                    return task.result()
+            raise asyncio.TimeoutError
+        finally:
+            if not task.done():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+
+
+class AsyncBaiDuASR:
+    """
+    百度实时语音识别 asyncio 客户端
+        - 每次 recognize 使用独立的 websocket 连接, 状态都在调用栈中, 可以并发识别
+        - 最多 concurrency 个识别同时进行
+        - timeout 为空闲超时, 超过 timeout 秒既没有发送音频也没有收到结果时失败,
+          按实时速度上传的长语音不会因为总时长超时
+        - on_partial 接收临时识别结果(MID_TEXT), 可以是普通函数或协程函数
+        - 音频按 160ms 分帧, 以 speed 倍实时速度发送, 见 FramePacer
+    """
+    _instance = None
+
+    def __init__(self, uri: str = URI, concurrency: int = 4, timeout: float = 60, speed: float = 1.0) -> None:
+        self.uri = uri
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.speed = speed
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.session: aiohttp.ClientSession | None = None
+
+    @classmethod
+    def get_instance(cls) -> 'AsyncBaiDuASR':
+        if cls._instance is None:
+            from library.utils import CFG
+            baidu_cfg: dict = CFG.C.get('Baidu') or {}
+            cls._instance = cls(
+                concurrency= baidu_cfg.get('CONCURRENCY') or 4,
+                timeout= baidu_cfg.get('TIMEOUT') or 60,
+                speed= baidu_cfg.get('SPEED', 1.0),
+            )
+        return cls._instance
+
+    async def open_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession()
+        return self.session
+
+    async def close_session(self) -> None:
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    async def recognize(self, frames: AsyncIterator[bytes], on_partial: Optional[Callable[[str], Any]] = None) -> str:
+        """识别一段 16k 16bit 单声道 pcm
+
+        Args:
+            frames (AsyncIterator[bytes]): pcm 帧, 建议每帧 160ms
+            on_partial (Callable[[str], Any], optional): 收到临时结果时调用, 参数为目前为止的完整文本
+
+        Returns:
+            str: 识别结果, 多句时拼接在一起
+        """
+        async with self._semaphore:
+            idle = IdleTimer(self.timeout)
+            try:
+                return await idle.run(self._recognize(frames, on_partial, idle))
+            except asyncio.TimeoutError:
+                raise BaiDuASRError(f"Recognition timed out, no progress in {self.timeout}s")
+
+    async def _recognize(self, frames: AsyncIterator[bytes], on_partial: Optional[Callable[[str], Any]], idle: IdleTimer) -> str:
+        ss = await self.open_session()
+        sentences = []
+        async with ss.ws_connect(f"{self.uri}?sn={uuid.uuid1()}") as ws:
+            sender = asyncio.create_task(self._send(ws, frames, idle))
+            try:
+                async for ws_msg in ws:
+                    idle.touch()
+                    if ws_msg.type == aiohttp.WSMsgType.ERROR:
+                        raise BaiDuASRError(f"Websocket error: {ws.exception()!r}")
+                    if ws_msg.type != aiohttp.WSMsgType.TEXT:
+                        continue
+                    logger.debug(f"Response: {ws_msg.data}")
+                    res: dict = json.loads(ws_msg.data)
+                    if res.get('err_no'):
+                        if res['err_no'] == NO_SPEECH_ERRNO:
+                            continue
+                        raise BaiDuASRError(f"Recognition failed: {res.get('err_no')} {res.get('err_msg')}")
+                    if res.get('type') == 'FIN_TEXT':
+                        sentences.append(res.get('result', ''))
+                    elif res.get('type') == 'MID_TEXT' and on_partial is not None:
+                        partial = on_partial(''.join(sentences) + res.get('result', ''))
+                        if inspect.isawaitable(partial):
+                            await partial
+                # 服务端在 FINISH 帧之后返回最后的结果并关闭连接, 这里取出发送时的错误
+                await sender
+            finally:
+                if not sender.done():
+                    sender.cancel()
+                    await asyncio.gather(sender, return_exceptions=True)
+        msg = ''.join(sentences)
+        logger.debug(f"语音转换文字完成: {msg}")
+        return msg
+
+    async def _send(self, ws: aiohttp.ClientWebSocketResponse, frames: AsyncIterator[bytes], idle: IdleTimer) -> None:
+        await ws.send_json(start_params())
+        pacer = FramePacer(self.speed)
+        started = time.monotonic()
+        try:
+            async for frame in reframe(frames, FRAME_BYTES):
+                await asyncio.sleep(pacer.delay(len(frame)))
+                # 发送缓冲区满时 send_bytes 会等待 drain
+                await ws.send_bytes(frame)
+                idle.touch()
+        except Exception:
+            # 音频出错, 关闭连接让接收端结束
+            await ws.close()
+            raise
+        await ws.send_json({"type": "FINISH"})
+        logger.debug(
+            f"Sent audio in {time.monotonic() - started:.2f}s, paced {pacer.waited:.2f}s, fell behind {pacer.lagged} times"
+        )
+
+
 def send_audio(ws, pcm_file):
     """
     发送二进制音频数据，注意每个帧之间需要有间隔时间
@@ -128,6 +325,7 @@ def send_audio(ws, pcm_file):
     """
     chunk_ms = 160  # 160ms的录音
     chunk_len = int(16000 * 2 / 1000 * chunk_ms)
+    pacer = FramePacer()
     with open(pcm_file, 'rb') as f:
         pcm = f.read()
 
@@ -141,9 +339,9 @@ def send_audio(ws, pcm_file):
             end = total
         body = pcm[index:end]
         logger.debug("try to send audio length {}, from bytes [{},{})".format(len(body), index, end))
+        time.sleep(pacer.delay(len(body)))
         ws.send(body, websocket.ABNF.OPCODE_BINARY)
         index = end
-        time.sleep(chunk_ms / 1000.0)  # ws.send 也有点耗时，这里没有计算
 
 
 def send_finish(ws):
@@ -198,7 +396,7 @@ def wav_file_to_text(wav_fp: str) -> str:
     """
     流式读取wav文件，并且利用百度API转换为文字
     """
-    audio_stream = wav_file_stream(wav_fp, chunk_size=1024)
+    audio_stream = wav_file_stream(wav_fp, chunk_size=FRAME_BYTES // 2)
     bdai = BaiDuVoiceAI()
     msg = bdai.voice2text(audio_stream)
     logger.info(f"You said: {msg}")
@@ -207,6 +405,14 @@ def wav_file_to_text(wav_fp: str) -> str:
     #     return ""
     return msg
 
+async def async_pcm_to_text(frames: AsyncIterator[bytes], on_partial: Optional[Callable[[str], Any]] = None) -> str:
+    """
+    边接收 pcm 帧边识别, 第一帧到达后即开始发送
+    """
+    msg = await AsyncBaiDuASR.get_instance().recognize(frames, on_partial)
+    logger.info(f"You said: {msg}")
+    return msg
+
 def main():
     wav_fp = "/home/yohann/.AIGCSrv/media/voice/7215601231908484633.wav"
     audio_stream = wav_file_stream(wav_fp, chunk_size=1024)
@@ -0,0 +1,405 @@
+import asyncio
+import collections
+import contextlib
+import json
+import logging
+import os
+import pathlib
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+import weakref
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Iterator
+
+from settings import conf
+
+log = logging.getLogger('app.convo_store')
+
+LOAD_SQL = "SELECT data FROM conversation WHERE convo_id = ?;"
+# 租约过期(持有者崩溃)后可以被其他进程抢占
+ACQUIRE_SQL = """INSERT INTO conversation_lock(convo_id, owner, expires) VALUES(?, ?, ?)
+ON CONFLICT(convo_id) DO UPDATE SET owner = excluded.owner, expires = excluded.expires
+WHERE conversation_lock.expires < ?;"""
+RELEASE_SQL = "DELETE FROM conversation_lock WHERE convo_id = ? AND owner = ?;"
+SAVE_SQL = "INSERT OR REPLACE INTO conversation(convo_id, data, updated_at) VALUES(?, ?, ?);"
+DELETE_SQL = "DELETE FROM conversation WHERE convo_id = ?;"
+KEYS_SQL = "SELECT convo_id FROM conversation;"
+
+
+class ConversationStore(MutableMapping):
+    """
+    Chatbot.conversation 的持久化存储, 用法与 dict 相同
+        - 每个会话一行, 存在 sqlite 的 conversation 表中, 第一次访问时才读取
+        - 内存中只保留最近访问的 cache_size 个会话, 超出时淘汰最久未访问的
+        - 会话在原地修改, 所以记录访问过的会话, 每 flush_interval 秒交给后台线程,
+          在后台线程中序列化, 只写入内容有变化的会话
+        - 协程中先 aload 再访问, 读取和解析都在后台线程中执行, 不阻塞事件循环
+        - lock(convo_id) 保证同一会话同一时刻只有一个请求在修改;
+          shared 为 True 时(多个 worker 进程共用 db_fp), 同时持有 sqlite 中的会话租约,
+          进入时重新读取会话, 退出时立即写入, 其他进程总是读到最新的内容,
+          租约和读写都在后台线程中执行, 不阻塞事件循环
+        - 没有事件循环的同步调用方使用 sync_lock
+    """
+
+    def __init__(
+            self,
+            db_fp: str,
+            cache_size: int = 1000,
+            flush_interval: float = 5,
+            shared: bool = False,
+            lock_timeout: float = 300,
+        ) -> None:
+        self.db_fp = pathlib.Path(db_fp).expanduser()
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self.shared = shared
+        self.lock_timeout = lock_timeout
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        # 不再使用的锁自动回收
+        self._locks: weakref.WeakValueDictionary[str, asyncio.Lock] = weakref.WeakValueDictionary()
+        self._cache: collections.OrderedDict[str, dict] = collections.OrderedDict()
+        # 访问过、可能被修改的会话
+        self._touched: set[str] = set()
+        # 最近一次写入的内容, 用于跳过没有变化的会话
+        self._saved: dict[str, str] = {}
+        # 已交给后台线程但还没写入的会话
+        self._pending: dict[str, dict] = {}
+        # aload 确认 sqlite 中不存在的会话, 之后的访问不再读取
+        self._absent: set[str] = set()
+        self._pending_lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self.db_fp.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(self.db_fp.as_posix(), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL;")
+        self.conn.execute(conf.CONVERSATION_TABLE)
+        self.conn.execute(conf.CONVERSATION_LOCK_TABLE)
+        self.conn.commit()
+        self._conn_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='app.convo_store')
+        self._closed = False
+
+    @classmethod
+    def from_config(cls) -> 'ConversationStore':
+        from library.utils import CFG
+        store_cfg: dict = CFG.C['ChatGPT'].get('STORE') or {}
+        return cls(
+            db_fp= store_cfg.get('DB_FP') or '~/.AIGCSrv/conversation.db',
+            cache_size= store_cfg.get('CACHE_SIZE', 1000),
+            flush_interval= store_cfg.get('FLUSH_INTERVAL', 5),
+            shared= store_cfg.get('SHARED', False),
+            lock_timeout= store_cfg.get('LOCK_TIMEOUT', 300),
+        )
+
+    @contextlib.asynccontextmanager
+    async def lock(self, convo_id: str) -> AsyncIterator[None]:
+        """
+        独占一个会话, 用于一次完整的问答(添加问题、请求、添加回复)
+        """
+        lock = self._locks.get(convo_id)
+        if lock is None:
+            lock = self._locks[convo_id] = asyncio.Lock()
+        async with lock:
+            if not self.shared:
+                await self.aload(convo_id)
+                yield
+                return
+            await self._acquire(convo_id)
+            try:
+                await self.arefresh(convo_id)
+                yield
+                await self.acommit(convo_id)
+            finally:
+                await self._run(self._release, convo_id)
+
+    @contextlib.contextmanager
+    def sync_lock(self, convo_id: str) -> Iterator[None]:
+        """
+        lock 的同步版本, 用于没有事件循环的调用方(sync_imsg 等), 只持有 sqlite 中的会话租约;
+        不能在事件循环中使用, 同一进程的 lock 持有相同 owner 的租约, 会一直等到租约过期
+        """
+        if not self.shared:
+            yield
+            return
+        delay = 0.01
+        while not self._try_acquire(convo_id):
+            time.sleep(delay)
+            delay = min(delay * 2, 0.5)
+        try:
+            self.refresh(convo_id)
+            yield
+            self.commit(convo_id)
+        finally:
+            self._release(convo_id)
+
+    async def _acquire(self, convo_id: str) -> None:
+        delay = 0.01
+        while not await self._run(self._try_acquire, convo_id):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.5)
+
+    def _try_acquire(self, convo_id: str) -> bool:
+        """
+        获取租约, 其他进程持有或数据库忙时返回 False, 由调用方退避后重试
+        """
+        now = time.time()
+        try:
+            return bool(self._execute(ACQUIRE_SQL, (convo_id, self.owner, now + self.lock_timeout, now)))
+        except sqlite3.OperationalError as e:
+            log.warning(f"Acquire conversation {convo_id} failed: {e}")
+            return False
+
+    def _release(self, convo_id: str) -> None:
+        try:
+            self._execute(RELEASE_SQL, (convo_id, self.owner))
+        except sqlite3.Error as e:
+            # 租约在 lock_timeout 后过期, 其他进程仍然可以获取
+            log.error(f"Release conversation {convo_id} failed: {e}")
+
+    async def _run(self, func: Callable, *args) -> Any:
+        """
+        在后台线程中执行, 与 _flush_ids 提交的写入按顺序执行, 读取时已包含之前的写入
+        """
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _execute(self, sql: str, params: tuple) -> int:
+        with self._conn_lock:
+            try:
+                cur = self.conn.execute(sql, params)
+                self.conn.commit()
+            except sqlite3.Error:
+                self.conn.rollback()
+                raise
+            return cur.rowcount
+
+    def refresh(self, convo_id: str) -> None:
+        """
+        写入本进程的修改后丢弃内存中的会话, 下次访问时从 sqlite 读取其他进程写入的内容;
+        等待后台写入完成, 协程中使用 arefresh
+        """
+        self._flush_ids([convo_id])
+        self._executor.submit(lambda: None).result()
+        self._drop(convo_id)
+
+    async def arefresh(self, convo_id: str) -> None:
+        """
+        refresh 的协程版本, 在后台线程中按顺序写入和读取会话, 之后的访问不再读 sqlite
+        """
+        self._flush_ids([convo_id])
+        self._drop(convo_id)
+        self._loaded(convo_id, await self._run(self._read, convo_id))
+
+    def _drop(self, convo_id: str) -> None:
+        self._cache.pop(convo_id, None)
+        self._saved.pop(convo_id, None)
+        self._absent.discard(convo_id)
+
+    async def aload(self, convo_id: str) -> bool:
+        """
+        会话不在内存中时在后台线程中读取和解析, 之后的访问不再在事件循环中读 sqlite
+
+        Returns:
+            bool: 会话是否存在
+        """
+        if convo_id in self._cache or convo_id in self._absent:
+            return convo_id in self._cache
+        with self._pending_lock:
+            pending = convo_id in self._pending
+        if pending:
+            return self._cached(convo_id)
+        return self._loaded(convo_id, await self._run(self._read, convo_id))
+
+    def _loaded(self, convo_id: str, loaded: tuple[str, dict] | None) -> bool:
+        """
+        保存后台线程读取的会话, 读取期间已经在内存中的会话保持不变
+        """
+        if convo_id in self._cache:
+            return True
+        if loaded is None:
+            if len(self._absent) >= self.cache_size:
+                self._absent.clear()
+            self._absent.add(convo_id)
+            return False
+        self._saved[convo_id], self._cache[convo_id] = loaded
+        self._evict()
+        return True
+
+    def commit(self, convo_id: str) -> None:
+        """
+        立即写入会话
+        """
+        self._save(self._snapshot([convo_id]))
+
+    async def acommit(self, convo_id: str) -> None:
+        """
+        在后台线程中写入会话, 等待写入完成
+        """
+        if convos := self._snapshot([convo_id]):
+            await self._run(self._save, convos)
+
+    def __getitem__(self, convo_id: str) -> dict:
+        if not self._cached(convo_id):
+            raise KeyError(convo_id)
+        self._touched.add(convo_id)
+        self.maybe_flush()
+        return self._cache[convo_id]
+
+    def __setitem__(self, convo_id: str, convo: dict) -> None:
+        self._cache[convo_id] = convo
+        self._cache.move_to_end(convo_id)
+        self._touched.add(convo_id)
+        self._absent.discard(convo_id)
+        self._evict()
+        self.maybe_flush()
+
+    def __delitem__(self, convo_id: str) -> None:
+        if convo_id not in self:
+            raise KeyError(convo_id)
+        self._cache.pop(convo_id, None)
+        self._touched.discard(convo_id)
+        self._saved.pop(convo_id, None)
+        with self._pending_lock:
+            self._pending.pop(convo_id, None)
+        self._absent.add(convo_id)
+        self._executor.submit(self._delete, convo_id)
+
+    def __contains__(self, convo_id: object) -> bool:
+        return self._cached(convo_id)
+
+    def _cached(self, convo_id: str) -> bool:
+        """
+        会话移到 LRU 末尾, 不在内存中时取回等待写入的会话或从 sqlite 读取, 不存在时返回 False
+        """
+        if convo_id in self._cache:
+            self._cache.move_to_end(convo_id)
+            return True
+        if convo_id in self._absent:
+            return False
+        with self._pending_lock:
+            convo = self._pending.get(convo_id)
+        if convo is None:
+            loaded = self._read(convo_id)
+            if loaded is None:
+                return False
+            self._saved[convo_id], convo = loaded
+        # 等待写入的会话放回内存, 再次修改后会重新写入
+        self._cache[convo_id] = convo
+        self._evict()
+        return True
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._keys())
+
+    def __len__(self) -> int:
+        return len(self._keys())
+
+    def _keys(self) -> list[str]:
+        with self._conn_lock:
+            stored = [row[0] for row in self.conn.execute(KEYS_SQL)]
+        with self._pending_lock:
+            pending = list(self._pending)
+        return list(dict.fromkeys([*stored, *pending, *self._cache]))
+
+    def _read(self, convo_id: str) -> tuple[str, dict] | None:
+        """
+        从 sqlite 读取并解析会话
+
+        Returns:
+            tuple[str, dict] | None: 保存的内容和会话, 不存在时为 None
+        """
+        with self._conn_lock:
+            row = self.conn.execute(LOAD_SQL, (convo_id, )).fetchone()
+        return (row[0], json.loads(row[0])) if row else None
+
+    def _evict(self) -> None:
+        while len(self._cache) > self.cache_size:
+            convo_id = next(iter(self._cache))
+            self._flush_ids([convo_id])
+            del self._cache[convo_id]
+            self._saved.pop(convo_id, None)
+            log.debug(f"Evicted conversation {convo_id}")
+
+    def maybe_flush(self) -> None:
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        在后台线程中序列化并写入有变化的会话, 不等待写入完成
+        """
+        self._last_flush = time.monotonic()
+        self._flush_ids(list(self._touched))
+
+    def _flush_ids(self, convo_ids: list[str]) -> None:
+        convos = self._snapshot(convo_ids)
+        if not convos:
+            return
+        with self._pending_lock:
+            self._pending.update({convo_id: convo for convo_id, (convo, _) in convos.items()})
+        self._executor.submit(self._save, convos)
+
+    def _snapshot(self, convo_ids: list[str]) -> dict[str, tuple[dict, str | None]]:
+        """
+        要写入的会话和最近一次写入的内容, 不在事件循环中序列化
+        """
+        convos = {}
+        for convo_id in convo_ids:
+            self._touched.discard(convo_id)
+            if convo_id in self._cache:
+                convos[convo_id] = (self._cache[convo_id], self._saved.get(convo_id))
+        return convos
+
+    def _save(self, convos: dict[str, tuple[dict, str | None]]) -> None:
+        """
+        序列化并写入内容有变化的会话, 在后台线程中执行, commit 和 close 时在当前线程执行
+        """
+        rows = []
+        for convo_id, (convo, saved) in convos.items():
+            try:
+                data = json.dumps(convo, ensure_ascii=False)
+            except (TypeError, ValueError) as e:
+                log.error(f"Can not save conversation {convo_id}: {e}")
+                continue
+            if data != saved:
+                rows.append((convo_id, data, time.time()))
+        written = not rows or self._write(rows)
+        for convo_id, data, _ in rows:
+            # 内存中仍是这个会话时记录写入的内容; 写入失败时不记录, 下次 flush 或淘汰时重新写入
+            if written and self._cache.get(convo_id) is convos[convo_id][0]:
+                self._saved[convo_id] = data
+        with self._pending_lock:
+            for convo_id, (convo, _) in convos.items():
+                # 写入期间又交给后台线程的会话保留
+                if self._pending.get(convo_id) is convo:
+                    del self._pending[convo_id]
+
+    def _write(self, rows: list[tuple]) -> bool:
+        try:
+            with self._conn_lock:
+                self.conn.executemany(SAVE_SQL, rows)
+                self.conn.commit()
+            log.debug(f"Saved {len(rows)} conversations")
+            return True
+        except sqlite3.Error as e:
+            log.exception(e)
+            return False
+
+    def _delete(self, convo_id: str) -> None:
+        with self._conn_lock:
+            self.conn.execute(DELETE_SQL, (convo_id, ))
+            self.conn.commit()
+
+    def close(self) -> None:
+        """
+        等待后台写入完成, 剩余的变化在当前线程写入
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._executor.shutdown(wait=True)
+        self._save(self._snapshot(list(self._touched)))
+        with self._conn_lock:
+            self.conn.close()
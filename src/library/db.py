@@ -1,7 +1,12 @@
+import asyncio
+import functools
 import pathlib
+import socket
 import sqlite3
 import logging
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 sys.path.append(pathlib.Path(__file__).parent.parent.as_posix())
 
 from library.utils import CFG
@@ -9,11 +14,38 @@ from settings import conf
 
 log = logging.getLogger('app.db')
 
+# 固定的 sql 文本可以命中 sqlite3 的 prepared statement 缓存
+INSERT_SQL = f"INSERT OR IGNORE INTO data_list({', '.join(conf.DATALIST_COLUMNS)}) VALUES({', '.join('?' for _ in conf.DATALIST_COLUMNS)});"
+DELETE_SQL = "DELETE FROM data_list WHERE msgid = ?;"
+EXISTED_SQL = "SELECT 1 FROM data_list WHERE msgid = ? LIMIT 1;"
+# 不是 json 的旧数据不会被跳过
+FROM_USER_SQL = "IFNULL(CASE WHEN json_valid(recvd_cont_dict) THEN json_extract(recvd_cont_dict, '$.FromUserName') END, '')"
+FETCH_SQL = f"SELECT {', '.join(conf.DATALIST_COLUMNS)} FROM data_list ORDER BY rowid LIMIT ?;"
+
 class DB:
+    """
+    data_list 是企业微信消息队列, 由 /wecom/recvMsg 写入, srv_callback 消费
+        - claim 领取一批消息并租用 VISIBILITY_TIMEOUT 秒, 超时未 delete 会被重新领取
+        - 领取超过 MAX_RETRIES 次的消息直接删除, 由 trigger 归档到 consumed_data
+        - insert 之后通过 unix datagram socket 唤醒等待中的消费者
+    协程中使用 a* 方法, sqlite 操作在专用线程中执行, 不阻塞 event loop
+    """
     __instance = None
+    __initialized = False
 
     def __init__(self) -> None:
+        if self.__initialized:
+            return
         self.conn, self.cur = self._init_db()
+        queue_cfg: dict = CFG.C.get('QUEUE') or {}
+        self.visibility_timeout: float = queue_cfg.get('VISIBILITY_TIMEOUT', 300)
+        self.max_retries: int = queue_cfg.get('MAX_RETRIES', 3)
+        self.poll_interval: float = queue_cfg.get('POLL_INTERVAL', 3)
+        self.sock_fp = f"{pathlib.Path(CFG.C['DATA_DB_FP']).expanduser().as_posix()}.sock"
+        self._listener: socket.socket | None = None
+        # 单线程保证同一时刻只有一个线程使用 sqlite 连接
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='app.db')
+        self.__class__.__initialized = True
 
     def __new__(cls, *args, **kwargs):
         if cls.__instance is None:
@@ -25,58 +57,179 @@ class DB:
         if not db_fp_obj.exists():
             db_fp_obj.touch()
         log.debug(f"Initializing sqlite db {db_fp_obj.as_posix()}")
-        conn = sqlite3.connect(db_fp_obj.as_posix())
+        conn = sqlite3.connect(db_fp_obj.as_posix(), cached_statements=256, check_same_thread=False)
         cur = conn.cursor()
-        # 创建 data_list 表(content, nonce, timestamp, recvd_cont_dict, receiveid, msgid)
+        # server 写入与 srv_callback 读取分属两个进程, WAL 下读写互不阻塞
+        cur.execute("PRAGMA journal_mode=WAL;")
+        cur.execute("PRAGMA synchronous=NORMAL;")
+        # 创建 data_list 表(content, nonce, timestamp, recvd_cont_dict, receiveid, msgid, lease_until, retries)
         cur.execute(conf.DATALIST_TABLE)
+        columns = {row[1] for row in cur.execute("PRAGMA table_info(data_list);")}
+        for column, column_def in conf.DATALIST_QUEUE_COLUMNS.items():
+            if column not in columns:
+                log.info(f"Adding column {column} to data_list")
+                cur.execute(f"ALTER TABLE data_list ADD COLUMN {column} {column_def};")
+        for index in conf.DATALIST_INDEXES:
+            cur.execute(index)
+        cur.execute("DROP INDEX IF EXISTS idx_data_list_msgid;")
         cur.execute(conf.TRIGGER_TABLE)
         cur.execute(conf.TRIGGER)
+        if not cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'uidx_data_list_msgid';").fetchone():
+            cur.execute(conf.DATALIST_DEDUP)
+            log.info(f"Removed {cur.rowcount} duplicated msgs from data_list")
+            cur.execute(conf.DATALIST_UNIQUE_MSGID)
+        conn.commit()
         log.debug("DB initialized")
         return conn, cur
     
-    def insert(self, data: dict):
-        keys = []
-        values = []
-        for k,v in data.items():
-            keys.append(k)
-            values.append(v)
-        columns = ', '.join(keys)
-        row = ', '.join(['?' for _ in values])
-        cmd = f"INSERT INTO data_list({columns}) VALUES({row});"
-        r = self.execute(cmd, values)
-        
-        log.debug(f"{r=}")
-
-    def insert2(self, data:dict):
-        keys = []
-        values = []
-        for k,v in data.items():
-            keys.append(k)
-            values.append(v)
-        columns = ', '.join(keys)
-        row = ', '.join([repr(v) for v in values])
-        cmd = f"INSERT INTO data_list({columns}) VALUES({row});"
-        r = self.execute(cmd, )
-        log.debug(f"{r=}")
+    def insert(self, data: dict) -> bool:
+        """写入一条消息, msgid 已存在时忽略
+
+        Args:
+            data (dict): {content, nonce, timestamp, recvd_cont_dict, receiveid, msgid}
+
+        Returns:
+            bool: True 写入成功, False msgid 重复
+        """
+        with self.conn:
+            self.cur.execute(INSERT_SQL, [data.get(k) for k in conf.DATALIST_COLUMNS])
+        inserted = self.cur.rowcount == 1
+        log.debug(f"{inserted=}")
+        if inserted:
+            self.notify()
+        return inserted
 
     def delete(self, data: dict):
-        _msgid = data['msgid']
-        cmd = f"DELETE FROM data_list where msgid='{_msgid}';"
-        r = self.execute(cmd)
-        log.debug(f"{r=}")
+        self.delete_many([data['msgid']])
+
+    def delete_many(self, msgids: list[str]):
+        """
+        在一个事务内删除多条消息
+        """
+        with self.conn:
+            self.cur.executemany(DELETE_SQL, [(msgid, ) for msgid in msgids])
+        log.debug(f"Deleted {self.cur.rowcount} msgs")
 
     def fetch(self):
-        cmd = "select content, nonce, timestamp, recvd_cont_dict, receiveid, msgid from data_list;"
-        r = self.execute(cmd)
-        # log.debug(f"{r=}")
-        return r
+        return self.fetch_batch(-1)
+
+    def fetch_batch(self, limit: int = 10) -> list:
+        """按写入顺序读取最多 limit 条消息, 不领取, limit < 0 读取全部
+
+        Returns:
+            list: [(content, nonce, timestamp, recvd_cont_dict, receiveid, msgid), ...]
+        """
+        return self.execute(FETCH_SQL, [limit])
+
+    def claim(self, limit: int = 10, exclude_users: list[str] | None = None) -> list:
+        """领取最多 limit 条未被租用的消息, 按写入顺序返回
+
+        Args:
+            exclude_users (list[str]): 跳过这些 FromUserName 的消息, 用于正在回答的用户
+
+        Returns:
+            list: [(content, nonce, timestamp, recvd_cont_dict, receiveid, msgid), ...]
+        """
+        if limit <= 0:
+            return []
+        now = time.time()
+        # BEGIN IMMEDIATE 拿到写锁, 多个消费者不会领到同一条消息
+        self.cur.execute("BEGIN IMMEDIATE;")
+        try:
+            self.cur.execute(
+                "SELECT msgid FROM data_list WHERE lease_until <= ? AND retries >= ?;",
+                (now, self.max_retries)
+            )
+            if dead := [row[0] for row in self.cur.fetchall()]:
+                log.error(f"Archived msgs exceeding {self.max_retries} retries: {dead}")
+                self.cur.execute(
+                    "DELETE FROM data_list WHERE lease_until <= ? AND retries >= ?;",
+                    (now, self.max_retries)
+                )
+            exclude_users = exclude_users or []
+            self.cur.execute(
+                "SELECT rowid, content, nonce, timestamp, recvd_cont_dict, receiveid, msgid "
+                "FROM data_list WHERE lease_until <= ? "
+                + (f"AND {FROM_USER_SQL} NOT IN ({', '.join('?' for _ in exclude_users)}) " if exclude_users else "")
+                + "ORDER BY rowid LIMIT ?;",
+                (now, *exclude_users, limit)
+            )
+            rows = self.cur.fetchall()
+            if rows:
+                self.cur.execute(
+                    f"UPDATE data_list SET lease_until = ?, retries = retries + 1 "
+                    f"WHERE rowid IN ({', '.join('?' for _ in rows)});",
+                    (now + self.visibility_timeout, *(row[0] for row in rows))
+                )
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        if rows:
+            log.debug(f"Claimed {len(rows)} msgs")
+        return [row[1:] for row in rows]
+
+    def release(self, msgid: str):
+        """
+        归还已领取的消息, 可被立即重新领取
+        """
+        self.execute("UPDATE data_list SET lease_until = 0 WHERE msgid = ?;", [msgid])
+
+    def notify(self):
+        """
+        唤醒等待中的消费者, 没有消费者或消费者积压的通知已满(所有 worker 都在忙)时忽略,
+        不阻塞执行 insert 的线程
+        """
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            try:
+                sock.sendto(b'1', self.sock_fp)
+            except OSError:
+                pass
+
+    async def wait(self, timeout: float = 0) -> bool:
+        """等待 insert 的唤醒通知, 最多等待 timeout 秒(默认 POLL_INTERVAL)
+
+        Returns:
+            bool: True 被唤醒, False 超时
+        """
+        if self._listener is None:
+            pathlib.Path(self.sock_fp).unlink(missing_ok=True)
+            self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._listener.bind(self.sock_fp)
+            self._listener.setblocking(False)
+        loop = asyncio.get_running_loop()
+        try:
+            await asyncio.wait_for(loop.sock_recv(self._listener, 16), timeout or self.poll_interval)
+        except asyncio.TimeoutError:
+            return False
+        # 合并积压的通知
+        try:
+            while self._listener.recv(16):
+                pass
+        except BlockingIOError:
+            pass
+        return True
     
     def existed(self, msgid:str) -> bool:
-        cmd = f"select content from data_list where msgid='{msgid}';"
-        r = self.execute(cmd)
+        r = self.execute(EXISTED_SQL, [msgid])
         log.debug(r)
         return bool(r)
 
+    async def _run(self, fn, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, functools.partial(fn, *args, **kwargs)
+        )
+
+    async def ainsert(self, data: dict) -> bool:
+        return await self._run(self.insert, data)
+
+    async def adelete(self, data: dict):
+        return await self._run(self.delete, data)
+
+    async def aclaim(self, limit: int = 10, exclude_users: list[str] | None = None) -> list:
+        return await self._run(self.claim, limit, exclude_users)
+
     def execute(self, cmd, args: list = []):
         # log.debug(f"{cmd=}, {args=}")
         if args:
@@ -91,7 +244,7 @@ def main():
     CFG()
     log.debug(CFG.C)
     db = DB()
-    db.insert2({'content': 'contenta', 'msgid': '12453'})
+    db.insert({'content': 'contenta', 'msgid': '12453'})
     pass
 
 
@@ -0,0 +1,45 @@
+import asyncio
+import time
+
+
+class RateLimiter:
+    """
+    Async token bucket, allows `rate` acquisitions per `period` seconds with bursts up to `rate`
+    """
+
+    def __init__(self, rate: float, period: float = 60) -> None:
+        self.capacity = rate
+        self.tokens = rate
+        self.fill_rate = rate / period
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _fill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+        self.updated = now
+
+    def delay(self, n: float = 1) -> float:
+        """Seconds until n tokens are available, 0 if they are now.
+        Requests larger than the bucket go through once it is full and leave a debt
+        """
+        self._fill()
+        return max(min(n, self.capacity) - self.tokens, 0) / self.fill_rate
+
+    def take(self, n: float = 1) -> None:
+        self.tokens -= n
+
+    async def acquire(self, n: float = 1) -> float:
+        """Wait until n tokens are available and take them
+
+        Returns:
+            float: seconds waited
+        """
+        waited = 0.0
+        # lock keeps waiters in FIFO order
+        async with self._lock:
+            while (delay := self.delay(n)) > 0:
+                await asyncio.sleep(delay)
+                waited += delay
+            self.take(n)
+        return waited
@@ -0,0 +1,114 @@
+import asyncio
+import collections
+import logging
+from typing import AsyncIterator, Awaitable, Callable, TypeVar
+
+log = logging.getLogger('app.singleflight')
+
+T = TypeVar('T')
+
+
+class Flight:
+    """
+    一次进行中的流式请求, 收到的内容保存在 chunks 中, 后加入的订阅者从头读取
+    """
+
+    def __init__(self) -> None:
+        self.chunks: list[str] = []
+        self.done = False
+        self.error: BaseException | None = None
+        self._changed = asyncio.Event()
+
+    def push(self, chunk: str) -> None:
+        self.chunks.append(chunk)
+        self._wake()
+
+    def finish(self, error: BaseException | None = None) -> None:
+        self.done = True
+        self.error = error
+        self._wake()
+
+    def _wake(self) -> None:
+        # 每次更新换一个新的 Event, 等待中的订阅者全部唤醒
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def subscribe(self) -> AsyncIterator[str]:
+        i = 0
+        while True:
+            while i < len(self.chunks):
+                yield self.chunks[i]
+                i += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self._changed.wait()
+
+
+class SingleFlight:
+    """
+    合并相同的并发请求: key 相同的请求同时只执行一个, 其他调用等待并共享结果
+        - call(key, factory): factory() 返回 awaitable, 所有调用得到同一个结果或异常
+        - stream(key, factory): factory() 返回异步迭代器, 内容分发给每个订阅者
+    上游请求在单独的 task 中执行, 调用者断开(取消)不影响其他调用者, 也不中断上游请求
+    """
+
+    def __init__(self) -> None:
+        self._calls: dict[str, asyncio.Future] = {}
+        self._streams: dict[str, Flight] = {}
+        # 保留上游 task 的引用, 避免执行中被回收
+        self._tasks: set[asyncio.Task] = set()
+        self.counter = collections.Counter()
+
+    def in_flight(self, key: str) -> bool:
+        """
+        key 相同的请求正在执行, 此时 call/stream 会加入该请求而不是发起新的请求
+        """
+        return key in self._calls or key in self._streams
+
+    async def call(self, key: str, factory: Callable[[], Awaitable[T]]) -> T:
+        future = self._calls.get(key)
+        if future is None:
+            future = self._calls[key] = asyncio.ensure_future(factory())
+            future.add_done_callback(lambda f: self._forget(self._calls, key, f, f))
+            self.counter['leaders'] += 1
+        else:
+            log.debug(f"Joined in-flight call {key[:8]}")
+            self.counter['followers'] += 1
+        return await asyncio.shield(future)
+
+    def stream(self, key: str, factory: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        flight = self._streams.get(key)
+        if flight is None:
+            flight = self._streams[key] = Flight()
+            task = asyncio.create_task(self._produce(flight, factory()))
+            self._tasks.add(task)
+            task.add_done_callback(lambda t: self._forget(self._streams, key, flight, t))
+            self.counter['leaders'] += 1
+        else:
+            log.debug(f"Joined in-flight stream {key[:8]}, {len(flight.chunks)} chunks received")
+            self.counter['followers'] += 1
+        return flight.subscribe()
+
+    async def _produce(self, flight: Flight, source: AsyncIterator[str]) -> None:
+        try:
+            async for chunk in source:
+                flight.push(chunk)
+        except BaseException as e:
+            flight.finish(e)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+        else:
+            flight.finish()
+
+    def _forget(self, flights: dict, key: str, flight: object, task: asyncio.Future) -> None:
+        if flights.get(key) is flight:
+            del flights[key]
+        self._tasks.discard(task)
+        # 所有调用者都已断开时, 异常没有被读取
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> dict:
+        return {**self.counter, 'in_flight': len(self._calls) + len(self._streams)}
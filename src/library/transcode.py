@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import pathlib
+import time
+from typing import AsyncIterator
+
+log = logging.getLogger('app.transcode')
+
+# 输出 16k 采样率、16 bit、单声道的 raw pcm, 即百度实时语音识别要求的格式
+PCM_ARGS = ('-t', 'raw', '-r', '{rate}', '-e', 'signed-integer', '-b', '16', '-c', '1')
+COMMANDS = {
+    'amr': ('ffmpeg', '-loglevel', 'error', '-f', 'amr', '-i', 'pipe:0',
+            '-f', 's16le', '-acodec', 'pcm_s16le', '-ac', '1', '-ar', '{rate}', 'pipe:1'),
+    'spx': ('sox', '-t', 'spx', '-', *PCM_ARGS, '-'),
+}
+# stdout 每次读取的字节数, 16k 16bit 下为 160ms
+READ_SIZE = 5120
+
+
+class TranscodeError(Exception):
+    pass
+
+
+async def reframe(chunks: AsyncIterator[bytes], frame_size: int = READ_SIZE) -> AsyncIterator[bytes]:
+    """把任意大小的数据块重新切分为 frame_size 字节的帧, 最后一帧可能不足 frame_size
+
+    Args:
+        chunks (AsyncIterator[bytes]): 例如 Transcoder.stream_to_pcm 的输出
+        frame_size (int): 默认 5120 字节, 即 16k 16bit 下 160ms
+    """
+    buf = bytearray()
+    async for chunk in chunks:
+        buf += chunk
+        if len(buf) < frame_size:
+            continue
+        end = len(buf) - len(buf) % frame_size
+        view = memoryview(buf)
+        for i in range(0, end, frame_size):
+            yield bytes(view[i: i + frame_size])
+        view.release()
+        del buf[:end]
+    if buf:
+        yield bytes(buf)
+
+
+async def tee_to_file(chunks: AsyncIterator[bytes], fp: pathlib.Path) -> AsyncIterator[bytes]:
+    """原样转发数据块, 同时写入 fp, 调试时保存中间数据
+    """
+    with fp.open('wb') as f:
+        async for chunk in chunks:
+            f.write(chunk)
+            yield chunk
+    log.debug(f"Saved {fp}")
+
+
+class Transcoder:
+    """
+    语音格式转换, ffmpeg/sox 子进程通过管道读写, 不落盘
+    最多 concurrency 个子进程同时运行, 每次转换记录耗时和实时率
+    """
+    _instance = None
+
+    def __init__(self, concurrency: int = 4, timeout: float = 30) -> None:
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.count = 0
+        self.seconds = 0.0
+        self.audio_seconds = 0.0
+
+    @classmethod
+    def get_instance(cls) -> 'Transcoder':
+        if cls._instance is None:
+            from library.utils import CFG
+            transcode_cfg: dict = CFG.C.get('TRANSCODE') or {}
+            cls._instance = cls(
+                concurrency= transcode_cfg.get('CONCURRENCY', 4),
+                timeout= transcode_cfg.get('TIMEOUT', 30),
+            )
+        return cls._instance
+
+    @staticmethod
+    def command(fmt: str, rate: int) -> list[str]:
+        if fmt not in COMMANDS:
+            raise TranscodeError(f"Unsupported audio format {fmt}")
+        return [arg.format(rate=rate) for arg in COMMANDS[fmt]]
+
+    async def stream_to_pcm(self, chunks: AsyncIterator[bytes], fmt: str = 'amr', rate: int = 16000) -> AsyncIterator[bytes]:
+        """边写入边转换, 输入读完之前就开始输出 pcm
+
+        Args:
+            chunks (AsyncIterator[bytes]): amr/spx 音频数据流, 例如下载中的 response body
+
+        Yields:
+            bytes: s16le 单声道 pcm, 每块最多 READ_SIZE 字节
+        """
+        async with self._semaphore:
+            started = time.perf_counter()
+            proc = await asyncio.create_subprocess_exec(
+                *self.command(fmt, rate),
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            size_in = 0
+
+            async def feed():
+                nonlocal size_in
+                try:
+                    async for chunk in chunks:
+                        size_in += len(chunk)
+                        proc.stdin.write(chunk)
+                        await proc.stdin.drain()
+                except (BrokenPipeError, ConnectionResetError) as e:
+                    # 转换程序提前退出, 不再读取输入
+                    raise TranscodeError(f"Transcoding {fmt} failed, input pipe closed: {e!r}") from e
+                finally:
+                    proc.stdin.close()
+
+            feeder = asyncio.create_task(feed())
+            stderr = asyncio.create_task(proc.stderr.read())
+            size_out = 0
+            try:
+                while pcm := await asyncio.wait_for(proc.stdout.read(READ_SIZE), self.timeout):
+                    size_out += len(pcm)
+                    yield pcm
+                await feeder
+                await asyncio.wait_for(proc.wait(), self.timeout)
+                err = await stderr
+            except BaseException:
+                # 出错或调用方提前停止读取
+                feeder.cancel()
+                stderr.cancel()
+                if proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+                raise
+            if proc.returncode != 0:
+                raise TranscodeError(f"Transcoding {fmt} failed, exit code = {proc.returncode}: {err.decode(errors='ignore')}")
+            self._record(fmt, size_in, size_out, rate, started)
+
+    def _record(self, fmt: str, size_in: int, size_out: int, rate: int, started: float) -> None:
+        elapsed = time.perf_counter() - started
+        audio_seconds = size_out / (rate * 2)
+        self.count += 1
+        self.seconds += elapsed
+        self.audio_seconds += audio_seconds
+        log.info(
+            f"Transcoded {fmt} {size_in} bytes -> pcm {size_out} bytes, {audio_seconds:.2f}s audio in {elapsed * 1000:.0f}ms, "
+            f"{audio_seconds / elapsed if elapsed else 0:.1f}x realtime, total {self.count} conversions avg {self.seconds / self.count * 1000:.0f}ms"
+        )
@@ -10,6 +10,8 @@ from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
 from AIGC.ChatGPT import Chatbot
+from AIGC.scheduler import Priority
+from AIGC.transport import Deadline
 from database import User, get_question_db, BaseQuestionDatabase, get_anwser_db, BaseAnwserDatabase
 from library.fastapi_users.message import Message
 from library.schemas import BaseQuestion
@@ -55,7 +57,11 @@ def get_aigc_router(current_active_user):
         Args:
             request (Request): _description_
             response (Response): _description_
+
+        Headers:
+            X-Request-Timeout: seconds the client waits for the answer, capped by ChatGPT.HTTP.DEADLINE
         """
+        deadline = Deadline.from_header(request.headers.get('X-Request-Timeout'), chat.timeouts.deadline)
         log.debug(f"data: {data}")
         log.debug(f"chat: {chat}")
         log.debug(f"Received request from {data.userName}")
@@ -83,12 +89,38 @@ def get_aigc_router(current_active_user):
         return StreamingResponse(
             chat.async_ask_stream(
                 prompt=data.content,
+                # one conversation per user, asks of different users never wait for each other
+                convo_id= str(user.id),
                 question_dict = question_dict,
-                anwser_db = anwser_db
+                anwser_db = anwser_db,
+                priority = Priority.WEB,
+                deadline = deadline,
             )
         )
 
 
+    @router.get("/stats")
+    async def chat_stats(
+        chat: Chatbot = Depends(get_chatbot),
+        user: User = Depends(current_active_user),
+    ):
+        """
+        Queue depth and wait times of OpenAI requests, endpoint health, answer cache and coalescing counters of this worker,
+        only for superusers
+        """
+        if not user.is_superuser:
+            log.error(f"User {user.email} requested stats, not superuser")
+            raise HTTPException(
+                status_code=403,
+                detail=Message.USER_NOT_SUPERUSER,
+            )
+        return {
+            'scheduler': chat.scheduler.stats(),
+            'endpoints': chat.endpoints.stats(),
+            'cache': chat.cache.stats() if chat.cache is not None else None,
+            'inflight': chat.inflight.stats() if chat.inflight is not None else None,
+        }
+
     @router.post("/test")
     @router.get("/test")
     async def test_status(request: Request, response: Response):
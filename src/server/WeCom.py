@@ -1,80 +1,33 @@
+import asyncio
 import json
 import logging
-import hashlib
-from base64 import b64decode
 # import xml.etree.cElementTree as et
 # import sys
 # import pathlib
 # sys.path.append(pathlib.Path(__file__).parent.parent.as_posix())
 
 from fastapi import Response, Request, status, APIRouter
-from Crypto.Cipher import AES
 
 from server.utils import aget, XMLParse
 from library.utils import CFG
 from library.db import DB
+from library.WeCom.crypto import WeComCrypto
+from settings import conf
 
 log = logging.getLogger('app.server')
 # app = FastAPI(root_path='/chat')
 router = APIRouter()
 
 
-def msg_valid(signature: str, *args) -> bool:
-    """Check if msg is valid
-
-    Args:
-        signature (str): msg_signature
-
-    Returns:
-        bool: True valid, False invalid
-    """
-    log.debug(args)
-    sorted_str = ''.join(sorted(args))
-    sha1 = hashlib.sha1()
-    sha1.update(sorted_str.encode('utf8'))
-    _signature = sha1.hexdigest()
-    # log.debug(f"{signature=}, {_signature=}")
-    return signature == _signature
-
-
-def format_b64text(b64text: str) -> str:
-    len_remain = 4 - (len(b64text) % 4)
-    if len_remain == 4:
-        return b64text
-    else:
-        return f"{b64text}{'='*len_remain}"
-    
-
-def msg_b64_decrypt(encryped_text_b64: str, encoding_aes_key: str) -> dict:
-    """msg decrypt
-
-
-    Args:
-        encryped_text_b64 (str): msg encrypted w/ aes key and then b64encoded
-        encoding_aes_key (str): b64 encoding aes key
+def decrypt_recvd_msg(encrypt: str) -> tuple[dict, dict]:
+    """解密 post body 中的 Encrypt 并提取消息内容
 
     Returns:
-        str: AES-256-CBC decrypted msg
+        tuple[dict, dict]: recvd_msg_dict, recvd_cont_dict
     """
-    encrypted_text = b64decode(encryped_text_b64)
-    aes_key = b64decode(format_b64text(encoding_aes_key))
-    iv = aes_key[:16]
-    # log.debug(f"{aes_key=}, {iv=}")
-
-    # decrypt
-    decr = AES.new(aes_key, AES.MODE_CBC, iv)
-    msg_bytes = decr.decrypt(encrypted_text)
-    # log.debug(f"Decrypted msg: {msg_bytes.decode()}")
-
-    _random = msg_bytes[:16].decode()
-    msg_len = int.from_bytes(msg_bytes[16:20], byteorder='big', signed=False)
-    msg = msg_bytes[20: 20+msg_len]
-    receiveid = msg_bytes[20+msg_len:].decode()
-    result = dict(random = _random, length = msg_len, message = msg, receiveid = receiveid)
-    # log.debug(f"{result=}")
-    return result
-
-# def msg_encrypt_b64(reply_msg: str, timestamp: str, nonce: str, )
+    recvd_msg_dict = WeComCrypto.get_instance().decrypt(encrypt)
+    recvd_cont_dict = XMLParse().extract_decrypted_msg(recvd_msg_dict['message'])
+    return recvd_msg_dict, recvd_cont_dict
 
 # 验证企业微信的URL有效性
 @router.get('/recvMsg')
@@ -83,9 +36,10 @@ async def recvWeComMsg(request: Request, response: Response, msg_signature: str
     log.debug(f"{msg_signature=}, {timestamp=}, {nonce=}, {echostr=}")   
 
     # 将加密后的字符串与 signature 进行比对
-    if msg_valid(msg_signature, CFG.C['WeCom']['Token'], timestamp, nonce, echostr):
+    crypto = WeComCrypto.get_instance()
+    if crypto.verify(msg_signature, timestamp, nonce, echostr):
         log.debug(f"msg valid")
-        msg_dict = msg_b64_decrypt(echostr, CFG.C['WeCom']['EncodingAESKey'])
+        msg_dict = crypto.decrypt(echostr)
 
         response.status_code = status.HTTP_200_OK
         return int(msg_dict['message'])
@@ -94,6 +48,16 @@ async def recvWeComMsg(request: Request, response: Response, msg_signature: str
         log.warning("Invalid signature")
         return "Invalid signature"
     
+def log_lost_msg(data: dict):
+    """
+    应答之后才完成的写入失败时, 企业微信不会再推送, 记录完整的消息以便补发
+    """
+    def callback(insert: asyncio.Future):
+        if insert.cancelled() or insert.exception() is None:
+            return
+        log.error(f"Msg {data['msgid']} acked but not stored: {data['recvd_cont_dict']}", exc_info= insert.exception())
+    return callback
+
 def reply_msg(msg: str):
     return f"您刚刚发送消息: {msg}"
     
@@ -153,29 +117,36 @@ async def post_recvWeComMsg(request: Request, response: Response, msg_signature:
 
     # log.debug(f"{to_user_name=}, {agent_id=}, {encrypt=}")
 
-    if msg_valid(msg_signature, CFG.C['WeCom']['Token'], timestamp, nonce, recvd_body['Encrypt']):
-        # encrypt 部分 解密后的dict
-        recvd_msg_dict = msg_b64_decrypt(recvd_body['Encrypt'], CFG.C['WeCom']['EncodingAESKey']) # type: ignore
-        # 提取 msg_dict 中的内容
-        recvd_cont_dict = xml_parse.extract_decrypted_msg(recvd_msg_dict['message'])
+    if WeComCrypto.get_instance().verify(msg_signature, timestamp, nonce, recvd_body['Encrypt']):
+        # encrypt 部分解密后的dict, 以及 msg_dict 中的内容
+        if len(recvd_body['Encrypt']) > conf.WECOM_OFFLOAD_DECRYPT_SIZE:
+            recvd_msg_dict, recvd_cont_dict = await asyncio.to_thread(decrypt_recvd_msg, recvd_body['Encrypt'])
+        else:
+            recvd_msg_dict, recvd_cont_dict = decrypt_recvd_msg(recvd_body['Encrypt'])
         response.status_code = status.HTTP_200_OK
         # if recvd_cont_dict['MsgType'] == 'voice':
         #     return ''
 
-        # 将消息塞入数据库，会有callback去消费消息
+        # 将消息塞入数据库，会有callback去消费消息, DB 在 server 启动时已创建
         db = DB()
-        # db.fetch()
-        if db.existed(msgid= recvd_cont_dict['MsgId']):
-            return 
-        db.insert(dict(
+        data = dict(
             content = recvd_cont_dict.get('Content', ''),
             nonce = nonce,
             timestamp = timestamp,
             recvd_cont_dict = json.dumps(recvd_cont_dict),
             receiveid = recvd_msg_dict['receiveid'],
             msgid = recvd_cont_dict['MsgId']
-        ))
-        db.existed(recvd_cont_dict['MsgId'])
+        )
+        # 企业微信超时未收到响应会重复推送, msgid 唯一索引负责去重
+        insert = asyncio.ensure_future(db.ainsert(data))
+        try:
+            # 数据库繁忙时先应答企业微信, 写入在后台继续完成
+            if not await asyncio.wait_for(asyncio.shield(insert), CFG.C['WeCom'].get('ACK_TIMEOUT', 3)):
+                log.debug(f"Duplicated msg {recvd_cont_dict['MsgId']}")
+                return
+        except asyncio.TimeoutError:
+            log.warning(f"Ack msg {recvd_cont_dict['MsgId']} before it is stored")
+            insert.add_done_callback(log_lost_msg(data))
 
         # rely_cont = reply_msg(recvd_cont_dict['Content'])
         # rply_cont_xml = xml_parse.generate(rely_cont, recvd_cont_dict)
@@ -10,10 +10,12 @@ from database import User, create_db_and_tables
 from server.Users.schemas import UserCreate, UserRead, UserUpdate
 from server.Users.users import bearer_jwt_backend, cookie_db_backend, current_active_user, fastapi_users
 from server.AIGC import get_aigc_router 
+from AIGC.ChatGPT import Chatbot
 from server.WeCom import router as wecom_router
 # from server.visit import get_visit_router
 from settings.log import get_log_config
 from library.utils import CFG
+from library.db import DB
 from library.fastapi_users.message import mk_json_res
 
 log = logging.getLogger('app')
@@ -89,6 +91,14 @@ async def authenticated_route(user: User = Depends(current_active_user)):
 async def on_startup():
     # Not needed if you setup a migration system like Alembic
     await create_db_and_tables()
+    # data_list 队列在启动时打开(建表、迁移), 不在第一个企业微信消息的请求中阻塞 event loop
+    DB()
+    # Keep one pooled connection to OpenAI for the whole app lifecycle
+    await Chatbot.get_instance().open_session()
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await Chatbot.get_instance().close_session()
 
 #@app.middleware("http")
 async def log_requests(request: Request, call_next):
@@ -39,7 +39,7 @@ FROM
     -- left join chat_handle_join ch ON m.handle_id = ch.handle_id
     left join chat c on cm.chat_id = c.rowid
 WHERE
-    m.date > {date}
+    m.date > ?
     and m.associated_message_type = 0
     and m.text is not null
     and m.text != ' '
@@ -51,6 +51,49 @@ MSG_KEYS = ("msg", "datetime", "raw_date", "sender_address", "group_name", "chat
 
 GET_LATEST_DATE = "SELECT date FROM message ORDER BY rowid DESC LIMIT 1;"
 
+# 按 rowid 增量读取, rowid 放在最后一列
+GET_MSGS_AFTER_ROWID = """
+SELECT 
+    m.text, 
+    datetime(m.date / 1000000000 + strftime('%s', '2001-01-01'), 'unixepoch', 'localtime') as date, 
+    m.date as raw_date,
+    (CASE m.is_from_me WHEN 1 THEN SUBSTR(m.account,3) ELSE h.id END) as sender_address,
+    c.display_name as group_name,
+    c.chat_identifier,
+    c.guid,
+    m.rowid
+FROM
+    message m 
+    left join handle h on m.handle_id = h.rowid
+    left join chat_message_join cm ON m.rowid = cm.message_id
+    left join chat c on cm.chat_id = c.rowid
+WHERE
+    m.rowid > ?
+    and m.associated_message_type = 0
+    and m.text is not null
+    and m.text != ' '
+ORDER BY 
+m.rowid ASC;
+"""
+GET_LATEST_ROWID = "SELECT IFNULL(MAX(rowid), 0) FROM message;"
+# --imsg_watch, chat.db 变化检测, 单位秒
+IMSG_WATCH_INTERVAL = 0.2  # 不支持 kqueue 时比较文件 stat 的间隔
+IMSG_WATCH_TIMEOUT = 30  # 没有收到文件事件时也会查询一次, 防止漏掉事件
+IMSG_WATCH_SETTLE = 0.05  # 写入停止后再查询, 事务提交之前新的 msg 不可见
+
+# Chatbot 会话, 每个 convo_id 一行 json, 见 library/convo_store.py
+CONVERSATION_TABLE = """CREATE TABLE IF NOT EXISTS conversation(
+    convo_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    updated_at REAL
+);"""
+# 多个 worker 进程共用会话时的租约, 见 ConversationStore.lock
+CONVERSATION_LOCK_TABLE = """CREATE TABLE IF NOT EXISTS conversation_lock(
+    convo_id TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires REAL NOT NULL
+);"""
+
 # start with
 MSG_FILTER = "Q: "
 CMD_FILTER = "C: "
@@ -70,6 +113,23 @@ SEND_IMSG2 = """tell application "Messages"
 end tell
 """
 SEND_IMSG = SEND_IMSG2
+# 一次 osascript 发送多条回复
+SEND_IMSG_BATCH = """tell application "Messages"
+    set errs to ""
+{sends}    return errs
+end tell
+"""
+# 单条发送失败不影响后续发送, 脚本返回每行一个失败的序号和原因
+SEND_IMSG_LINE = """    try
+        send "{msg}" to chat id "{guid}"
+    on error errMsg
+        set errs to errs & "{index}: " & errMsg & linefeed
+    end try
+"""
+IMSG_SEND_BATCH = 10
+
+# WeCom 回调: 超过该长度的密文在线程中解密, 避免阻塞 event loop
+WECOM_OFFLOAD_DECRYPT_SIZE = 4096
 
 # Baidu Voice API Const
 APP_ID = 31348808
@@ -88,6 +148,8 @@ HELP_MSG = """ChatGPT iMessage bot
         help, 显示帮助信息
         test, 测试程序是否存活
         token, 获取已使用的token数量
+        cache, 查看回答缓存和合并请求的统计
+        queue, 查看请求队列的长度、等待时间和各个 API 的状态
         enable_history, eh, 允许bot读取历史记录
         disable_history, dh, 禁止bot读取历史记录
         reset, 开启enable_history后使用该命令可以清空机器人记录的聊天记录
@@ -104,9 +166,24 @@ DATALIST_TABLE = """CREATE TABLE IF NOT EXISTS data_list (
     timestamp TEXT,
     recvd_cont_dict TEXT,
     receiveid TEXT,
-    msgid TEXT
+    msgid TEXT,
+    lease_until REAL DEFAULT 0,
+    retries INTEGER DEFAULT 0
 );
 """
+# data_list 作为队列新增的列，用于迁移旧的数据库
+DATALIST_QUEUE_COLUMNS = {
+    'lease_until': 'REAL DEFAULT 0',
+    'retries': 'INTEGER DEFAULT 0',
+}
+DATALIST_COLUMNS = ('content', 'nonce', 'timestamp', 'recvd_cont_dict', 'receiveid', 'msgid')
+DATALIST_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS idx_data_list_lease ON data_list(lease_until);",
+)
+# msgid 唯一, 重复推送的消息由 INSERT OR IGNORE 丢弃
+DATALIST_UNIQUE_MSGID = "CREATE UNIQUE INDEX IF NOT EXISTS uidx_data_list_msgid ON data_list(msgid);"
+# 创建唯一索引前清理旧数据库中重复的 msgid, 被删除的行由 trigger 归档
+DATALIST_DEDUP = "DELETE FROM data_list WHERE rowid NOT IN (SELECT MIN(rowid) FROM data_list GROUP BY msgid);"
 TRIGGER_TABLE = """CREATE TABLE IF NOT EXISTS consumed_data (
     content TEXT,
     nonce TEXT,
@@ -0,0 +1,83 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   imsg_chat_db.py
+@Desc    :   可重放的 chat.db 测试数据, 只包含 imsg 查询用到的表和列, 用于在 macOS 之外测试 iMessage 读取
+'''
+
+# here put the import lib
+import pathlib
+import sqlite3
+import threading
+import time
+import typing
+
+SCHEMA = """
+CREATE TABLE handle (ROWID INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT NOT NULL);
+CREATE TABLE chat (ROWID INTEGER PRIMARY KEY AUTOINCREMENT, guid TEXT UNIQUE NOT NULL, chat_identifier TEXT, display_name TEXT);
+CREATE TABLE message (
+    ROWID INTEGER PRIMARY KEY AUTOINCREMENT,
+    text TEXT,
+    handle_id INTEGER DEFAULT 0,
+    account TEXT,
+    date INTEGER,
+    is_from_me INTEGER DEFAULT 0,
+    associated_message_type INTEGER DEFAULT 0
+);
+CREATE TABLE chat_message_join (chat_id INTEGER, message_id INTEGER, PRIMARY KEY (chat_id, message_id));
+"""
+
+# 2001-01-01 之后的纳秒数
+APPLE_EPOCH = 978307200
+
+# (间隔秒数, 发送者, chat guid, 群名, 内容)
+MSGS = [
+    (0.05, '+8613800000001', 'iMessage;-;+8613800000001', '', 'Q: hello'),
+    (0.05, '+8613800000002', 'iMessage;+;chat100', 'group', 'Q: 你好'),
+    (0.05, '+8613800000001', 'iMessage;-;+8613800000001', '', 'not a question'),
+    (0.05, '+8613800000002', 'iMessage;+;chat100', 'group', 'C: reset'),
+]
+
+
+def create(db_fp: typing.Union[str, pathlib.Path], history: int = 3) -> pathlib.Path:
+    """
+    创建 WAL 模式的 chat.db, 并写入 history 条历史消息
+    """
+    db_fp = pathlib.Path(db_fp)
+    with sqlite3.connect(db_fp) as db:
+        db.execute("PRAGMA journal_mode=WAL;")
+        db.executescript(SCHEMA)
+        for i in range(history):
+            insert(db, '+8613800000000', 'iMessage;-;+8613800000000', '', f"history {i}")
+    return db_fp
+
+
+def insert(db: sqlite3.Connection, sender: str, guid: str, group_name: str, text: str) -> int:
+    row = db.execute("SELECT ROWID FROM handle WHERE id = ?", (sender, )).fetchone()
+    handle_id = row[0] if row else db.execute("INSERT INTO handle (id) VALUES (?)", (sender, )).lastrowid
+    db.execute(
+        "INSERT OR IGNORE INTO chat (guid, chat_identifier, display_name) VALUES (?, ?, ?)",
+        (guid, guid.split(';')[-1], group_name)
+    )
+    chat_id = db.execute("SELECT ROWID FROM chat WHERE guid = ?", (guid, )).fetchone()[0]
+    date = int((time.time() - APPLE_EPOCH) * 1e9)
+    rowid = db.execute(
+        "INSERT INTO message (text, handle_id, date) VALUES (?, ?, ?)", (text, handle_id, date)
+    ).lastrowid
+    db.execute("INSERT INTO chat_message_join (chat_id, message_id) VALUES (?, ?)", (chat_id, rowid))
+    db.commit()
+    return rowid
+
+
+def replay(db_fp: typing.Union[str, pathlib.Path], msgs: typing.List = MSGS) -> threading.Thread:
+    """
+    在后台线程中按间隔写入 msgs, 模拟 Messages.app 收到消息
+    """
+    def run():
+        with sqlite3.connect(db_fp) as db:
+            for delay, *msg in msgs:
+                time.sleep(delay)
+                insert(db, *msg)
+
+    thread = threading.Thread(target= run, daemon= True)
+    thread.start()
+    return thread
@@ -0,0 +1,106 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   test_answer_cache.py
+@Desc    :   AnswerCache 的精确匹配、相似问题匹配、向量的存储和淘汰、过期和内存上限
+'''
+
+# here put the import lib
+import asyncio
+import sys, pathlib
+sys.path.append(pathlib.Path(__file__).parent.parent.as_posix())
+
+from library.answer_cache import ENTRY_OVERHEAD, AnswerCache, normalize
+
+SCOPE = AnswerCache.make_scope('You are ChatGPT', {'model': 'gpt-3.5-turbo', 'temperature': 0.5})
+
+
+def test_exact_match():
+    cache = AnswerCache()
+    assert normalize(' 你好，  ChatGPT？ ') == normalize('你好, chatgpt?') == '你好, chatgpt'
+    lookup = cache.lookup('你好, ChatGPT?', SCOPE)
+    assert lookup.hit is None
+    cache.store(lookup, '你好!')
+    assert cache.lookup('你好，  chatgpt。', SCOPE).answer == '你好!'
+    # system prompt 或采样参数不同时不命中
+    other = AnswerCache.make_scope('You are ChatGPT', {'model': 'gpt-3.5-turbo', 'temperature': 1})
+    assert cache.lookup('你好, ChatGPT?', other).hit is None
+    stats = cache.stats()
+    assert stats['exact_hits'] == 1 and stats['misses'] == 2 and stats['hit_rate'] == 0.3333
+
+
+def test_ttl_and_memory_budget():
+    cache = AnswerCache(max_bytes= 3 * 300, ttl= 0)
+    lookup = cache.lookup('q', SCOPE)
+    cache.store(lookup, 'a')
+    assert cache.lookup('q', SCOPE).hit is None and cache.stats()['expired'] == 1
+
+    cache = AnswerCache(max_bytes= 3 * 300)
+    for i in range(4):
+        cache.store(cache.lookup(f"q{i}", SCOPE), 'a')
+        # q0 最近命中过, 淘汰 q1
+        cache.lookup('q0', SCOPE)
+    assert cache.stats()['evictions'] == 1 and cache.bytes <= cache.max_bytes
+    assert cache.lookup('q0', SCOPE).hit and cache.lookup('q1', SCOPE).hit is None
+
+
+def test_semantic_match():
+    vectors = {'天气怎么样': [1.0, 0.0], '今天天气如何': [0.99, 0.1], '讲个笑话': [0.0, 1.0]}
+
+    async def embed(text: str) -> list[float]:
+        if text == 'boom':
+            raise RuntimeError('boom')
+        return vectors[text]
+
+    async def main():
+        cache = AnswerCache(embed= embed, similarity= 0.95, replay_chunk= 2)
+        cache.store(await cache.alookup('天气怎么样', SCOPE), '晴天')
+        lookup = await cache.alookup('今天天气如何', SCOPE)
+        assert lookup.hit == 'semantic' and lookup.answer == '晴天'
+        assert (await cache.alookup('讲个笑话', SCOPE)).hit is None
+        assert (await cache.alookup('boom', SCOPE)).hit is None
+        assert [chunk async for chunk in cache.replay('12345')] == ['12', '34', '5']
+        stats = cache.stats()
+        assert stats['semantic_hits'] == 1 and stats['misses'] == 3 and stats['embed_errors'] == 1
+    asyncio.run(main())
+
+
+def test_semantic_vectors():
+    vectors = {f"q{i}": [float(i == j) for j in range(4)] for i in range(4)}
+
+    async def embed(text: str) -> list[float]:
+        return vectors[text]
+
+    async def main():
+        cache = AnswerCache(embed= embed, max_vectors= 3)
+        for i in range(3):
+            cache.store(await cache.alookup(f"q{i}", SCOPE), f"a{i}")
+        # 每个数 4 字节
+        assert cache.bytes == sum(len(f"q{i}") + 2 + ENTRY_OVERHEAD + 4 * 4 for i in range(3))
+        # 删除中间一行后, 最后一行移到空出的位置, 仍然对应原来的问题
+        cache._remove(AnswerCache.make_key('q1', SCOPE))
+        scope_vectors = cache._vectors[SCOPE]
+        assert len(scope_vectors.matrix) == 2 * 4 and scope_vectors.keys[1] == AnswerCache.make_key('q2', SCOPE)
+        assert (await cache.alookup('q2', SCOPE)).answer == 'a2'
+        assert (await cache.alookup('q1', SCOPE)).hit is None
+
+        # 超过 max_vectors 时淘汰最早写入的回答
+        cache.store(await cache.alookup('q1', SCOPE), 'a1')
+        cache.store(await cache.alookup('q3', SCOPE), 'a3')
+        assert len(scope_vectors) == 3 and cache.stats()['evictions'] == 1
+        assert cache.lookup('q0', SCOPE).hit is None and cache.lookup('q3', SCOPE).answer == 'a3'
+        # 清空 scope 后不保留空的 ScopeVectors
+        for i in range(1, 4):
+            cache._remove(AnswerCache.make_key(f"q{i}", SCOPE))
+        assert cache._vectors == {} and cache.bytes == 0
+    asyncio.run(main())
+
+
+def main():
+    test_exact_match()
+    test_ttl_and_memory_budget()
+    test_semantic_match()
+    test_semantic_vectors()
+
+
+if __name__ == '__main__':
+    main()
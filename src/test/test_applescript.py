@@ -0,0 +1,112 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   test_applescript.py
+@Desc    :   AppleScriptWorker 和常驻进程的行协议, 用 python 进程代替 osascript
+'''
+
+# here put the import lib
+import sys, pathlib
+import threading
+import time
+sys.path.append(pathlib.Path(__file__).parent.parent.as_posix())
+
+from library.applescript import UNKNOWN, AppleScriptWorker, PersistentTransport, Result
+
+# 与 HELPER_JXA 相同的协议: 脚本内容原样作为 out 返回, "fail" 返回错误, "exit" 退出进程, "hang" 不返回,
+# "slow" 分几次输出一行, "partial" 只输出半行
+FAKE_HELPER = """
+import json, sys, time
+for line in sys.stdin:
+    cmd = json.loads(line)
+    if cmd['script'] == 'exit':
+        sys.exit(1)
+    if cmd['script'] == 'hang':
+        time.sleep(10)
+    res = {'id': cmd['id'], 'code': 0, 'out': cmd['script'], 'err': ''}
+    if cmd['script'] == 'fail':
+        res.update(code=1, out='', err='Can’t get chat id')
+    out = json.dumps(res) + '\\n'
+    if cmd['script'] in ('slow', 'partial'):
+        for i in range(0, len(out) - 1, 10):
+            sys.stdout.write(out[i: min(i + 10, len(out) - 1)])
+            sys.stdout.flush()
+            time.sleep(0.05 if cmd['script'] == 'slow' else 0.2)
+        if cmd['script'] == 'partial':
+            time.sleep(10)
+    sys.stdout.write(out[-1] if cmd['script'] == 'slow' else out)
+    sys.stdout.flush()
+"""
+
+
+class FakeTransport:
+    def __init__(self) -> None:
+        self.scripts = []
+        self.threads = set()
+        self.closed = False
+
+    def run(self, script: str) -> Result:
+        self.scripts.append(script)
+        self.threads.add(threading.current_thread().name)
+        return Result(0, script.upper().encode(), b'')
+
+    def close(self) -> None:
+        self.closed = True
+
+
+def test_worker_reports_result_per_command():
+    transport = FakeTransport()
+    worker = AppleScriptWorker(transport)
+    futures = [worker.submit(f"send {i}") for i in range(20)]
+    assert [f.result().out for f in futures] == [f"SEND {i}" for i in range(20)]
+    worker.close()
+    # 所有命令在同一个线程中按提交顺序执行
+    assert transport.scripts == [f"send {i}" for i in range(20)]
+    assert transport.threads == {'applescript'} and transport.closed
+
+
+def test_persistent_transport_reuses_one_process():
+    transport = PersistentTransport([sys.executable, '-c', FAKE_HELPER], timeout= 0.5)
+    try:
+        r = transport.run('send "你好" to chat id "a"')
+        pid = transport.proc.pid
+        assert r.code == 0 and r.out == 'send "你好" to chat id "a"'
+        r = transport.run('fail')
+        assert r.code == 1 and r.err == 'Can’t get chat id'
+        assert transport.proc.pid == pid
+
+        # 命令写入后进程退出或超时, 不知道是否已经执行, 下一个命令重新启动进程
+        for script in ('exit', 'hang'):
+            r = transport.run(script)
+            assert r.code == UNKNOWN and transport.proc is None
+            assert transport.run('ok').out == 'ok' and transport.proc.pid != pid
+            pid = transport.proc.pid
+    finally:
+        transport.close()
+
+
+def test_persistent_transport_partial_lines():
+    transport = PersistentTransport([sys.executable, '-c', FAKE_HELPER], timeout= 0.5)
+    try:
+        # 分多次输出的一行拼接完整
+        r = transport.run('slow')
+        assert r.code == 0 and r.out == 'slow'
+        assert transport.run('ok').out == 'ok'
+
+        # 一直只有半行时, timeout 按整行计算, 不会因为不断有数据而一直等待
+        started = time.monotonic()
+        r = transport.run('partial')
+        assert r.code == UNKNOWN and transport.proc is None
+        assert time.monotonic() - started < 1
+        assert transport.run('ok').out == 'ok'
+    finally:
+        transport.close()
+
+
+def main():
+    test_worker_reports_result_per_command()
+    test_persistent_transport_reuses_one_process()
+    test_persistent_transport_partial_lines()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   test_audio.py
+@Desc    :   Audio.record_stream 的预分配缓冲区、静音检测提前结束和 record 返回的完整录音, 用假的输入流代替麦克风
+'''
+
+# here put the import lib
+import array
+import sys, pathlib
+sys.path.append(pathlib.Path(__file__).parent.parent.as_posix())
+
+import pyaudio
+
+from library.audio import Audio
+
+RATE = 1000
+CHUNK = 100
+LOUD = 1000
+
+
+class FakeStream:
+    """
+    按采样帧序号生成 16bit 单声道音频, loud(i) 为 True 的帧幅度为 LOUD, 其余为静音
+    """
+
+    def __init__(self, loud=lambda i: True) -> None:
+        self.loud = loud
+        self.pos = 0
+        self.reads = []
+        self.closed = False
+
+    def read(self, frames: int) -> bytes:
+        self.reads.append(frames)
+        samples = array.array('h', [LOUD if self.loud(self.pos + i) else 0 for i in range(frames)])
+        self.pos += frames
+        return samples.tobytes()
+
+    def stop_stream(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class FakePyAudio:
+    def terminate(self) -> None:
+        pass
+
+
+def make_audio(stream: FakeStream) -> Audio:
+    # 不打开声卡, 只保留录音需要的属性
+    audio = object.__new__(Audio)
+    audio.p = FakePyAudio()
+    audio.r_format = pyaudio.paInt16
+    audio.r_channel = 1
+    audio.r_rate = RATE
+    audio.r_chunk = CHUNK
+    audio.silence_threshold = 500
+    audio.silence_duration = 0.2
+    audio.get_record_stream = lambda: stream
+    return audio
+
+
+def run(gen) -> tuple[list[memoryview], memoryview]:
+    chunks = []
+    try:
+        while True:
+            chunks.append(next(gen))
+    except StopIteration as e:
+        return chunks, e.value
+
+
+def test_record_stream_fills_buffer():
+    stream = FakeStream()
+    chunks, data = run(make_audio(stream).record_stream(1))
+    # 按 duration 预分配, 每次最多读取 r_chunk 帧
+    assert stream.reads == [CHUNK] * 10 and stream.closed
+    assert len(data) == RATE * 2
+    # 输出的是同一个缓冲区的切片, 不复制数据
+    assert all(chunk.obj is data.obj for chunk in chunks)
+    assert b''.join(chunks) == data.tobytes()
+
+    # 最后一次只读取缓冲区剩余的帧
+    stream = FakeStream()
+    _, data = run(make_audio(stream).record_stream(0.25))
+    assert stream.reads == [CHUNK, CHUNK, 50] and len(data) == 250 * 2
+    assert run(make_audio(FakeStream()).record_stream(0)) == ([], memoryview(b''))
+
+
+def test_stop_on_silence():
+    audio = make_audio(FakeStream())
+    assert audio.is_silent(memoryview(bytes(20))) and not audio.is_silent(memoryview(array.array('h', [LOUD] * 10).tobytes()))
+
+    # 说话 0.3 秒后静音, 静音 silence_duration 秒后结束, 返回的录音只包含读取的帧
+    stream = FakeStream(lambda i: i < 300)
+    chunks, data = run(make_audio(stream).record_stream(1, stop_on_silence= True))
+    assert len(chunks) == 5 and len(data) == 500 * 2 and stream.closed
+    assert data.obj is chunks[0].obj and len(data.obj) == RATE * 2
+
+    # 开始说话之前的静音不计算
+    stream = FakeStream(lambda i: 300 <= i < 400)
+    _, data = run(make_audio(stream).record_stream(1, stop_on_silence= True))
+    assert len(data) == 600 * 2
+
+    # 不检测静音时录满 duration
+    _, data = run(make_audio(FakeStream(lambda i: i < 300)).record_stream(1))
+    assert len(data) == RATE * 2
+
+
+def test_record_returns_full_audio():
+    stream = FakeStream(lambda i: i % 3 == 0)
+    data = make_audio(stream).record(1)
+    expected = array.array('h', [LOUD if i % 3 == 0 else 0 for i in range(RATE)]).tobytes()
+    assert data.tobytes() == expected
+
+    stream = FakeStream(lambda i: i < 300)
+    data = make_audio(stream).record(1, stop_on_silence= True)
+    assert data.tobytes() == array.array('h', [LOUD] * 300 + [0] * 200).tobytes()
+
+
+def main():
+    test_record_stream_fills_buffer()
+    test_stop_on_silence()
+    test_record_returns_full_audio()
+
+
+if __name__ == '__main__':
+    main()
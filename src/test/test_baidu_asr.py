@@ -0,0 +1,138 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   test_baidu_asr.py
+@Desc    :   AsyncBaiDuASR against a local stand-in of the Baidu realtime asr websocket
+'''
+
+# here put the import lib
+import asyncio
+import json
+import time
+import sys, pathlib
+sys.path.append(pathlib.Path(__file__).parent.parent.as_posix())
+
+from aiohttp import web
+
+from library.baidu_api import AsyncBaiDuASR, BaiDuASRError, FramePacer
+
+FRAME = b'\x00' * 5120
+
+
+async def asr_handler(request: web.Request) -> web.WebSocketResponse:
+    """
+    收到的音频字节数作为识别结果, 每帧返回一个 MID_TEXT, FINISH 后返回 FIN_TEXT
+    音频以 b'err' 开头时返回错误
+    """
+    ws = web.WebSocketResponse()
+    await ws.prepare(request)
+    size = 0
+    async for msg in ws:
+        if msg.type == web.WSMsgType.BINARY:
+            if msg.data.startswith(b'err'):
+                await ws.send_json({'type': 'FIN_TEXT', 'err_no': -3001, 'err_msg': 'bad audio'})
+                break
+            size += len(msg.data)
+            await ws.send_json({'type': 'MID_TEXT', 'err_no': 0, 'result': str(size)})
+        elif json.loads(msg.data)['type'] == 'FINISH':
+            await asyncio.sleep(request.app['delay'])
+            await ws.send_json({'type': 'FIN_TEXT', 'err_no': 0, 'result': str(size)})
+            break
+    await ws.close()
+    return ws
+
+
+async def frames(n: int, data: bytes = FRAME):
+    for _ in range(n):
+        await asyncio.sleep(0)
+        yield data
+
+
+async def run_server(delay: float = 0) -> web.AppRunner:
+    app = web.Application()
+    app['delay'] = delay
+    app.router.add_get('/realtime_asr', asr_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', 0).start()
+    return runner
+
+
+def asr_uri(runner: web.AppRunner) -> str:
+    port = runner.addresses[0][1]
+    return f"ws://127.0.0.1:{port}/realtime_asr"
+
+
+def test_concurrent_recognitions():
+    async def main():
+        runner = await run_server(delay= 0.05)
+        asr = AsyncBaiDuASR(asr_uri(runner), concurrency= 3, speed= 0)
+        partials = []
+        try:
+            results = await asyncio.gather(*(
+                asr.recognize(frames(n), on_partial= partials.append) for n in range(1, 8)
+            ))
+        finally:
+            await asr.close_session()
+            await runner.cleanup()
+        assert results == [str(5120 * n) for n in range(1, 8)]
+        assert len(partials) == sum(range(1, 8))
+    asyncio.run(main())
+
+
+def test_error_and_timeout():
+    async def main():
+        runner = await run_server(delay= 1)
+        asr = AsyncBaiDuASR(asr_uri(runner), timeout= 0.3, speed= 0)
+        try:
+            for audio, error in ((frames(1, b'err'), 'bad audio'), (frames(1), 'timed out')):
+                try:
+                    await asr.recognize(audio)
+                except BaiDuASRError as e:
+                    assert error in str(e)
+                else:
+                    raise AssertionError(f"{error} not raised")
+            # 出错后 semaphore 已释放
+            assert asr._semaphore._value == asr.concurrency
+        finally:
+            await asr.close_session()
+            await runner.cleanup()
+    asyncio.run(main())
+
+
+def test_paced_upload():
+    async def main():
+        runner = await run_server()
+        try:
+            for speed in (1, 4):
+                # timeout 是空闲超时, 上传时间比 timeout 长也不会超时
+                asr = AsyncBaiDuASR(asr_uri(runner), timeout= 0.3, speed= speed)
+                # 不足一帧的数据块会合并为 160ms 的帧
+                started = time.monotonic()
+                assert await asr.recognize(frames(20, FRAME[:1280])) == str(1280 * 20)
+                elapsed = time.monotonic() - started
+                # 5 帧, 最后一帧不需要等待
+                assert 0.64 / speed <= elapsed < 0.64 / speed + 0.15, elapsed
+                await asr.close_session()
+        finally:
+            await runner.cleanup()
+    asyncio.run(main())
+
+
+def test_pacer_does_not_burst_after_lag():
+    pacer = FramePacer(speed= 1, max_lag= 0.1)
+    assert pacer.delay(5120) == 0
+    # 发送端被阻塞了 0.3s, 之后按当前时间重新计时
+    pacer.next_send -= 0.3
+    assert pacer.delay(5120) == 0 and pacer.lagged == 1
+    assert 0.15 < pacer.delay(5120) <= 0.16
+
+
+def main():
+    test_concurrent_recognitions()
+    test_error_and_timeout()
+    test_paced_upload()
+    test_pacer_does_not_burst_after_lag()
+
+
+if __name__ == '__main__':
+    main()
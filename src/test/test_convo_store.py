@@ -0,0 +1,297 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   test_convo_store.py
+@Desc    :   ConversationStore 的 LRU 淘汰写入、后台序列化和写入期间的读取、aload、refresh/commit、共享模式的租约和 close
+'''
+
+# here put the import lib
+import asyncio
+import sqlite3
+import tempfile
+import threading
+import sys, pathlib
+sys.path.append(pathlib.Path(__file__).parent.parent.as_posix())
+
+from library.convo_store import ConversationStore
+
+
+def stored(store: ConversationStore, convo_id: str) -> dict | None:
+    # 另开一个连接读取 sqlite 中实际写入的内容
+    other = ConversationStore(store.db_fp.as_posix())
+    try:
+        return other.get(convo_id)
+    finally:
+        other.close()
+
+
+def block_executor(store: ConversationStore) -> threading.Event:
+    """
+    占住后台写入线程, 返回的 event set 之后才开始写入
+    """
+    event = threading.Event()
+    store._executor.submit(event.wait, 5)
+    return event
+
+
+def drain(store: ConversationStore) -> None:
+    store._executor.submit(lambda: None).result()
+
+
+def test_evict_flushes_changes():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        store = ConversationStore(f"{tmp_dir}/convo.db", cache_size= 2, flush_interval= 60)
+        try:
+            for i in range(3):
+                store[f"c{i}"] = {'messages': [i]}
+            # c0 最久未访问, 淘汰时写入 sqlite
+            assert list(store._cache) == ['c1', 'c2']
+            drain(store)
+            assert stored(store, 'c0') == {'messages': [0]} and stored(store, 'c1') is None
+
+            # 访问过的会话移到末尾, 淘汰 c2; 被淘汰的会话修改后再淘汰会写入新内容
+            store['c0']['messages'].append('x')
+            store['c1']
+            assert list(store._cache) == ['c0', 'c1']
+            store['c3'] = {}
+            assert list(store._cache) == ['c1', 'c3']
+            drain(store)
+            assert stored(store, 'c0') == {'messages': [0, 'x']} and stored(store, 'c2') == {'messages': [2]}
+            assert sorted(store) == ['c0', 'c1', 'c2', 'c3'] and len(store) == 4
+        finally:
+            store.close()
+
+
+def test_reads_pending_writes():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        store = ConversationStore(f"{tmp_dir}/convo.db", cache_size= 1, flush_interval= 60)
+        try:
+            event = block_executor(store)
+            store['c0'] = {'messages': [0]}
+            store['c1'] = {'messages': [1]}
+            # c0 已淘汰但还没写入 sqlite, 读取等待写入的内容
+            assert 'c0' in store._pending and stored(store, 'c0') is None
+            assert 'c0' not in store._cache and store['c0'] == {'messages': [0]}
+            assert sorted(store) == ['c0', 'c1']
+
+            del store['c1']
+            assert 'c1' not in store._pending and 'c1' not in store
+            event.set()
+            drain(store)
+            assert store._pending == {}
+            assert stored(store, 'c0') == {'messages': [0]} and stored(store, 'c1') is None
+        finally:
+            store.close()
+
+
+def count_writes(store: ConversationStore) -> list[list[str]]:
+    """
+    记录每次写入 sqlite 的会话
+    """
+    writes = []
+    write = store._write
+    store._write = lambda rows: writes.append([row[0] for row in rows]) or write(rows)
+    return writes
+
+
+def test_flush_skips_unchanged():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        store = ConversationStore(f"{tmp_dir}/convo.db", flush_interval= 60)
+        try:
+            writes = count_writes(store)
+            store['c0'] = {'messages': []}
+            store.flush()
+            drain(store)
+            assert stored(store, 'c0') == {'messages': []} and store._touched == set()
+            assert writes == [['c0']]
+
+            # 只读访问, 内容没有变化时不写入
+            store['c0']
+            store.flush()
+            drain(store)
+            assert writes == [['c0']] and store._pending == {}
+
+            # 序列化在后台线程中进行, flush 只交出会话
+            event = block_executor(store)
+            store['c0']['messages'].append(1)
+            store.flush()
+            assert store._pending == {'c0': {'messages': [1]}} and store._pending['c0'] is store._cache['c0']
+            assert store._saved['c0'] == '{"messages": []}'
+            event.set()
+            drain(store)
+            assert writes == [['c0'], ['c0']] and store._pending == {}
+            assert store._saved['c0'] == '{"messages": [1]}' and stored(store, 'c0') == {'messages': [1]}
+            del store._write
+        finally:
+            store.close()
+
+
+def test_aload_off_loop():
+    async def main(store: ConversationStore):
+        threads = []
+        read = store._read
+        store._read = lambda convo_id: threads.append(threading.current_thread().name) or read(convo_id)
+        # 在后台线程中读取和解析, 之后的访问不再读 sqlite
+        assert await store.aload('c0') is True
+        assert store['c0'] == {'messages': [0]} and 'c0' in store
+        # 不存在的会话只读取一次
+        assert await store.aload('c1') is False
+        assert 'c1' not in store and store.get('c1') is None
+        assert len(threads) == 2 and all(name.startswith('app.convo_store') for name in threads)
+        # 新建之后正常访问
+        store['c1'] = {'messages': []}
+        assert await store.aload('c1') is True and store['c1'] == {'messages': []}
+        async with store.lock('c2'):
+            pass
+        assert len(threads) == 3
+        del store._read
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_fp = f"{tmp_dir}/convo.db"
+        other = ConversationStore(db_fp)
+        other['c0'] = {'messages': [0]}
+        other.close()
+        store = ConversationStore(db_fp)
+        try:
+            asyncio.run(main(store))
+        finally:
+            store.close()
+
+
+def test_refresh_and_commit():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_fp = f"{tmp_dir}/convo.db"
+        store1 = ConversationStore(db_fp, flush_interval= 60)
+        store2 = ConversationStore(db_fp, flush_interval= 60)
+        try:
+            store1['c0'] = {'messages': [1]}
+            # commit 在当前线程立即写入
+            store1.commit('c0')
+            assert store2['c0'] == {'messages': [1]}
+
+            store2['c0']['messages'].append(2)
+            store2.commit('c0')
+            # 没有 refresh 时读到的是内存中的旧内容
+            assert store1['c0'] == {'messages': [1]}
+            store1.refresh('c0')
+            assert store1['c0'] == {'messages': [1, 2]}
+
+            # refresh 之前先写入本进程未保存的修改
+            store1['c1'] = {'messages': []}
+            store1.refresh('c1')
+            drain(store1)
+            assert store2['c1'] == {'messages': []}
+        finally:
+            store1.close()
+            store2.close()
+
+
+def test_shared_lock():
+    async def main(store1: ConversationStore, store2: ConversationStore):
+        store1['c0'] = {'messages': []}
+        store1.commit('c0')
+        order = []
+
+        async def ask(store: ConversationStore, name: str):
+            async with store.lock('c0'):
+                # 持有租约期间其他进程不能进入, 进入时读到上一个持有者写入的内容
+                store['c0']['messages'].append(name)
+                order.append(name)
+                await asyncio.sleep(0.05)
+                assert store['c0']['messages'][-1] == name
+
+        await asyncio.gather(ask(store1, 'a'), ask(store2, 'b'), ask(store1, 'c'), ask(store2, 'd'))
+        store1.refresh('c0')
+        assert store1['c0']['messages'] == order and len(order) == 4
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_fp = f"{tmp_dir}/convo.db"
+        store1 = ConversationStore(db_fp, shared= True)
+        store2 = ConversationStore(db_fp, shared= True)
+        try:
+            asyncio.run(main(store1, store2))
+        finally:
+            store1.close()
+            store2.close()
+
+
+def test_shared_lock_off_loop():
+    async def main(store1: ConversationStore, store2: ConversationStore):
+        store1['c0'] = {'messages': []}
+        store1.commit('c0')
+        # 另一个连接占住写锁, 获取租约时 OperationalError 退避重试, 事件循环不被阻塞
+        other = sqlite3.connect(store1.db_fp.as_posix(), isolation_level= None)
+        other.execute("BEGIN IMMEDIATE;")
+        store1.conn.execute("PRAGMA busy_timeout = 10;")
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        async def ask():
+            async with store1.lock('c0'):
+                store1['c0']['messages'].append('a')
+
+        ticker_task = asyncio.create_task(ticker())
+        ask_task = asyncio.create_task(ask())
+        await asyncio.sleep(0.2)
+        assert not ask_task.done() and ticks >= 10
+        other.rollback()
+        other.close()
+        await asyncio.wait_for(ask_task, 2)
+        ticker_task.cancel()
+
+        # 同步调用方与其他进程的 lock 互斥, 进入时读到最新内容, 退出时写入
+        with store2.sync_lock('c0'):
+            assert store2['c0']['messages'] == ['a']
+            store2['c0']['messages'].append('b')
+        async with store1.lock('c0'):
+            assert store1['c0']['messages'] == ['a', 'b']
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_fp = f"{tmp_dir}/convo.db"
+        store1 = ConversationStore(db_fp, shared= True)
+        store2 = ConversationStore(db_fp, shared= True)
+        try:
+            asyncio.run(main(store1, store2))
+        finally:
+            store1.close()
+            store2.close()
+
+
+def test_close_writes_remaining():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_fp = f"{tmp_dir}/convo.db"
+        store = ConversationStore(db_fp, flush_interval= 60)
+        store['c0'] = {'messages': [0]}
+        store['c0']['messages'].append(1)
+        event = block_executor(store)
+        store['c1'] = {'messages': []}
+        store.flush()
+        store['c1']['messages'].append(1)
+        event.set()
+        # 等待后台写入, 之后的修改在当前线程写入
+        store.close()
+        store.close()
+        store = ConversationStore(db_fp)
+        try:
+            assert store['c0'] == {'messages': [0, 1]} and store['c1'] == {'messages': [1]}
+        finally:
+            store.close()
+
+
+def main():
+    test_evict_flushes_changes()
+    test_reads_pending_writes()
+    test_flush_skips_unchanged()
+    test_aload_off_loop()
+    test_refresh_and_commit()
+    test_shared_lock()
+    test_shared_lock_off_loop()
+    test_close_writes_remaining()
+
+
+if __name__ == '__main__':
+    main()
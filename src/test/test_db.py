@@ -0,0 +1,184 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   test_db.py
+@Desc    :   data_list 消息队列: 租约领取、过期重新领取、MAX_RETRIES 归档、msgid 去重迁移和不阻塞的唤醒通知
+'''
+
+# here put the import lib
+import asyncio
+import json
+import sqlite3
+import tempfile
+import threading
+import time
+import sys, pathlib
+sys.path.append(pathlib.Path(__file__).parent.parent.as_posix())
+
+from library.db import DB
+from library.utils import CFG
+
+
+def new_db(db_fp: pathlib.Path, visibility_timeout: float = 300, max_retries: int = 3) -> DB:
+    # DB 是单例, 每个测试使用自己的临时数据库
+    DB._DB__instance = None
+    DB._DB__initialized = False
+    CFG.C['DATA_DB_FP'] = db_fp.as_posix()
+    CFG.C['QUEUE'] = {'VISIBILITY_TIMEOUT': visibility_timeout, 'MAX_RETRIES': max_retries, 'POLL_INTERVAL': 0.2}
+    return DB()
+
+
+def msg(msgid: str, user: str = 'user1') -> dict:
+    return {
+        'content': f"content {msgid}",
+        'msgid': msgid,
+        'recvd_cont_dict': json.dumps({'MsgId': msgid, 'FromUserName': user}),
+    }
+
+
+def consumed(db: DB) -> list[str]:
+    return [row[0] for row in db.execute("SELECT msgid FROM consumed_data ORDER BY rowid;")]
+
+
+def test_insert_ignores_duplicates():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = new_db(pathlib.Path(tmp_dir) / 'data.db')
+        assert db.insert(msg('1')) is True
+        assert db.insert(msg('1')) is False
+        assert db.insert(msg('2')) is True
+        assert [row[5] for row in db.fetch()] == ['1', '2']
+        assert db.existed('1') and not db.existed('3')
+
+
+def test_claim_lease_and_reclaim():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = new_db(pathlib.Path(tmp_dir) / 'data.db', visibility_timeout= 0.2)
+        for msgid in '123':
+            db.insert(msg(msgid))
+        assert [row[5] for row in db.claim(2)] == ['1', '2']
+        # 已租用的消息不会再被领取
+        assert [row[5] for row in db.claim(5)] == ['3']
+        assert db.claim(5) == [] and db.claim(0) == []
+
+        # 归还后立即可以领取, 删除后不再出现并归档到 consumed_data
+        db.release('2')
+        db.delete({'msgid': '3'})
+        assert [row[5] for row in db.claim(5)] == ['2']
+        assert consumed(db) == ['3']
+
+        # 租约过期后重新领取
+        time.sleep(0.25)
+        assert [row[5] for row in db.claim(5)] == ['1', '2']
+        retries = dict(db.execute("SELECT msgid, retries FROM data_list;"))
+        assert retries == {'1': 2, '2': 3}
+
+
+def test_claim_archives_after_max_retries():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = new_db(pathlib.Path(tmp_dir) / 'data.db', visibility_timeout= 0.05, max_retries= 2)
+        db.insert(msg('1'))
+        for _ in range(2):
+            assert [row[5] for row in db.claim(5)] == ['1']
+            time.sleep(0.06)
+        # 领取 MAX_RETRIES 次仍未删除, 归档而不再领取
+        assert db.claim(5) == []
+        assert db.fetch() == [] and consumed(db) == ['1']
+
+
+def test_claim_excludes_users():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = new_db(pathlib.Path(tmp_dir) / 'data.db')
+        db.insert(msg('1', 'A'))
+        db.insert(msg('2', 'B'))
+        db.insert(msg('3', 'A'))
+        db.insert({'content': 'not json', 'msgid': '4', 'recvd_cont_dict': 'xml'})
+        assert [row[5] for row in db.claim(5, exclude_users= ['A'])] == ['2', '4']
+        assert [row[5] for row in db.claim(5)] == ['1', '3']
+
+
+def test_migrate_old_table():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_fp = pathlib.Path(tmp_dir) / 'data.db'
+        # 旧版本的表: 没有 lease_until/retries, msgid 不唯一
+        conn = sqlite3.connect(db_fp.as_posix())
+        conn.execute("CREATE TABLE data_list (content TEXT, nonce TEXT, timestamp TEXT, recvd_cont_dict TEXT, receiveid TEXT, msgid TEXT);")
+        conn.execute("CREATE INDEX idx_data_list_msgid ON data_list(msgid);")
+        conn.executemany("INSERT INTO data_list(content, msgid) VALUES(?, ?);", [('a', '1'), ('b', '1'), ('c', '2'), ('d', '1')])
+        conn.commit()
+        conn.close()
+
+        db = new_db(db_fp)
+        columns = {row[1] for row in db.execute("PRAGMA table_info(data_list);")}
+        assert {'lease_until', 'retries'} <= columns
+        indexes = {row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'index';")}
+        assert 'uidx_data_list_msgid' in indexes and 'idx_data_list_msgid' not in indexes
+        # 每个 msgid 保留最早的一条, 重复的归档
+        assert [(row[0], row[5]) for row in db.fetch()] == [('a', '1'), ('c', '2')]
+        assert consumed(db) == ['1', '1']
+        assert db.insert(msg('1')) is False
+        assert [row[5] for row in db.claim(5)] == ['1', '2']
+
+        # 再次初始化不会重复迁移
+        db = new_db(db_fp)
+        assert len(db.fetch()) == 2
+
+
+def test_notify_wakes_waiter():
+    async def main(db: DB):
+        started = time.monotonic()
+        # 没有通知时等待 POLL_INTERVAL 后超时
+        assert await db.wait() is False
+        assert time.monotonic() - started >= 0.15
+
+        waiter = asyncio.create_task(db.wait(timeout= 5))
+        await asyncio.sleep(0.05)
+        started = time.monotonic()
+        assert await db.ainsert(msg('1')) is True
+        assert await waiter is True and time.monotonic() - started < 1
+        # 积压的通知被合并, 下一次等待不会立即返回
+        db.notify()
+        db.notify()
+        assert await db.wait(timeout= 1) is True
+        assert await db.wait(timeout= 0.1) is False
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = new_db(pathlib.Path(tmp_dir) / 'data.db')
+        try:
+            asyncio.run(main(db))
+        finally:
+            if db._listener is not None:
+                db._listener.close()
+
+
+def test_notify_never_blocks():
+    async def main(db: DB):
+        # 绑定监听的 socket 后不再读取, 积压的通知超过队列长度
+        assert await db.wait(timeout= 0.01) is False
+        sender = threading.Thread(target= lambda: [db.notify() for _ in range(200)], daemon= True)
+        sender.start()
+        sender.join(timeout= 2)
+        assert not sender.is_alive()
+        # 写入不受影响, 积压的通知仍然唤醒消费者
+        assert await db.ainsert(msg('1')) is True
+        assert await db.wait(timeout= 1) is True
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = new_db(pathlib.Path(tmp_dir) / 'data.db')
+        try:
+            asyncio.run(main(db))
+        finally:
+            if db._listener is not None:
+                db._listener.close()
+
+
+def main():
+    test_insert_ignores_duplicates()
+    test_claim_lease_and_reclaim()
+    test_claim_archives_after_max_retries()
+    test_claim_excludes_users()
+    test_migrate_old_table()
+    test_notify_wakes_waiter()
+    test_notify_never_blocks()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   test_endpoints.py
+@Desc    :   EndpointPool 的选择、熔断和 x-ratelimit-* 响应头
+'''
+
+# here put the import lib
+import collections
+import time
+import sys, pathlib
+sys.path.append(pathlib.Path(__file__).parent.parent.as_posix())
+
+from AIGC.endpoints import CircuitBreaker, Endpoint, EndpointPool, key_fingerprint, parse_duration
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(failures= 2, reset_timeout= 0.05)
+    breaker.failure()
+    assert breaker.available()
+    breaker.failure()
+    assert breaker.state == 'open' and not breaker.available()
+    time.sleep(0.06)
+    # 半开时只放行一个探测请求, 失败后重新打开
+    assert breaker.state == 'half_open' and breaker.available()
+    breaker.attempt()
+    assert not breaker.available()
+    breaker.failure()
+    assert breaker.state == 'open'
+    time.sleep(0.06)
+    breaker.attempt()
+    breaker.success()
+    assert breaker.state == 'closed' and breaker.available()
+
+
+def test_pool_spreads_and_skips_unhealthy():
+    pool = EndpointPool([Endpoint(f"http://127.0.0.1:800{i}/v1", name= f"ep{i}") for i in range(3)])
+    assert pool.endpoints[0].chat_url == 'http://127.0.0.1:8000/v1/chat/completions'
+    counts = collections.Counter(pool.choose().name for _ in range(300))
+    assert set(counts) == {'ep0', 'ep1', 'ep2'}
+
+    # 慢的 endpoint 很少被选中, 熔断的不会被选中
+    pool.endpoints[0].latency = 10
+    pool.endpoints[1].breaker.open(60)
+    counts = collections.Counter(pool.choose().name for _ in range(300))
+    assert 'ep1' not in counts and counts['ep2'] > counts['ep0']
+
+    # 已经试过的 endpoint 只在没有其他可用时再用
+    assert pool.choose(exclude= {'ep2'}).name == 'ep0'
+    assert pool.has_other({'ep2'}) and not pool.has_other({'ep0', 'ep2'})
+    assert pool.choose(exclude= {'ep0', 'ep2'}).name in ('ep0', 'ep2')
+
+    # 全部熔断时探测最早恢复的
+    pool.endpoints[0].breaker.open(30)
+    pool.endpoints[2].breaker.open(10)
+    assert pool.choose().name == 'ep2'
+
+
+def test_rate_limit_headers():
+    assert parse_duration('6m0s') == 360 and parse_duration('20ms') == 0.02 and parse_duration('1.5') == 1.5
+    endpoint = Endpoint()
+    score = endpoint.score()
+    endpoint.success(1.0, {
+        'x-ratelimit-limit-requests': '3500', 'x-ratelimit-remaining-requests': '35',
+        'x-ratelimit-limit-tokens': '90000', 'x-ratelimit-remaining-tokens': '80000',
+    })
+    assert endpoint.score() > 50 * score
+    endpoint.success(1.0, {
+        'x-ratelimit-limit-requests': '3500', 'x-ratelimit-remaining-requests': '0',
+        'x-ratelimit-reset-requests': '1s',
+    })
+    assert not endpoint.breaker.available()
+    assert endpoint.stats()['remaining_requests'] == 0
+
+
+def test_pool_identity():
+    def pool(*endpoints: tuple) -> EndpointPool:
+        return EndpointPool([Endpoint(url, api_key= key, model= model, name= f"ep{i}") for i, (url, key, model) in enumerate(endpoints)])
+
+    a = pool(('http://a/v1', 'sk-1', ''), ('http://b/v1', 'sk-2', 'llama'))
+    # 与顺序和名字无关, 不包含 api key 本身
+    assert a.identity() == pool(('http://b/v1', 'sk-2', 'llama'), ('http://a/v1', 'sk-1', '')).identity()
+    assert 'sk-1' not in ' '.join(a.identity()) and key_fingerprint('sk-1') in a.identity()[0]
+    for other in (
+        pool(('http://a/v1', 'sk-3', ''), ('http://b/v1', 'sk-2', 'llama')),
+        pool(('http://a/v1', 'sk-1', ''), ('http://b/v1', 'sk-2', 'qwen')),
+        pool(('http://a/v1', 'sk-1', '')),
+    ):
+        assert other.identity() != a.identity()
+    assert key_fingerprint('') == '' and key_fingerprint('sk-1') != key_fingerprint('sk-2')
+
+
+def main():
+    test_circuit_breaker()
+    test_pool_spreads_and_skips_unhealthy()
+    test_rate_limit_headers()
+    test_pool_identity()
+
+
+if __name__ == '__main__':
+    main()
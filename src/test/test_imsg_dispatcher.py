@@ -0,0 +1,93 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   test_imsg_dispatcher.py
+@Desc    :   ImsgDispatcher 的并发、会话内顺序和批量发送, sender 替换为记录发送内容的函数
+'''
+
+# here put the import lib
+import asyncio
+import random
+import sys, pathlib
+sys.path.append(pathlib.Path(__file__).parent.parent.as_posix())
+
+from iMessage.dispatcher import ImsgDispatcher
+from iMessage.imsg import Message, send_imsgs
+from library import applescript
+
+
+def make_msg(guid: str, text: str) -> Message:
+    return Message((text, '', 0, f"{guid}@icloud.com", '', guid, guid))
+
+
+def test_concurrent_answers_keep_conversation_order():
+    async def main():
+        running = 0
+        max_running = 0
+        batches = []
+
+        async def answer(msg: Message) -> str:
+            nonlocal running, max_running
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(random.uniform(0, 0.02))
+            running -= 1
+            if msg.msg == 'skip':
+                return ''
+            if msg.msg == 'boom':
+                raise RuntimeError('boom')
+            return f"A: {msg.msg}"
+
+        dispatcher = ImsgDispatcher(answer, sender= batches.append, concurrency= 3)
+        for i in range(10):
+            for guid in ('a', 'b', 'c', 'd', 'e'):
+                dispatcher.submit(make_msg(guid, f"{guid}{i}"))
+        dispatcher.submit(make_msg('a', 'skip'))
+        dispatcher.submit(make_msg('a', 'boom'))
+        await dispatcher.close()
+
+        sent = [(msg_obj.guid, anwser) for batch in batches for msg_obj, anwser in batch]
+        assert max_running == 3
+        assert len(sent) == 51 and len(batches) < 51
+        for guid in ('b', 'c', 'd', 'e'):
+            assert [anwser for g, anwser in sent if g == guid] == [f"A: {guid}{i}" for i in range(10)]
+        # 出错时把错误信息作为回复, 空回复不发送
+        assert [anwser for g, anwser in sent if g == 'a'][-1] == 'boom'
+    asyncio.run(main())
+
+
+def test_send_imsgs_resends_only_failed(monkeypatch):
+    scripts = []
+
+    def run(script: str) -> applescript.Result:
+        scripts.append(script)
+        out = b'1: Can\xe2\x80\x99t get chat id "b".' if len(scripts) == 1 else b''
+        return applescript.Result(0, out, b'')
+
+    monkeypatch.setattr(applescript, 'run', run)
+    send_imsgs([(make_msg('a', 'q'), 'x "1"'), (make_msg('b', 'q'), 'y'), (make_msg('c', 'q'), '')])
+    assert len(scripts) == 2
+    assert scripts[0].count('send ') == 2 and 'x \\"1\\"' in scripts[0]
+    assert 'chat id "b"' in scripts[1] and 'send "y"' in scripts[1]
+
+
+def test_send_imsgs_no_resend_when_unknown(monkeypatch):
+    scripts = []
+
+    def run(script: str) -> applescript.Result:
+        scripts.append(script)
+        return applescript.Result(applescript.UNKNOWN, b'', b'AppleScript helper exited or timed out')
+
+    # 超时的脚本可能已经发送, 批量和单条都不重发, 也不发送错误信息
+    monkeypatch.setattr(applescript, 'run', run)
+    send_imsgs([(make_msg('a', 'q'), 'x'), (make_msg('b', 'q'), 'y')])
+    assert len(scripts) == 1 and scripts[0].count('send ') == 2
+    send_imsgs([(make_msg('a', 'q'), 'x')])
+    assert len(scripts) == 2 and 'send "x"' in scripts[1]
+
+
+def main():
+    test_concurrent_answers_keep_conversation_order()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   test_imsg_watch.py
+@Desc    :   --imsg_watch: chat.db 变化检测和按 rowid 增量读取, 使用 fixtures/imsg_chat_db.py 重放消息
+'''
+
+# here put the import lib
+import sys, pathlib
+import tempfile
+import time
+sys.path.append(pathlib.Path(__file__).parent.parent.as_posix())
+
+from iMessage.imsg import ChatDBWatcher, Imsg, Message
+from fixtures import imsg_chat_db
+
+
+def test_incremental_read_after_change():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_fp = imsg_chat_db.create(pathlib.Path(tmp_dir) / 'chat.db')
+        imsg = Imsg(db_fp= db_fp)
+        watcher = ChatDBWatcher(db_fp, interval= 0.01)
+        # 历史消息不会被读取
+        assert imsg.rowid == 3 and imsg.get_new_msgs() == []
+
+        thread = imsg_chat_db.replay(db_fp)
+        received = []
+        deadline = time.monotonic() + 5
+        while len(received) < len(imsg_chat_db.MSGS) and time.monotonic() < deadline:
+            if watcher.wait(timeout= 1):
+                received += [Message(msg) for msg in imsg.get_new_msgs()]
+        thread.join()
+        watcher.close()
+
+        assert [m.msg for m in received] == [msg[-1] for msg in imsg_chat_db.MSGS]
+        assert received[1].group_name == 'group' and received[1].guid == 'iMessage;+;chat100'
+        assert received[0].sender_address == '+8613800000001'
+        assert imsg.rowid == 3 + len(imsg_chat_db.MSGS)
+
+
+def test_wait_timeout():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_fp = imsg_chat_db.create(pathlib.Path(tmp_dir) / 'chat.db')
+        watcher = ChatDBWatcher(db_fp, interval= 0.01)
+        started = time.monotonic()
+        assert watcher.wait(timeout= 0.1) is False
+        assert time.monotonic() - started < 0.5
+        watcher.close()
+
+
+def main():
+    test_incremental_read_after_change()
+    test_wait_timeout()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   test_scheduler.py
+@Desc    :   RequestScheduler 的 rpm/tpm 限制、优先级和 Retry-After
+'''
+
+# here put the import lib
+import asyncio
+import time
+import sys, pathlib
+sys.path.append(pathlib.Path(__file__).parent.parent.as_posix())
+
+from AIGC.scheduler import Priority, RequestScheduler
+
+
+def test_priority_order_within_budget():
+    async def main():
+        # 每秒 20 个请求, 桶中最多 2 个
+        scheduler = RequestScheduler(rpm= 2, tpm= 0)
+        scheduler.requests.fill_rate = 20
+        order = []
+
+        async def request(name: str, priority: Priority) -> None:
+            await scheduler.acquire(100, priority)
+            order.append(name)
+
+        tasks = [asyncio.create_task(request(f"imsg{i}", Priority.IMSG)) for i in range(3)]
+        await asyncio.sleep(0)
+        tasks += [asyncio.create_task(request(f"wecom{i}", Priority.WECOM)) for i in range(2)]
+        tasks.append(asyncio.create_task(request('web', Priority.WEB)))
+        await asyncio.sleep(0)
+        stats = scheduler.stats()
+        assert stats['queued_imsg'] == 1 and stats['queued_wecom'] == 2 and stats['queued_web'] == 1
+        await asyncio.gather(*tasks)
+        # 前两个请求在桶内直接通过, 之后按优先级
+        assert order == ['imsg0', 'imsg1', 'web', 'wecom0', 'wecom1', 'imsg2']
+        stats = scheduler.stats()
+        assert stats['granted_imsg'] == 3 and stats['wait_max_imsg'] >= 0.15
+    asyncio.run(main())
+
+
+def test_token_budget_and_retry_after():
+    async def main():
+        scheduler = RequestScheduler(rpm= 0, tpm= 1000)
+        scheduler.tokens.fill_rate = 10000
+        assert await scheduler.acquire(1000) < 0.01
+        # 桶空了, 1000 个 token 需要等 0.1s
+        assert 0.08 < await scheduler.acquire(1000) < 0.15
+        scheduler.pause(0.2)
+        started = time.monotonic()
+        await scheduler.acquire(1, Priority.WEB)
+        assert time.monotonic() - started >= 0.19
+        assert scheduler.stats()['throttled'] == 1
+    asyncio.run(main())
+
+
+def test_cancelled_waiter_is_skipped():
+    async def main():
+        scheduler = RequestScheduler(rpm= 1, tpm= 0)
+        scheduler.requests.fill_rate = 10
+        await scheduler.acquire(1)
+        waiter = asyncio.create_task(scheduler.acquire(1, Priority.WEB))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        assert 0.05 < await scheduler.acquire(1) < 0.15
+        assert scheduler.stats()['queued_web'] == 0
+    asyncio.run(main())
+
+
+def test_estimate():
+    scheduler = RequestScheduler(completion_tokens= 300)
+    # max_tokens 是剩余的上下文, 只作为回复长度的上限
+    assert scheduler.estimate(120, 3878) == 420
+    assert scheduler.estimate(3900, 98) == 3998
+
+
+def main():
+    test_priority_order_within_budget()
+    test_token_budget_and_retry_after()
+    test_cancelled_waiter_is_skipped()
+    test_estimate()
+
+
+if __name__ == '__main__':
+    main()
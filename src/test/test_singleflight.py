@@ -0,0 +1,98 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   test_singleflight.py
+@Desc    :   SingleFlight 合并相同的并发请求, 流式内容分发给每个订阅者
+'''
+
+# here put the import lib
+import asyncio
+import sys, pathlib
+sys.path.append(pathlib.Path(__file__).parent.parent.as_posix())
+
+from library.singleflight import SingleFlight
+
+
+def test_call_shares_result():
+    async def main():
+        calls = []
+
+        async def completion(answer: str) -> str:
+            calls.append(answer)
+            await asyncio.sleep(0.05)
+            if answer == 'boom':
+                raise RuntimeError('boom')
+            return answer
+
+        flights = SingleFlight()
+        results = await asyncio.gather(
+            *(flights.call('q', lambda: completion('a')) for _ in range(5)),
+            *(flights.call('boom', lambda: completion('boom')) for _ in range(2)),
+            return_exceptions=True,
+        )
+        assert results[:5] == ['a'] * 5 and all(isinstance(r, RuntimeError) for r in results[5:])
+        assert calls == ['a', 'boom']
+        # 请求结束后不再合并
+        assert await flights.call('q', lambda: completion('b')) == 'b'
+        assert flights.stats() == {'leaders': 3, 'followers': 5, 'in_flight': 0}
+    asyncio.run(main())
+
+
+def test_stream_fan_out():
+    async def main():
+        started = 0
+
+        async def completion():
+            nonlocal started
+            started += 1
+            for chunk in ('Hel', 'lo ', 'there'):
+                await asyncio.sleep(0.02)
+                yield chunk
+
+        async def subscribe(delay: float) -> str:
+            await asyncio.sleep(delay)
+            return ''.join([chunk async for chunk in flights.stream('q', completion)])
+
+        async def disconnect() -> None:
+            # 第一个订阅者读到一段后断开, 不影响其他订阅者
+            async for _ in flights.stream('q', completion):
+                raise asyncio.CancelledError
+
+        flights = SingleFlight()
+        first = asyncio.create_task(disconnect())
+        # 后加入的订阅者也收到完整内容
+        results = await asyncio.gather(subscribe(0), subscribe(0.03), subscribe(0.05))
+        assert results == ['Hello there'] * 3 and started == 1
+        assert first.cancelled()
+        assert flights.stats() == {'leaders': 1, 'followers': 3, 'in_flight': 0}
+    asyncio.run(main())
+
+
+def test_stream_error_reaches_every_subscriber():
+    async def main():
+        async def completion():
+            yield 'partial'
+            await asyncio.sleep(0.01)
+            raise ConnectionError('reset')
+
+        async def subscribe() -> list:
+            chunks = []
+            try:
+                async for chunk in flights.stream('q', completion):
+                    chunks.append(chunk)
+            except ConnectionError as e:
+                chunks.append(str(e))
+            return chunks
+
+        flights = SingleFlight()
+        assert await asyncio.gather(subscribe(), subscribe()) == [['partial', 'reset']] * 2
+    asyncio.run(main())
+
+
+def main():
+    test_call_shares_result()
+    test_stream_fan_out()
+    test_stream_error_reaches_every_subscriber()
+
+
+if __name__ == '__main__':
+    main()
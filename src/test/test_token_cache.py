@@ -0,0 +1,170 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   test_token_cache.py
+@Desc    :   Chatbot 会话中缓存的 tokens/token_count 与重新计算的结果一致, 限流时的 token 估算使用缓存,
+             不使用历史的提问不修改会话
+'''
+
+# here put the import lib
+import sys, pathlib
+import tempfile
+sys.path.append(pathlib.Path(__file__).parent.parent.as_posix())
+
+from AIGC.ChatGPT import Chatbot
+from AIGC.scheduler import RequestScheduler
+from library.convo_store import ConversationStore
+import exceptions
+
+
+def make_bot(db_fp: pathlib.Path) -> Chatbot:
+    # 不经过单例和配置文件, 只保留计算 token 需要的属性
+    bot = object.__new__(Chatbot)
+    bot.engine = 'gpt-3.5-turbo'
+    bot.system_prompt = 'You are a helpful assistant'
+    bot.max_tokens = 4000
+    bot.conversation = ConversationStore(db_fp)
+    return bot
+
+
+def fresh_count(bot: Chatbot, convo_id: str) -> int:
+    return sum(bot._count_message_tokens(message) for message in bot.conversation[convo_id]['history'])
+
+
+def assert_cache_matches(bot: Chatbot, convo_id: str) -> None:
+    convo = bot.conversation[convo_id]
+    assert len(convo['tokens']) == len(convo['history'])
+    assert convo['tokens'] == [bot._count_message_tokens(message) for message in convo['history']]
+    assert convo['token_count'] == fresh_count(bot, convo_id)
+    assert bot.get_token_count(convo_id) == fresh_count(bot, convo_id) + 2
+
+
+def test_add_rollback_reset():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bot = make_bot(pathlib.Path(tmp_dir) / 'conversation.db')
+        bot.new_user('u1')
+        bot.conversation['u1']['use_history'] = True
+        assert_cache_matches(bot, 'u1')
+
+        for i in range(5):
+            bot.add_to_conversation(f"question {i} about something", 'user', convo_id= 'u1')
+            bot.add_to_conversation(f"answer {i} " * (i + 1), 'assistant', convo_id= 'u1')
+            assert_cache_matches(bot, 'u1')
+
+        bot.rollback(3, convo_id= 'u1')
+        assert len(bot.conversation['u1']['history']) == 8
+        assert_cache_matches(bot, 'u1')
+
+        bot.reset('u1', system_prompt= 'Another system prompt')
+        assert len(bot.conversation['u1']['history']) == 1
+        assert_cache_matches(bot, 'u1')
+
+        # 不使用历史时每次提问都重置会话
+        bot.conversation['u1']['use_history'] = False
+        bot.add_to_conversation('only question', 'user', convo_id= 'u1')
+        assert len(bot.conversation['u1']['history']) == 2
+        assert_cache_matches(bot, 'u1')
+        bot.conversation.close()
+
+
+def test_truncate_and_stale_cache():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bot = make_bot(pathlib.Path(tmp_dir) / 'conversation.db')
+        bot.new_user('u2')
+        bot.conversation['u2']['use_history'] = True
+        bot.max_tokens = 60
+        for i in range(10):
+            bot.add_to_conversation(f"message number {i} " * 3, 'user', convo_id= 'u2')
+            bot._Chatbot__truncate_conversation(convo_id= 'u2')
+            assert_cache_matches(bot, 'u2')
+        assert bot.get_token_count('u2') <= bot.max_tokens
+        assert bot.conversation['u2']['history'][0]['role'] == 'system'
+
+        # 旧版本写入的会话没有 tokens, 第一次使用时重建
+        convo = bot.conversation['u2']
+        del convo['tokens']
+        convo['token_count'] = 0
+        assert bot.get_token_count('u2') == fresh_count(bot, 'u2') + 2
+        assert_cache_matches(bot, 'u2')
+        bot.conversation.close()
+
+
+def test_estimate_uses_cached_count():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bot = make_bot(pathlib.Path(tmp_dir) / 'conversation.db')
+        bot.scheduler = RequestScheduler(completion_tokens= 500)
+        bot.new_user('u3')
+        bot.conversation['u3']['use_history'] = True
+        bot.add_to_conversation('a question ' * 20, 'user', convo_id= 'u3')
+
+        # 带历史的提问只计算新问题的 token, 其余使用缓存
+        counted = []
+        count = bot._count_message_tokens
+        bot._count_message_tokens = lambda message: counted.append(message) or count(message)
+        messages, prompt_tokens = bot._ask_messages('another question', 'u3')
+        assert counted == [{'role': 'user', 'content': 'another question'}]
+        del bot._count_message_tokens
+        assert messages == bot.conversation['u3']['history'] and messages is not bot.conversation['u3']['history']
+        assert prompt_tokens == fresh_count(bot, 'u3') + 2
+
+        payload = {'messages': messages, 'max_tokens': bot.max_tokens - prompt_tokens}
+        assert bot._estimate_tokens(prompt_tokens, payload) == prompt_tokens + 500
+        # 剩余的上下文不足时最多按 max_tokens 计算
+        payload['max_tokens'] = 100
+        assert bot._estimate_tokens(prompt_tokens, payload) == prompt_tokens + 100
+        bot.conversation.close()
+
+
+def test_history_free_messages():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bot = make_bot(pathlib.Path(tmp_dir) / 'conversation.db')
+        bot.new_user('u4', system_prompt= 'Be brief')
+        history = [dict(message) for message in bot.conversation['u4']['history']]
+
+        # 不使用历史时只发送系统提示和问题, 会话不变, 同一会话的提问可以同时进行
+        first, first_tokens = bot._ask_messages('first question', 'u4')
+        second, _ = bot._ask_messages('second question', 'u4')
+        assert first == [history[0], {'role': 'user', 'content': 'first question'}]
+        assert second[-1]['content'] == 'second question'
+        assert bot.conversation['u4']['history'] == history
+        assert first_tokens == sum(bot._count_message_tokens(message) for message in first) + 2
+        # 新用户在第一次提问时创建
+        messages, _ = bot._ask_messages('hello', 'u5')
+        assert messages[0]['content'] == bot.system_prompt and 'u5' in bot.conversation
+        bot.conversation.close()
+
+
+def test_rollback_failed_prompt():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bot = make_bot(pathlib.Path(tmp_dir) / 'conversation.db')
+        bot.new_user('u6')
+        bot.conversation['u6']['use_history'] = True
+        bot.add_to_conversation('first question', 'user', convo_id= 'u6')
+        bot.add_to_conversation('first answer', 'assistant', convo_id= 'u6')
+        history = list(bot.conversation['u6']['history'])
+
+        # 请求失败后去掉问题, 重新提问不会重复发送
+        messages, _ = bot._ask_messages('second question', 'u6')
+        bot._rollback_prompt('u6', messages)
+        assert bot.conversation['u6']['history'] == history
+        assert_cache_matches(bot, 'u6')
+        # 不使用历史的提问没有写入会话, 不回滚
+        bot.conversation['u6']['use_history'] = False
+        messages, _ = bot._ask_messages('third question', 'u6')
+        bot._rollback_prompt('u6', messages)
+        assert bot.conversation['u6']['history'] == history
+
+        assert Chatbot._error_answer(exceptions.ModelOverloaded('That model is currently overloaded')) == 'That model is currently overloaded'
+        assert Chatbot._error_answer(exceptions.UpstreamTimeout('timed out')) == 'Error: timed out'
+        bot.conversation.close()
+
+
+def main():
+    test_add_rollback_reset()
+    test_truncate_and_stale_cache()
+    test_estimate_uses_cached_count()
+    test_history_free_messages()
+    test_rollback_failed_prompt()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   test_transcode.py
+@Desc    :   reframe 重新分帧, tee_to_file 转存, Transcoder.stream_to_pcm 的管道输出、失败退出码、输入管道关闭、超时和统计
+'''
+
+# here put the import lib
+import asyncio
+import tempfile
+import sys, pathlib
+sys.path.append(pathlib.Path(__file__).parent.parent.as_posix())
+
+from library import transcode
+from library.transcode import Transcoder, TranscodeError, reframe, tee_to_file
+
+# 测试环境不一定装有 ffmpeg/sox, 用 shell 命令代替转换程序
+transcode.COMMANDS.update({
+    'copy': ('cat',),
+    'broken': ('sh', '-c', 'cat >/dev/null; echo bad input >&2; exit 3'),
+    'slow': ('sleep', '5'),
+    'closed': ('sh', '-c', 'exec 0<&-; sleep 0.1'),
+})
+
+
+async def agen(chunks: list[bytes], delay: float = 0):
+    for chunk in chunks:
+        if delay:
+            await asyncio.sleep(delay)
+        yield chunk
+
+
+async def collect(chunks) -> list[bytes]:
+    return [chunk async for chunk in chunks]
+
+
+def test_reframe():
+    async def main():
+        assert await collect(reframe(agen([]), 4)) == []
+        # 跨块拼接, 一块包含多帧, 最后一帧不足 frame_size
+        frames = await collect(reframe(agen([b'ab', b'cdefghij', b'', b'k']), 4))
+        assert frames == [b'abcd', b'efgh', b'ijk']
+        frames = await collect(reframe(agen([b'abcd', b'efgh']), 4))
+        assert frames == [b'abcd', b'efgh']
+    asyncio.run(main())
+
+
+def test_tee_to_file():
+    async def main(fp: pathlib.Path):
+        chunks = await collect(tee_to_file(agen([b'ab', b'cd']), fp))
+        assert chunks == [b'ab', b'cd'] and fp.read_bytes() == b'abcd'
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        asyncio.run(main(pathlib.Path(tmp_dir) / 'voice.pcm'))
+
+
+def test_command():
+    assert Transcoder.command('amr', 8000)[-2] == '8000'
+    assert '16000' in Transcoder.command('spx', 16000)
+    try:
+        Transcoder.command('mp3', 16000)
+        assert False
+    except TranscodeError:
+        pass
+
+
+def test_stream_to_pcm():
+    async def main():
+        transcoder = Transcoder(concurrency= 2, timeout= 2)
+        # 数据边写入边输出, 大于管道缓冲区的输入也不会死锁
+        data = [bytes([i]) * 30000 for i in range(10)]
+        pcm = await collect(transcoder.stream_to_pcm(agen(data, 0.001), 'copy'))
+        assert b''.join(pcm) == b''.join(data)
+        assert all(len(chunk) <= transcode.READ_SIZE for chunk in pcm)
+        assert transcoder.count == 1 and transcoder.audio_seconds == 300000 / 32000
+
+        try:
+            await collect(transcoder.stream_to_pcm(agen([b'x' * 100]), 'broken'))
+            assert False
+        except TranscodeError as e:
+            assert 'exit code = 3' in str(e) and 'bad input' in str(e)
+
+        # 转换程序不读取输入就退出, 写入管道出错也是 TranscodeError
+        try:
+            await collect(transcoder.stream_to_pcm(agen([b'x' * 100000] * 10, 0.01), 'closed'))
+            assert False
+        except TranscodeError as e:
+            assert 'input pipe closed' in str(e)
+
+        transcoder.timeout = 0.2
+        try:
+            await collect(transcoder.stream_to_pcm(agen([b'x']), 'slow'))
+            assert False
+        except asyncio.TimeoutError:
+            pass
+        # 失败的转换不计入统计, 子进程结束后释放并发名额
+        assert transcoder.count == 1 and not transcoder._semaphore.locked()
+        assert transcoder._semaphore._value == 2
+    asyncio.run(main())
+
+
+def main():
+    test_reframe()
+    test_tee_to_file()
+    test_command()
+    test_stream_to_pcm()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   test_transport.py
+@Desc    :   退避时间、请求 deadline、流式响应的首字节/空闲超时和合并请求的订阅者 deadline
+'''
+
+# here put the import lib
+import asyncio
+import time
+import sys, pathlib
+sys.path.append(pathlib.Path(__file__).parent.parent.as_posix())
+
+from aiohttp import web
+import aiohttp
+
+from AIGC.transport import Backoff, Deadline, first_within, iter_lines
+from library.singleflight import SingleFlight
+import exceptions
+
+
+def test_backoff():
+    backoff = Backoff(max_attempts= 3, base= 0.5, cap= 4)
+    for attempt in range(6):
+        expected = min(4, 0.5 * 2 ** attempt)
+        delays = [backoff.delay(attempt) for _ in range(50)]
+        # 抖动在 0.5 ~ 1.5 倍之间, 且不是固定值
+        assert all(0.5 * expected <= d <= 1.5 * expected for d in delays)
+        assert len(set(delays)) > 1
+    # 有 Retry-After 时直接使用
+    assert backoff.delay(5, '2') == 2 and backoff.delay(0, 'soon') <= 0.75
+    assert Backoff(max_attempts= 0).max_attempts == 1
+
+
+def test_deadline():
+    async def main():
+        deadline = Deadline(0.1)
+        assert await deadline.run(asyncio.sleep(0.01, 'ok')) == 'ok'
+        # 单次超时先到时是 TimeoutError, 可以重试
+        try:
+            await deadline.run(asyncio.sleep(1), 0.02)
+            assert False
+        except asyncio.TimeoutError:
+            pass
+        assert deadline.allows(0.01) and not deadline.allows(1)
+        # deadline 先到时不再重试
+        try:
+            await deadline.run(asyncio.sleep(1), 10)
+            assert False
+        except exceptions.DeadlineExceeded:
+            pass
+        assert deadline.expired
+        try:
+            await deadline.run(asyncio.sleep(0))
+            assert False
+        except exceptions.DeadlineExceeded:
+            pass
+
+        assert Deadline().remaining() is None and Deadline().allows(3600)
+        assert Deadline.from_header('5', 120).remaining() <= 5
+        assert 100 < Deadline.from_header('600', 120).remaining() <= 120
+        assert 100 < Deadline.from_header('abc', 120).remaining() <= 120
+        assert 100 < Deadline.from_header('0', 120).remaining() <= 120
+    asyncio.run(main())
+
+
+def test_iter_lines_timeouts():
+    async def handler(request: web.Request) -> web.StreamResponse:
+        response = web.StreamResponse()
+        await response.prepare(request)
+        await asyncio.sleep(float(request.query['first']))
+        await response.write(b'data: 1\n\n')
+        await asyncio.sleep(float(request.query['idle']))
+        await response.write(b'data: 2\n\n')
+        return response
+
+    async def read(ss: aiohttp.ClientSession, url: str, first: float, idle: float, deadline: float = 10) -> list[bytes]:
+        lines = []
+        async with ss.get(url, params= {'first': first, 'idle': idle}) as response:
+            # 与 Chatbot._post 相同, deadline 只限制第一行
+            first_line = await Deadline(deadline).run(response.content.readline(), 0.1)
+            async for line in iter_lines(response.content, idle= 0.1, first= first_line):
+                if line.strip():
+                    lines.append(line.strip())
+        return lines
+
+    async def main():
+        app = web.Application()
+        app.router.add_get('/', handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        url = f"http://127.0.0.1:{port}/"
+        try:
+            async with aiohttp.ClientSession() as ss:
+                assert await read(ss, url, 0, 0) == [b'data: 1', b'data: 2']
+                # 第一行超时
+                started = time.monotonic()
+                try:
+                    await read(ss, url, 1, 0)
+                    assert False
+                except asyncio.TimeoutError:
+                    assert time.monotonic() - started < 0.5
+                # 收到第一行后卡住
+                try:
+                    await read(ss, url, 0, 1)
+                    assert False
+                except asyncio.TimeoutError:
+                    pass
+                # 第一行之前 deadline 比首字节超时先到
+                try:
+                    await read(ss, url, 0.08, 0, deadline= 0.05)
+                    assert False
+                except exceptions.DeadlineExceeded:
+                    pass
+                # 开始回答后 deadline 不再截断
+                assert await read(ss, url, 0.05, 0.05, deadline= 0.08) == [b'data: 1', b'data: 2']
+        finally:
+            await runner.cleanup()
+    asyncio.run(main())
+
+
+def test_first_within():
+    async def main():
+        async def produce(delay: float):
+            await asyncio.sleep(delay)
+            for chunk in 'abc':
+                yield chunk
+                await asyncio.sleep(0.05)
+
+        flights = SingleFlight()
+
+        async def ask(deadline: Deadline) -> str:
+            source = first_within(flights.stream('q', lambda: produce(0.2)), deadline)
+            return ''.join([chunk async for chunk in source])
+
+        leader = asyncio.create_task(ask(Deadline(5)))
+        await asyncio.sleep(0.01)
+        # 加入的请求只等待自己的 deadline, 超时不影响其他订阅者和上游请求
+        started = time.monotonic()
+        try:
+            await ask(Deadline(0.05))
+            assert False
+        except exceptions.DeadlineExceeded:
+            pass
+        assert time.monotonic() - started < 0.15
+        # 第一块之后不再受 deadline 限制
+        assert await ask(Deadline(0.3)) == 'abc'
+        assert await leader == 'abc'
+        assert [c async for c in first_within(produce(0), Deadline(0.01))] == ['a', 'b', 'c']
+
+        async def empty():
+            return
+            yield
+        assert [c async for c in first_within(empty(), Deadline(1))] == []
+    asyncio.run(main())
+
+
+def main():
+    test_backoff()
+    test_deadline()
+    test_iter_lines_timeouts()
+    test_first_within()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   test_wecom_client.py
+@Desc    :   split_text 的 utf-8 字节分段, WeComClient.send 的重试、退避、token 刷新和成员限流器回收
+'''
+
+# here put the import lib
+import asyncio
+import time
+import sys, pathlib
+sys.path.append(pathlib.Path(__file__).parent.parent.as_posix())
+
+from aiohttp import web
+
+from library.utils import CFG
+from WeCom.access_token import AccessTokenManager
+from WeCom.client import WeComClient, split_text
+
+
+def assert_parts(parts: list[str], max_bytes: int) -> None:
+    assert parts and all(0 < len(part.encode()) <= max_bytes for part in parts)
+
+
+def test_split_text_bytes():
+    assert split_text('short') == ['short']
+    assert split_text('  \n') == []
+    # 3 字节的中文和 4 字节的 emoji, max_bytes 不是字符长度的整数倍时不截断字符
+    for content, max_bytes in (('中' * 100, 31), ('😀' * 50, 30), ('a中😀' * 40, 17)):
+        parts = split_text(content, max_bytes)
+        assert_parts(parts, max_bytes)
+        assert ''.join(parts) == content
+        # 每段尽量填满
+        assert all(len(part.encode()) > max_bytes - 4 for part in parts[:-1])
+
+
+def test_split_text_prefers_separators():
+    content = '第一句话。' * 10 + '\n\n' + '第二段内容，' * 10
+    parts = split_text(content, 100)
+    assert_parts(parts, 100)
+    assert all(part.endswith(('。', '，')) for part in parts[:-1])
+    assert ''.join(parts) == content.replace('\n\n', '')
+    # 分隔符太靠前时不在分隔符处断开, 避免过短的分段
+    parts = split_text('a. ' + 'b' * 200, 100)
+    assert [len(part) for part in parts] == [100, 100, 3]
+
+
+def test_send_retries():
+    calls = []
+    replies = []
+    token_errors = []
+
+    async def send_msg(request: web.Request) -> web.Response:
+        calls.append(request.query['access_token'])
+        status, errcode = replies.pop(0) if replies else (200, 0)
+        if status != 200:
+            return web.Response(status= status, text= '<html>error</html>')
+        return web.json_response({'errcode': errcode, 'errmsg': ''})
+
+    async def gettoken(request: web.Request) -> web.Response:
+        if token_errors:
+            return web.json_response(token_errors.pop(0))
+        return web.json_response({'access_token': f"token{len(calls)}", 'expires_in': 7200})
+
+    async def main():
+        app = web.Application()
+        app.router.add_post('/send', send_msg)
+        app.router.add_get('/gettoken', gettoken)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        base_url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+        CFG.C['WeCom']['URL']['SEND_MSG'] = base_url + '/send?access_token=%s'
+        CFG.C['WeCom']['URL']['ACCTK'] = base_url + '/gettoken?corpid=%s&corpsecret=%s'
+        CFG.C['WeCom']['CorpID'], CFG.C['WeCom']['Secret'] = 'corp', 'secret'
+
+        token_manager = AccessTokenManager.get_instance()
+        token_manager.token, token_manager.expiry = 'token0', time.time() + 7200
+        token_manager._store_cache = lambda: None
+        client = WeComClient()
+        client.backoff = 0.01
+        payload = {'touser': 'user1', 'msgtype': 'text', 'text': {'content': 'hi'}}
+        try:
+            # 5xx 和系统繁忙退避后重试
+            replies[:] = [(502, None), (200, -1)]
+            started = time.monotonic()
+            assert await client.send(payload) is True
+            assert len(calls) == 3 and time.monotonic() - started >= 0.01 * (0.5 + 1)
+
+            # token 失效时刷新后重试
+            calls.clear()
+            replies[:] = [(200, 42001)]
+            assert await client.send(payload) is True
+            assert calls[0] == 'token0' and calls[1] == 'token1'
+
+            # 不是 json 的 4xx body 和获取 token 出错都退避后重试
+            calls.clear()
+            replies[:] = [(404, None), (200, 42001)]
+            token_errors[:] = [{'errcode': 40013, 'errmsg': 'invalid corpid'}]
+            assert await client.send(payload) is True
+            assert len(calls) == 3 and not token_errors
+
+            # 其他错误不重试
+            calls.clear()
+            replies[:] = [(200, 40003)]
+            assert await client.send(payload) is False and len(calls) == 1
+
+            # 重试次数用完
+            calls.clear()
+            replies[:] = [(500, None)] * (client.retries + 1)
+            assert await client.send(payload) is False and len(calls) == client.retries + 1
+
+            # 长文本按顺序分段发送
+            calls.clear()
+            client.max_bytes = 30
+            assert await client.send_text('中' * 25, {'FromUserName': 'user1', 'AgentID': 1}) is True
+            assert len(calls) == 3
+        finally:
+            await client.close_session()
+            await runner.cleanup()
+            AccessTokenManager._instance = None
+    asyncio.run(main())
+
+
+def test_user_limiters_are_pruned():
+    client = WeComClient()
+    for i in range(5):
+        client._user_limiter(f"user{i}").take(1)
+    assert list(client._user_limiters) == [f"user{i}" for i in range(5)]
+    # 最近一分钟内使用过的限流器保留
+    client._user_limiter('user0')
+    assert list(client._user_limiters)[-1] == 'user0' and len(client._user_limiters) == 5
+
+    # 恢复满额的限流器被回收
+    for limiter in list(client._user_limiters.values())[:3]:
+        limiter.updated -= 120
+    client._user_limiter('user9')
+    assert list(client._user_limiters) == ['user4', 'user0', 'user9']
+
+
+def main():
+    test_split_text_bytes()
+    test_split_text_prefers_separators()
+    test_send_retries()
+    test_user_limiters_are_pruned()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   test_wecom_crypto.py
+@Desc    :   WeComCrypto 加解密往返, 以及与原 WXBizMsgCrypt 相同 key/随机串/nonce/timestamp 下的密文和签名一致
+'''
+
+# here put the import lib
+import os
+import re
+import sys, pathlib
+sys.path.append(pathlib.Path(__file__).parent.parent.as_posix())
+
+from library.WeCom import crypto
+from library.WeCom.crypto import WeComCrypto, WeComCryptoError
+from library.WeCom.WXBizMsgCrypt3 import WXBizMsgCrypt
+
+TOKEN = 'QDG6eK'
+ENCODING_AES_KEY = 'jWmYm7qr5nMoAUwZRjGtBxmz3KA1tkAj3ykkR6q2B2C'
+RECEIVEID = 'wx5823bf96d3bd56c7'
+NONCE = '1372623149'
+TIMESTAMP = '1409659813'
+REPLY = '<xml><ToUserName><![CDATA[mycreate]]></ToUserName><Content><![CDATA[你好 hello]]></Content></xml>'
+# 原 WXBizMsgCrypt3.WXBizMsgCrypt.EncryptMsg(REPLY, NONCE, TIMESTAMP) 的输出, 16 位随机串固定为 1234567890123456
+ORIGINAL_ENCRYPT = (
+    'y514aRT8yYkYNee3kPvkrOpXjZtZn8OYvgmJEygXgdB915p86nB0Kor9PXAlyYpr+k2ZAwwb/dM6Lmzm0RIuKfBSjS37n5OrVwAdneJURt6uNXTy'
+    'CUEXFB27kIwhqMKnbwETzbijWNY4yWp55DRUAcC+5ICzkpcK/ocZybbbTjHlUpkGvVzY31ILc7fn9OaqFnN+Eu8zcdl2D2qE23fl8w=='
+)
+ORIGINAL_SIGNATURE = 'e858f885710cf12dfbf7abfd55b9c391aef40e74'
+
+
+def extract(xml: str, tag: str) -> str:
+    return re.search(rf"<{tag}>(?:<!\[CDATA\[)?(.*?)(?:\]\]>)?</{tag}>", xml).group(1)
+
+
+def test_round_trip():
+    wecom_crypto = WeComCrypto(TOKEN, ENCODING_AES_KEY, RECEIVEID)
+    for text in ('', 'a', 'x' * 31, 'x' * 32, '中文消息' * 100):
+        encrypted = wecom_crypto.encrypt(text)
+        decrypted = wecom_crypto.decrypt(encrypted)
+        assert decrypted['message'].decode() == text
+        assert decrypted['length'] == len(text.encode())
+        assert decrypted['receiveid'] == RECEIVEID
+        assert len(decrypted['random']) == 16
+    # 每条消息的随机串不同
+    assert wecom_crypto.encrypt('a') != wecom_crypto.encrypt('a')
+
+    signature = wecom_crypto.signature(TIMESTAMP, NONCE, 'data')
+    assert wecom_crypto.verify(signature, TIMESTAMP, NONCE, 'data')
+    assert not wecom_crypto.verify(signature, TIMESTAMP, NONCE, 'other')
+
+    try:
+        WeComCrypto(TOKEN, 'too short')
+        assert False
+    except WeComCryptoError:
+        pass
+
+
+def test_same_as_original():
+    wecom_crypto = WeComCrypto(TOKEN, ENCODING_AES_KEY, RECEIVEID)
+    urandom = crypto.os.urandom
+    crypto.os.urandom = lambda n: bytes.fromhex('1234567890123456')
+    try:
+        reply_xml = wecom_crypto.encrypt_reply(REPLY, NONCE, TIMESTAMP)
+    finally:
+        crypto.os.urandom = urandom
+    assert extract(reply_xml, 'Encrypt') == ORIGINAL_ENCRYPT
+    assert extract(reply_xml, 'MsgSignature') == ORIGINAL_SIGNATURE
+    assert extract(reply_xml, 'TimeStamp') == TIMESTAMP and extract(reply_xml, 'Nonce') == NONCE
+
+    # 原实现产生的密文可以被校验和解密
+    assert wecom_crypto.verify(ORIGINAL_SIGNATURE, TIMESTAMP, NONCE, ORIGINAL_ENCRYPT)
+    decrypted = wecom_crypto.decrypt(ORIGINAL_ENCRYPT)
+    assert decrypted['random'] == '1234567890123456'
+    assert decrypted['message'].decode() == REPLY and decrypted['receiveid'] == RECEIVEID
+
+    # 兼容接口 WXBizMsgCrypt 接受 WeComCrypto 的回复
+    post_data = f"<xml><ToUserName><![CDATA[{RECEIVEID}]]></ToUserName><Encrypt><![CDATA[{extract(reply_xml, 'Encrypt')}]]></Encrypt></xml>"
+    ret, message = WXBizMsgCrypt(TOKEN, ENCODING_AES_KEY, RECEIVEID).DecryptMsg(post_data, ORIGINAL_SIGNATURE, TIMESTAMP, NONCE)
+    assert ret == 0 and message.decode() == REPLY
+    ret, _ = WXBizMsgCrypt(TOKEN, ENCODING_AES_KEY, RECEIVEID).DecryptMsg(post_data, '0' * 40, TIMESTAMP, NONCE)
+    assert ret != 0
+
+
+def main():
+    test_round_trip()
+    test_same_as_original()
+
+
+if __name__ == '__main__':
+    main()